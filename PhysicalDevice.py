@@ -25,8 +25,232 @@ import cupshelpers
 import urllib.parse
 import ppdippstr
 import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from debug import *
 
+HOST_CACHE_TTL = 300
+HOST_NEGATIVE_CACHE_TTL = 60
+HOST_RESOLVER_THREADS = 8
+
+def _parse_host_from_uri (uri):
+    """
+    Find the host named by a device URI, without resolving it.
+
+    @returns: (host, dnssdhost) tuple, either of which may be None
+    """
+    hostport = None
+    host = None
+    dnssdhost = None
+    (scheme, rest) = urllib.parse.splittype (uri)
+    if scheme == 'hp' or scheme == 'hpfax':
+        ipparam = None
+        if rest.startswith ("/net/"):
+            (rest, ipparam) = urllib.parse.splitquery (rest[5:])
+
+        if ipparam is not None:
+            if ipparam.startswith("ip="):
+                hostport = ipparam[3:]
+            elif ipparam.startswith ("hostname="):
+                hostport = ipparam[9:]
+            elif ipparam.startswith("zc="):
+                dnssdhost = ipparam[3:]
+            else:
+                return None, None
+        else:
+            return None, None
+    elif scheme == 'dnssd' or scheme == 'mdns':
+        # The URIs of the CUPS "dnssd" backend do not contain the host
+        # name of the printer
+        return None, None
+    else:
+        (hostport, rest) = urllib.parse.splithost (rest)
+        if hostport is None:
+            return None, None
+
+    if hostport:
+        (host, port) = urllib.parse.splitport (hostport)
+
+    return host, dnssdhost
+
+class HostResolver:
+    """
+    Resolve host names to addresses on a pool of worker threads,
+    remembering the results (including failures) for a while so
+    that grouping devices never has to wait for DNS.
+    """
+
+    def __init__ (self, ttl=HOST_CACHE_TTL,
+                  negative_ttl=HOST_NEGATIVE_CACHE_TTL,
+                  max_workers=HOST_RESOLVER_THREADS):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_workers = max_workers
+        self._lock = threading.Lock ()
+        self._cache = {}
+        self._pending = {}
+        self._executor = None
+
+    def _getaddrinfo (self, hostname):
+        try:
+            return socket.getaddrinfo(hostname, 0,
+                                      family=socket.AF_INET)[0][4][0]
+        except:
+            try:
+                return socket.getaddrinfo(hostname, 0,
+                                          family=socket.AF_INET6)[0][4][0]
+            except:
+                return None
+
+    def _resolve (self, hostname):
+        address = self._getaddrinfo (hostname)
+        if address:
+            expires = time.monotonic () + self.ttl
+        else:
+            expires = time.monotonic () + self.negative_ttl
+
+        with self._lock:
+            self._cache[hostname] = (address, expires)
+            self._pending.pop (hostname, None)
+
+        return address
+
+    def _cached (self, hostname):
+        # Must be called with the lock held.
+        entry = self._cache.get (hostname)
+        if entry is None:
+            return False, None
+
+        (address, expires) = entry
+        if expires < time.monotonic ():
+            del self._cache[hostname]
+            return False, None
+
+        return True, address
+
+    def get_cached (self, hostname):
+        """
+        Look up a host name in the cache only.
+
+        @param hostname: host name
+        @type hostname: string
+        @returns: (found, address) tuple; address is None for a
+        cached failure
+        """
+        with self._lock:
+            return self._cached (hostname)
+
+    def lookup (self, hostname):
+        """
+        Find the address for a host name, using the cache or an
+        outstanding lookup where possible and otherwise resolving
+        it synchronously.
+
+        @param hostname: host name
+        @type hostname: string
+        @returns: address string, or None if it cannot be resolved
+        """
+        with self._lock:
+            (found, address) = self._cached (hostname)
+            if found:
+                return address
+
+            future = self._pending.get (hostname)
+
+        if future is not None:
+            return future.result ()
+
+        return self._resolve (hostname)
+
+    def resolve (self, hostnames, reply_handler=None):
+        """
+        Start resolving host names in the background.
+
+        @param hostnames: host names to resolve
+        @type hostnames: iterable of strings
+        @param reply_handler: function to call, with no arguments,
+        once every host name has been resolved.  It is called in a
+        worker thread, or straight away if there was nothing to do.
+        @type reply_handler: function
+        """
+        futures = []
+        with self._lock:
+            for hostname in set (hostnames):
+                if not hostname:
+                    continue
+
+                future = self._pending.get (hostname)
+                if future is None:
+                    (found, address) = self._cached (hostname)
+                    if found:
+                        continue
+
+                    if self._executor is None:
+                        self._executor = ThreadPoolExecutor (
+                            max_workers=self.max_workers)
+
+                    future = self._executor.submit (self._resolve, hostname)
+                    self._pending[hostname] = future
+
+                futures.append (future)
+
+        debugprint ("HostResolver: %d host names to resolve" % len (futures))
+        if reply_handler is None:
+            return
+
+        if not futures:
+            reply_handler ()
+            return
+
+        remaining = [len (futures)]
+        lock = threading.Lock ()
+        def done (future):
+            with lock:
+                remaining[0] -= 1
+                finished = remaining[0] == 0
+
+            if finished:
+                reply_handler ()
+
+        for future in futures:
+            future.add_done_callback (done)
+
+    def clear (self):
+        """
+        Forget all cached results.
+        """
+        with self._lock:
+            self._cache.clear ()
+
+_host_resolver = HostResolver ()
+
+def get_host_resolver ():
+    """
+    @returns: the HostResolver shared by all PhysicalDevice objects
+    """
+    return _host_resolver
+
+def resolve_device_hosts (devices, reply_handler=None):
+    """
+    Start resolving, in the background, the host names that
+    PhysicalDevice will need to look up for these devices.
+
+    @param devices: devices about to be grouped
+    @type devices: iterable of cupshelpers.Device
+    @param reply_handler: function to call, with no arguments, once
+    the addresses are cached.  It is called in a worker thread.
+    @type reply_handler: function
+    """
+    hostnames = []
+    for device in devices:
+        (host, dnssdhost) = _parse_host_from_uri (device.uri)
+        hostnames.extend ([host, dnssdhost])
+        if hasattr (device, 'hostname'):
+            hostnames.append (device.hostname)
+
+    _host_resolver.resolve (hostnames, reply_handler=reply_handler)
+
 class PhysicalDevice:
     def __init__(self, device):
         self.devices = None
@@ -34,6 +258,7 @@ class PhysicalDevice:
         self.dnssd_hostname = None
         self._cupsserver = False
         self.firsturi = None
+        self._normalized_make_and_model = None
         self.add_device (device)
         self._user_data = {}
         self._ppdippstr = ppdippstr.backends
@@ -62,50 +287,10 @@ class PhysicalDevice:
             return hostname
 
     def _get_address (self, hostname):
-        try:
-            address = socket.getaddrinfo(hostname, 0,
-                                         family=socket.AF_INET)[0][4][0]
-        except:
-            try:
-                address = socket.getaddrinfo(hostname, 0,
-                                             family=socket.AF_INET6)[0][4][0]
-            except:
-                address = None
-        return address
+        return _host_resolver.lookup (hostname)
 
     def _get_host_from_uri (self, uri):
-        hostport = None
-        host = None
-        dnssdhost = None
-        (scheme, rest) = urllib.parse.splittype (uri)
-        if scheme == 'hp' or scheme == 'hpfax':
-            ipparam = None
-            if rest.startswith ("/net/"):
-                (rest, ipparam) = urllib.parse.splitquery (rest[5:])
-
-            if ipparam is not None:
-                if ipparam.startswith("ip="):
-                    hostport = ipparam[3:]
-                elif ipparam.startswith ("hostname="):
-                    hostport = ipparam[9:]
-                elif ipparam.startswith("zc="):
-                    dnssdhost = ipparam[3:]
-                else:
-                    return None, None
-            else:
-                return None, None
-        elif scheme == 'dnssd' or scheme == 'mdns':
-            # The URIs of the CUPS "dnssd" backend do not contain the host
-            # name of the printer
-            return None, None
-        else:
-            (hostport, rest) = urllib.parse.splithost (rest)
-            if hostport is None:
-                return None, None
-
-        if hostport:
-            (host, port) = urllib.parse.splitport (hostport)
-
+        (host, dnssdhost) = _parse_host_from_uri (uri)
         if (host):
             ip = None
             try:
@@ -166,6 +351,7 @@ class PhysicalDevice:
 
                 self.mfg = nicest (self.mfg, mfg)
                 self.mdl = nicest (self.mdl, mdl)
+                self._normalized_make_and_model = None
 
                 sn = device.id_dict.get ('SN', '')
                 if sn != '' and self.sn != '' and sn != self.sn:
@@ -283,6 +469,62 @@ class PhysicalDevice:
                 (self.mfg, self.mdl, self.sn, self._network_host,
                  self.dnssd_hostname, self.firsturi))
 
+    def _get_normalized_make_and_model (self):
+        """
+        Split and normalize our make and model, for comparison with
+        other physical devices.  The result is remembered until the
+        make or model changes.
+
+        @returns: (normalized make, normalized model) tuple
+        """
+        if self._normalized_make_and_model is None:
+            if (self.mfg == '' or
+                self.mdl.lower ().startswith (self.mfg.lower ())):
+                make_and_model = self.mdl
+            else:
+                make_and_model = "%s %s" % (self.mfg, self.mdl)
+            (mfg, mdl) = cupshelpers.ppds.ppdMakeModelSplit (make_and_model)
+            self._normalized_make_and_model = \
+                (cupshelpers.ppds.normalize (mfg),
+                 cupshelpers.ppds.normalize (mdl))
+
+        return self._normalized_make_and_model
+
+    def _get_host_keys (self):
+        """
+        @returns: list of the non-empty host names this physical
+        device is known by, or [None] if there are none
+        """
+        hosts = []
+        for host in [self._network_host, self.dnssd_hostname]:
+            if host and host not in hosts:
+                hosts.append (host)
+
+        return hosts or [None]
+
+    def _get_identity_keys (self):
+        """
+        Compute the keys by which __eq__ could possibly consider
+        another physical device equal to this one: device URIs,
+        normalized make and model, HP serial number, and whether
+        this is just a backend with no make.  Two physical devices
+        can only compare equal if they share a host key (see
+        _get_host_keys) and an identity key.
+
+        @returns: list of hashable keys
+        """
+        keys = [('uri', x.uri) for x in self.devices]
+        if self.mfg == '':
+            keys.append (('nomfg',))
+
+        if not (self.mfg == '' and self.mdl == ''):
+            (mfg, mdl) = self._get_normalized_make_and_model ()
+            keys.append (('model', mfg, mdl))
+            if mfg == "hp" and self.sn != '':
+                keys.append (('hpsn', self.sn))
+
+        return keys
+
     def __eq__(self, other):
         if type (other) != type (self):
             return False
@@ -323,17 +565,8 @@ class PhysicalDevice:
             # One or other is just a backend, not a real physical device.
             return False
 
-        def split_make_and_model (dev):
-            if dev.mfg == '' or dev.mdl.lower ().startswith (dev.mfg.lower ()):
-                make_and_model = dev.mdl
-            else:
-                make_and_model = "%s %s" % (dev.mfg, dev.mdl)
-            (mfg, mdl) = cupshelpers.ppds.ppdMakeModelSplit (make_and_model)
-            return (cupshelpers.ppds.normalize (mfg),
-                    cupshelpers.ppds.normalize (mdl))
-
-        (our_mfg, our_mdl) = split_make_and_model (self)
-        (other_mfg, other_mdl) = split_make_and_model (other)
+        (our_mfg, our_mdl) = self._get_normalized_make_and_model ()
+        (other_mfg, other_mdl) = other._get_normalized_make_and_model ()
 
         if our_mfg != other_mfg:
             return False
@@ -391,17 +624,8 @@ class PhysicalDevice:
             # One or other is just a backend, not a real physical device.
             return other.mfg == '' and other.mdl == ''
 
-        def split_make_and_model (dev):
-            if dev.mfg == '' or dev.mdl.lower ().startswith (dev.mfg.lower ()):
-                make_and_model = dev.mdl
-            else:
-                make_and_model = "%s %s" % (dev.mfg, dev.mdl)
-            (mfg, mdl) = cupshelpers.ppds.ppdMakeModelSplit (make_and_model)
-            return (cupshelpers.ppds.normalize (mfg),
-                    cupshelpers.ppds.normalize (mdl))
-
-        (our_mfg, our_mdl) = split_make_and_model (self)
-        (other_mfg, other_mdl) = split_make_and_model (other)
+        (our_mfg, our_mdl) = self._get_normalized_make_and_model ()
+        (other_mfg, other_mdl) = other._get_normalized_make_and_model ()
 
         if our_mfg != other_mfg:
             return our_mfg < other_mfg
@@ -414,20 +638,143 @@ class PhysicalDevice:
 
         return self.sn < other.sn
 
+class PhysicalDeviceGrouper:
+    """
+    Group devices into physical devices without comparing each new
+    physical device against every existing one.
+
+    Existing physical devices are indexed by their host and identity
+    keys, so that only those which could possibly compare equal are
+    checked with __eq__.  The result of index() is the same as
+    list.index() on the underlying list.
+    """
+
+    def __init__ (self, physicaldevices=None):
+        """
+        @param physicaldevices: list of PhysicalDevice objects to
+        add to; it is updated in place by append()
+        @type physicaldevices: list
+        """
+        if physicaldevices is None:
+            physicaldevices = []
+
+        self.physicaldevices = physicaldevices
+        self._buckets = {}
+        self._keys = []
+        for i in range (len (physicaldevices)):
+            self._index (i)
+
+    def _get_keys (self, physicaldevice):
+        keys = []
+        for host in physicaldevice._get_host_keys ():
+            for key in physicaldevice._get_identity_keys ():
+                keys.append ((host, key))
+
+        return keys
+
+    def _index (self, i):
+        keys = self._get_keys (self.physicaldevices[i])
+        for key in keys:
+            self._buckets.setdefault (key, set ()).add (i)
+
+        if i < len (self._keys):
+            self._keys[i] = keys
+        else:
+            self._keys.append (keys)
+
+    def _unindex (self, i):
+        for key in self._keys[i]:
+            bucket = self._buckets[key]
+            bucket.discard (i)
+            if not bucket:
+                del self._buckets[key]
+
+    def index (self, physicaldevice):
+        """
+        Find the first physical device equal to the one given.
+
+        @param physicaldevice: physical device to look for
+        @type physicaldevice: PhysicalDevice
+        @returns: index into the list of physical devices
+        @raise ValueError: no physical device is equal to it
+        """
+        candidates = set ()
+        for key in self._get_keys (physicaldevice):
+            candidates.update (self._buckets.get (key, ()))
+
+        for i in sorted (candidates):
+            other = self.physicaldevices[i]
+            if other is physicaldevice or other == physicaldevice:
+                return i
+
+        raise ValueError
+
+    def append (self, physicaldevice):
+        """
+        Add a new physical device to the list.
+
+        @param physicaldevice: physical device to add
+        @type physicaldevice: PhysicalDevice
+        """
+        self.physicaldevices.append (physicaldevice)
+        self._index (len (self.physicaldevices) - 1)
+
+    def add_device (self, i, device):
+        """
+        Add a device to an existing physical device.
+
+        @param i: index into the list of physical devices
+        @type i: int
+        @param device: device to add
+        @type device: cupshelpers.Device
+        @raise ValueError: the device does not belong there
+        """
+        self._unindex (i)
+        try:
+            self.physicaldevices[i].add_device (device)
+        finally:
+            # Even a failed add_device() may have changed the
+            # make and model.
+            self._index (i)
+
+    def add (self, device):
+        """
+        Add a device, either to the physical device it belongs
+        to or as a new physical device.
+
+        @param device: device to add
+        @type device: cupshelpers.Device
+        @returns: the PhysicalDevice it was added to
+        """
+        physicaldevice = PhysicalDevice (device)
+        try:
+            i = self.index (physicaldevice)
+            self.add_device (i, device)
+            return self.physicaldevices[i]
+        except ValueError:
+            self.append (physicaldevice)
+            return physicaldevice
+
+def group_devices (devices):
+    """
+    Group devices into physical devices.
+
+    @param devices: devices to group
+    @type devices: iterable of cupshelpers.Device
+    @returns: list of PhysicalDevice objects
+    """
+    grouper = PhysicalDeviceGrouper ()
+    for device in devices:
+        grouper.add (device)
+
+    return grouper.physicaldevices
+
 if __name__ == '__main__':
     import authconn
     c = authconn.Connection ()
     devices = cupshelpers.getDevices (c)
 
-    physicaldevices = []
-    for device in devices.values ():
-        physicaldevice = PhysicalDevice (device)
-        try:
-            i = physicaldevices.index (physicaldevice)
-            physicaldevices[i].add_device (device)
-        except ValueError:
-            physicaldevices.append (physicaldevice)
-
+    physicaldevices = group_devices (devices.values ())
     physicaldevices.sort ()
     for physicaldevice in physicaldevices:
         print(physicaldevice.get_info ())
@@ -28,8 +28,14 @@ import string
 import time
 import locale
 import os.path
+import array
+import bisect
 import functools
+import hashlib
+import pickle
 import re
+import tempfile
+from collections.abc import Mapping
 from . import _debugprint, set_debugprint_fn
 from functools import reduce
 
@@ -84,6 +90,30 @@ _MFR_NAMES_BY_LOWER = {}
 for mfr, regexp in _MFR_BY_RANGE:
     _MFR_NAMES_BY_LOWER[mfr.lower ()] = mfr
 
+# All of the _MFR_BY_RANGE expressions combined into one, so that a
+# single match finds the first of them to match.  Each is wrapped in
+# a named group giving its position in the list.
+_RE_mfr_by_range = re.compile ("|".join (["(?P<mfr%d>%s)" % (i, regexp.pattern)
+                                          for i, (mfr, regexp)
+                                          in enumerate (_MFR_BY_RANGE)]))
+_MFR_BY_GROUP = dict ([("mfr%d" % i, mfr)
+                       for i, (mfr, regexp) in enumerate (_MFR_BY_RANGE)])
+
+# Manufacturer names of more than one word, and the canonical names
+# for them.  Longer names must come before any prefix of them.
+_TWO_WORD_MFRS = [
+    ("canon inc", "Canon"),
+    ("konica minolta", "KONICA MINOLTA"),
+    ("lexmark international", "Lexmark"),
+    ("kyocera mita", "Kyocera"),
+    ("kyocera", "Kyocera"),
+    ("fuji xerox", "Fuji Xerox"),
+    ]
+_RE_two_word_mfr = re.compile ("(?:%s) " % "|".join ([name for name, mfr
+                                                      in _TWO_WORD_MFRS]))
+_TWO_WORD_MFR_NAMES = dict ([(name + " ", mfr)
+                             for name, mfr in _TWO_WORD_MFRS])
+
 _HP_MODEL_BY_NAME = {
     "dj": "DeskJet",
     "lj": "LaserJet",
@@ -94,6 +124,8 @@ _HP_MODEL_BY_NAME = {
 }
 
 _RE_turboprint = re.compile ("turboprint")
+_RE_lower_digit = re.compile (r"(?<=[a-z])(?=[0-9])")
+_RE_lower_upper = re.compile (r"(?<=[a-z])(?=[A-Z])")
 _RE_version_numbers = re.compile (r" v(?:er\.)?\d(?:\d*\.\d+)?(?: |$)")
 _RE_ignore_suffix = re.compile (","
                                 "| hpijs"
@@ -116,6 +148,7 @@ _RE_ignore_suffix = re.compile (","
                                 )
 _RE_ignore_series = re.compile (" series| all-in-one", re.I)
 
+@functools.lru_cache (maxsize=8192)
 def ppdMakeModelSplit (ppd_make_and_model):
     """
     Split a ppd-make-and-model string into a canonical make and model pair.
@@ -125,21 +158,25 @@ def ppdMakeModelSplit (ppd_make_and_model):
     @return: a string pair representing the make and the model
     """
 
-    # If the string starts with a known model name (like "LaserJet") assume
-    # that the manufacturer name is missing and add the manufacturer name
-    # corresponding to the model name
     ppd_make_and_model.strip ()
     make = None
     cleanup_make = False
     l = ppd_make_and_model.lower ()
-    for mfr, regexp in _MFR_BY_RANGE:
-        if regexp.match (l):
-            make = mfr
+    turboprint = _RE_turboprint.search (l)
+    two_word_mfr = _RE_two_word_mfr.match (l)
+
+    # If the string starts with a known model name (like "LaserJet") it
+    # is not from Turboprint.  The manufacturer name for the model is
+    # not kept: the string is split at its first word below like any
+    # other, so the check is only needed for Turboprint strings.
+    if turboprint:
+        match = _RE_mfr_by_range.match (l)
+        if match:
+            make = _MFR_BY_GROUP[match.lastgroup]
             model = ppd_make_and_model
-            break
 
     # Handle PPDs provided by Turboprint
-    if make is None and _RE_turboprint.search (l):
+    if make is None and turboprint:
         t = ppd_make_and_model.find (" TurboPrint")
         if t != -1:
             t2 = ppd_make_and_model.rfind (" TurboPrint")
@@ -152,33 +189,18 @@ def ppdMakeModelSplit (ppd_make_and_model):
         except:
             make = ppd_make_and_model
             model = ''
-        make = re.sub (r"(?<=[a-z])(?=[0-9])", " ", make)
-        make = re.sub (r"(?<=[a-z])(?=[A-Z])", " ", make)
-        model = re.sub (r"(?<=[a-z])(?=[0-9])", " ", model)
-        model = re.sub (r"(?<=[a-z])(?=[A-Z])", " ", model)
-        model = re.sub (r" Jet", "Jet", model)
-        model = re.sub (r"Photo Smart", "PhotoSmart", model)
+        make = _RE_lower_digit.sub (" ", make)
+        make = _RE_lower_upper.sub (" ", make)
+        model = _RE_lower_digit.sub (" ", model)
+        model = _RE_lower_upper.sub (" ", model)
+        model = model.replace (" Jet", "Jet")
+        model = model.replace ("Photo Smart", "PhotoSmart")
         cleanup_make = True
 
     # Special handling for two-word manufacturers
-    elif l.startswith ("canon inc "):
-        make = "Canon"
-        model = ppd_make_and_model[10:]
-    elif l.startswith ("konica minolta "):
-        make = "KONICA MINOLTA"
-        model = ppd_make_and_model[15:]
-    elif l.startswith ("lexmark international "):
-        make = "Lexmark"
-        model = ppd_make_and_model[22:]
-    elif l.startswith ("kyocera mita "):
-        make = "Kyocera"
-        model = ppd_make_and_model[13:]
-    elif l.startswith ("kyocera "):
-        make = "Kyocera"
-        model = ppd_make_and_model[8:]
-    elif l.startswith ("fuji xerox "):
-        make = "Fuji Xerox"
-        model = ppd_make_and_model[11:]
+    elif two_word_mfr:
+        make = _TWO_WORD_MFR_NAMES[two_word_mfr.group ()]
+        model = ppd_make_and_model[two_word_mfr.end ():]
 
     # Finally, take the first word as the name of the manufacturer.
     else:
@@ -251,6 +273,41 @@ def ppdMakeModelSplit (ppd_make_and_model):
     model = model.strip ()
     return (make, model)
 
+_RE_normalize_words = re.compile ("[a-z]+|[0-9]+")
+
+def _normalize_chars (lstrin):
+    """
+    Character-by-character implementation of normalize(), used for
+    strings containing non-ASCII characters.  The input must already
+    be stripped and lower-cased.
+    """
+    normalized = []
+
+    BLANK=0
+    ALPHA=1
+    DIGIT=2
+    lastchar = BLANK
+
+    alnumfound = False
+    for c in lstrin:
+        if c.isalpha ():
+            if lastchar != ALPHA and alnumfound:
+                normalized.append (" ")
+            lastchar = ALPHA
+        elif c.isdigit ():
+            if lastchar != DIGIT and alnumfound:
+                normalized.append (" ")
+            lastchar = DIGIT
+        else:
+            lastchar = BLANK
+
+        if c.isalnum ():
+            normalized.append (c)
+            alnumfound = True
+
+    return "".join (normalized)
+
+@functools.lru_cache (maxsize=8192)
 def normalize (strin):
     """
     This function normalizes manufacturer and model names for comparing.
@@ -276,31 +333,13 @@ def normalize (strin):
     @return: a normalized lowercase string in which punctuations have been replaced with spaces.
     """
     lstrin = strin.strip ().lower ()
-    normalized = ""
+    if lstrin.isascii ():
+        # For ASCII the alphanumeric characters are exactly [a-z0-9]
+        # (after lower-casing), so each word is simply a run of
+        # letters or a run of digits.
+        return " ".join (_RE_normalize_words.findall (lstrin))
 
-    BLANK=0
-    ALPHA=1
-    DIGIT=2
-    lastchar = BLANK
-
-    alnumfound = False
-    for i in range (len (lstrin)):
-        if lstrin[i].isalpha ():
-            if lastchar != ALPHA and alnumfound:
-                normalized += " ";
-            lastchar = ALPHA
-        elif lstrin[i].isdigit ():
-            if lastchar != DIGIT and alnumfound:
-                normalized += " ";
-            lastchar = DIGIT
-        else:
-            lastchar = BLANK
-
-        if lstrin[i].isalnum ():
-            normalized += lstrin[i]
-            alnumfound = True
-
-    return normalized
+    return _normalize_chars (lstrin)
 
 def _singleton (x):
     """If we don't know whether getPPDs() or getPPDs2() was used, this
@@ -309,6 +348,313 @@ def _singleton (x):
         return x[0]
     return x
 
+# Bump this whenever the layout of the on-disk index, or the way the
+# makes/models/IDs tables are derived, changes.
+_INDEX_VERSION = 1
+_INDEX_FILENAME = "ppds-index.pickle"
+
+_SNAPSHOT_FILENAME = "ppds-snapshot.pickle"
+
+def _default_cache_dir ():
+    cache_home = os.environ.get ("XDG_CACHE_HOME")
+    if not cache_home:
+        cache_home = os.path.join (os.path.expanduser ("~"), ".cache")
+
+    return os.path.join (cache_home, "cupshelpers")
+
+def _get_cache_dir (cache_dir):
+    if cache_dir is None:
+        cache_dir = os.environ.get ("CUPSHELPERS_CACHEDIR")
+        if cache_dir is None:
+            cache_dir = _default_cache_dir ()
+
+    return cache_dir
+
+def _write_cache_file (cache_dir, filename, obj):
+    """
+    Atomically replace a pickled cache file.  Errors are not fatal.
+    """
+    tmpname = None
+    try:
+        os.makedirs (cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile (dir=cache_dir,
+                                          prefix=".%s" % filename,
+                                          delete=False) as f:
+            tmpname = f.name
+            pickle.dump (obj, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        os.replace (tmpname, os.path.join (cache_dir, filename))
+    except OSError as e:
+        _debugprint ("%s not saved: %s" % (filename, e))
+        if tmpname is not None:
+            try:
+                os.unlink (tmpname)
+            except OSError:
+                pass
+
+def savePPDsSnapshot (ppds, cache_dir=None):
+    """
+    Save the list of PPDs so that a later process can start with it
+    instead of waiting for CUPS.
+
+    @type ppds: dict
+    @param ppds: dict of PPDs as returned by cups.Connection.getPPDs()
+    or cups.Connection.getPPDs2()
+    @type cache_dir: string
+    @param cache_dir: directory to save it in, as for PPDs
+    """
+    cache_dir = _get_cache_dir (cache_dir)
+    if not cache_dir:
+        return
+
+    _write_cache_file (cache_dir, _SNAPSHOT_FILENAME,
+                       { 'version': _INDEX_VERSION,
+                         'ppds': ppds })
+
+def loadPPDsSnapshot (cache_dir=None):
+    """
+    Load the list of PPDs saved by savePPDsSnapshot().  It may be out
+    of date, so should be checked against CUPS.
+
+    @type cache_dir: string
+    @param cache_dir: directory it was saved in, as for PPDs
+    @returns: dict of PPDs, or None if there is no usable snapshot
+    """
+    cache_dir = _get_cache_dir (cache_dir)
+    if not cache_dir:
+        return None
+
+    try:
+        with open (os.path.join (cache_dir, _SNAPSHOT_FILENAME), "rb") as f:
+            snapshot = pickle.load (f)
+    except (OSError, EOFError, pickle.UnpicklingError,
+            AttributeError, ImportError, IndexError) as e:
+        _debugprint ("PPDs snapshot not loaded: %s" % e)
+        return None
+
+    if (not isinstance (snapshot, dict) or
+        snapshot.get ('version') != _INDEX_VERSION or
+        not isinstance (snapshot.get ('ppds'), dict)):
+        return None
+
+    return snapshot['ppds']
+
+class _ModelIndex:
+    """
+    The models for one make, sorted for nearest-neighbour lookups,
+    together with an index of the words in their names.
+    """
+
+    def __init__ (self, mdls):
+        self.mdls = mdls
+        mdlnames = list(mdls.keys ())
+        modelkey = functools.cmp_to_key (cups.modelSort)
+
+        # Case-insensitive model sort on the names.
+        self._sorted = [(x, x.lower()) for x in mdlnames]
+        self._sorted.sort (key=lambda x: modelkey (x[1]))
+        self._keys = [modelkey (x[1]) for x in self._sorted]
+        self._position = {}
+        for i, (x, xl) in enumerate (self._sorted):
+            self._position[x] = i
+
+        # First model name (in case-sensitive model sort order)
+        # containing each word.
+        self._words = {}
+        mdlnames.sort (key=modelkey)
+        for x in mdlnames:
+            for word in x.lower ().split (' '):
+                self._words.setdefault (word, x)
+
+    def neighbours (self, mdl, mdll):
+        """
+        Return the (name, lower-case name) pairs either side of
+        (mdl, mdll) as if it had been inserted into the sorted list
+        of models.
+        """
+        n = len (self._sorted)
+        j = bisect.bisect_right (self._keys,
+                                 functools.cmp_to_key (cups.modelSort) (mdll))
+
+        def at (k):
+            # Element k of the sorted list with (mdl, mdll) inserted
+            # at position j.
+            if k < 0:
+                k += n + 1
+            if k < j:
+                return self._sorted[k]
+            if k == j:
+                return (mdl, mdll)
+            return self._sorted[k - 1]
+
+        # An identically-named model sorts just before the inserted
+        # entry, and is the one found.
+        i = self._position.get (mdl, j)
+        candidates = [at (i - 1)]
+        if i + 1 < n + 1:
+            candidates.append (at (i + 1))
+
+        return candidates
+
+    def find_word (self, word):
+        """
+        Return the first model name containing a word, or None.
+        """
+        return self._words.get (word)
+
+class _PPDTable(Mapping):
+    """
+    A read-only mapping of PPD name to a dict of PPD attributes, as
+    given by cups.Connection.getPPDs2 (or getPPDs).  Rather than
+    keeping a dict for each PPD, each attribute is a column of
+    indexes into a table of distinct values, so that the many
+    repeated makes, languages, types and so on are only stored once.
+
+    Looking up a PPD name builds a new dict each time, so callers
+    cannot change the table through it.  Use get_attribute() to fetch
+    a single attribute without building the whole dict.
+    """
+
+    def __init__ (self, ppds):
+        """
+        @type ppds: dict
+        @param ppds: dict of PPDs as returned by
+        cups.Connection.getPPDs() or cups.Connection.getPPDs2()
+        """
+        self._names = []
+        self._rows = {}
+        self._columns = {}
+        self._values = []
+        self._value_ids = {}
+        for ppdname, ppddict in ppds.items ():
+            self._append (ppdname, ppddict)
+
+        # The lookup table is only needed while building.
+        self._value_ids = None
+
+    def _intern (self, value):
+        if isinstance (value, list):
+            value = tuple (value)
+
+        try:
+            return self._value_ids[value]
+        except KeyError:
+            value_id = len (self._values)
+            self._value_ids[value] = value_id
+        except TypeError:
+            # Not hashable so cannot be shared.
+            value_id = len (self._values)
+
+        self._values.append (value)
+        return value_id
+
+    def _append (self, ppdname, ppddict):
+        row = len (self._names)
+        self._names.append (ppdname)
+        self._rows[ppdname] = row
+        for attribute in ppddict.keys ():
+            if attribute not in self._columns:
+                self._columns[attribute] = array.array ('i', [-1] * row)
+
+        for attribute, column in self._columns.items ():
+            if attribute in ppddict:
+                column.append (self._intern (ppddict[attribute]))
+            else:
+                column.append (-1)
+
+    def _value (self, value_id):
+        value = self._values[value_id]
+        if isinstance (value, tuple):
+            return list (value)
+
+        return value
+
+    def get_row (self, ppdname):
+        """
+        @returns: the row number of a PPD, which is its position in
+        iteration order
+        """
+        return self._rows[ppdname]
+
+    def get_name (self, row):
+        """
+        @returns: the PPD name for a row number
+        """
+        return self._names[row]
+
+    def get_attribute (self, ppdname, attribute, default=None):
+        """
+        @param ppdname: PPD name
+        @type ppdname: string
+        @param attribute: attribute name, e.g. 'ppd-make-and-model'
+        @type attribute: string
+        @returns: the attribute value for that PPD, or default if it
+        does not have one
+        """
+        row = self._rows[ppdname]
+        try:
+            value_id = self._columns[attribute][row]
+        except KeyError:
+            return default
+
+        if value_id == -1:
+            return default
+
+        return self._value (value_id)
+
+    def __getitem__ (self, ppdname):
+        row = self._rows[ppdname]
+        ppddict = {}
+        for attribute, column in self._columns.items ():
+            value_id = column[row]
+            if value_id != -1:
+                ppddict[attribute] = self._value (value_id)
+
+        return ppddict
+
+    def digest (self, h):
+        """
+        Feed the table's contents into a hash object.  This works on
+        the columns directly, so is much cheaper than building each
+        PPD's dict.
+
+        @param h: hash object, e.g. from hashlib.sha1()
+        """
+        h.update ("\0".join (self._names).encode ("utf-8", "replace"))
+        for attribute in sorted (self._columns.keys ()):
+            h.update (attribute.encode ("utf-8", "replace"))
+            h.update (self._columns[attribute].tobytes ())
+
+        h.update (repr (self._values).encode ("utf-8", "replace"))
+
+    def __contains__ (self, ppdname):
+        return ppdname in self._rows
+
+    def __iter__ (self):
+        return iter (self._names)
+
+    def __len__ (self):
+        return len (self._names)
+
+class _PPDTableView(Mapping):
+    """
+    The PPDs with the given names, as a mapping like _PPDTable.  The
+    dict for each PPD is only built if it is looked up.
+    """
+
+    def __init__ (self, table, ppdnames):
+        self._table = table
+        self._names = list (dict.fromkeys (ppdnames))
+
+    def __getitem__ (self, ppdname):
+        return self._table[ppdname]
+
+    def __iter__ (self):
+        return iter (self._names)
+
+    def __len__ (self):
+        return len (self._names)
+
 class PPDs:
     """
     This class is for handling the list of PPDs returned by CUPS.  It
@@ -336,7 +682,7 @@ class PPDs:
                        FIT_GENERIC: STATUS_GENERIC_DRIVER,
                        FIT_NONE: STATUS_NO_DRIVER }
 
-    def __init__ (self, ppds, language=None, xml_dir=None):
+    def __init__ (self, ppds, language=None, xml_dir=None, cache_dir=None):
         """
         @type ppds: dict
         @param ppds: dict of PPDs as returned by cups.Connection.getPPDs()
@@ -345,10 +691,24 @@ class PPDs:
         @type language: string
 	@param language: language name, as given by the first element
         of the pair returned by locale.getlocale()
+
+        @type cache_dir: string
+        @param cache_dir: directory for the persistent makes/models/IDs
+        index, or the empty string to disable it
         """
-        self.ppds = ppds.copy ()
+        ppds = ppds.copy ()
         self.makes = None
         self.ids = None
+        self._model_indexes = {}
+        self._ordered_types = {}
+        self._drivertype_names = {}
+        self._ppd_device_ids = {}
+        self._fingerprint = None
+        self._xmlfile_mtime = None
+        self._index = None
+        self._saving_index = False
+
+        self._cache_dir = _get_cache_dir (cache_dir)
 
         self.drivertypes = xmldriverprefs.DriverTypes ()
         self.preforder = xmldriverprefs.PreferenceOrder ()
@@ -360,6 +720,7 @@ class PPDs:
 
         try:
             xmlfile = os.path.join (xml_dir, "preferreddrivers.xml")
+            self._xmlfile_mtime = os.stat (xmlfile).st_mtime
             (drivertypes, preferenceorder) = \
                 xmldriverprefs.PreferredDrivers (xmlfile)
             self.drivertypes.load (drivertypes)
@@ -381,7 +742,7 @@ class PPDs:
             short_language = language
 
         to_remove = []
-        for ppdname, ppddict in self.ppds.items ():
+        for ppdname, ppddict in ppds.items ():
             try:
                 natural_language = _singleton (ppddict['ppd-natural-language'])
             except KeyError:
@@ -401,15 +762,19 @@ class PPDs:
             to_remove.append (ppdname)
 
         for ppdname in to_remove:
-            del self.ppds[ppdname]
+            del ppds[ppdname]
 
         # CUPS sets the 'raw' model's ppd-make-and-model to 'Raw Queue'
         # which unfortunately then appears as manufacturer Raw and
         # model Queue.  Use 'Generic' for this model.
-        if 'raw' in self.ppds:
-            makemodel = _singleton (self.ppds['raw']['ppd-make-and-model'])
+        if 'raw' in ppds:
+            makemodel = _singleton (ppds['raw']['ppd-make-and-model'])
             if not makemodel.startswith ("Generic "):
-                self.ppds['raw']['ppd-make-and-model'] = "Generic " + makemodel
+                raw = ppds['raw'].copy ()
+                raw['ppd-make-and-model'] = "Generic " + makemodel
+                ppds['raw'] = raw
+
+        self.ppds = _PPDTable (ppds)
 
     def getMakes (self):
         """
@@ -455,10 +820,13 @@ class PPDs:
 	"""
         self._init_makes ()
         try:
-            return self.makes[make][model]
+            ppdnames = self.makes[make][model]
         except KeyError:
             return {}
 
+        return dict ([(ppdname, self.ppds[ppdname])
+                      for ppdname in ppdnames.keys ()])
+
     def getInfoFromPPDName (self, ppdname):
         """
 	@returns: a dict representing a PPD, as given by
@@ -500,16 +868,12 @@ class PPDs:
             fit = {}
 
         if self.drivertypes and self.preforder:
-            ppds = {}
-            for ppdname in ppdnamelist:
-                ppds[ppdname] = self.ppds[ppdname]
-
-            orderedtypes = self.preforder.get_ordered_types (self.drivertypes,
-                                                             make_and_model,
-                                                             devid)
+            ppds = _PPDTableView (self.ppds, ppdnamelist)
+            orderedtypes = self._get_ordered_types (make_and_model, devid)
             _debugprint("Valid driver types for this printer in priority order: %s" % repr(orderedtypes))
             orderedppds = self.drivertypes.get_ordered_ppdnames (orderedtypes,
-                                                                 ppds, fit)
+                                                                 ppds, fit,
+                                                                 self._drivertype_names)
             _debugprint("PPDs with assigned driver types in priority order: %s" % repr(orderedppds))
             ppdnamelist = [typ_name[1] for typ_name in orderedppds]
             _debugprint("Resulting PPD list in priority order: %s" % repr(ppdnamelist))
@@ -531,14 +895,213 @@ class PPDs:
 
             # Finally, promote the matching ones to the head of the list.
             if downloadedppdnames:
+                promoted = set (downloadedppdnames)
                 for ppdname in ppdnamelist:
-                    if ppdname not in downloadedppdnames:
+                    if ppdname not in promoted:
+                        promoted.add (ppdname)
                         downloadedppdnames.append (ppdname)
 
                 ppdnamelist = downloadedppdnames
 
         return ppdnamelist
 
+    def getDriverTypeName (self, ppdname, fit=FIT_CLOSE):
+        """
+	Find the preferred driver type for a PPD.  The result is
+	remembered, so asking again for the same PPD and fit is cheap.
+
+	@param ppdname: PPD name
+	@type ppdname: string
+	@param fit: driver fit
+	@type fit: string
+	@returns: driver type name, or "none" if no driver type
+	matches, or None if driver preferences are not available
+	"""
+        if not self.drivertypes:
+            return None
+
+        # Avoid building the PPD's attributes dict if we already know.
+        try:
+            return self._drivertype_names[(ppdname, fit)]
+        except KeyError:
+            pass
+
+        return self.drivertypes.classify (ppdname, self.ppds[ppdname], fit,
+                                          self._drivertype_names)
+
+    def classifyPPDs (self, fits=None):
+        """
+	Find the preferred driver type for every PPD in advance, so
+	that ordering PPD names by preference needs only dictionary
+	lookups.
+
+	@param fits: driver fits to classify for, by default all of them
+	@type fits: string list
+	"""
+        if not self.drivertypes:
+            return
+
+        if fits is None:
+            fits = [self.FIT_EXACT_CMD, self.FIT_EXACT, self.FIT_CLOSE,
+                    self.FIT_GENERIC, self.FIT_NONE]
+
+        tstart = time.time ()
+        cache = self._drivertype_names
+        for ppdname in self.ppds.keys ():
+            ppddict = None
+            for fit in fits:
+                if (ppdname, fit) in cache:
+                    continue
+
+                if ppddict is None:
+                    ppddict = self.ppds[ppdname]
+
+                self.drivertypes.classify (ppdname, ppddict, fit, cache)
+
+        _debugprint ("classifyPPDs: %.3fs" % (time.time () - tstart))
+
+    def _get_ordered_types (self, make_and_model, devid):
+        """
+        Return the driver types for a device in priority order, as
+        given by PreferenceOrder.get_ordered_types, remembering the
+        result for each distinct make-and-model and Device ID.
+        """
+        key = None
+        if devid is not None:
+            try:
+                key = (make_and_model,
+                       tuple (sorted ([(k, tuple (v) if isinstance (v, list)
+                                        else v)
+                                       for k, v in devid.items ()])))
+                hash (key)
+            except TypeError:
+                key = None
+
+        if key is not None and key in self._ordered_types:
+            return list (self._ordered_types[key])
+
+        orderedtypes = self.preforder.get_ordered_types (self.drivertypes,
+                                                         make_and_model,
+                                                         devid)
+        if key is not None:
+            self._ordered_types[key] = list (orderedtypes)
+
+        return orderedtypes
+
+    def _get_ppd_device_id (self, ppdname):
+        """
+        Return the parsed ppd-device-id of a PPD, or None.
+        """
+        try:
+            return self._ppd_device_ids[ppdname]
+        except KeyError:
+            pass
+
+        ppd_device_id = _singleton (self.ppds.get_attribute (ppdname,
+                                                             'ppd-device-id'))
+        if ppd_device_id:
+            ppd_device_id_dict = parseDeviceID (ppd_device_id)
+        else:
+            ppd_device_id_dict = None
+
+        self._ppd_device_ids[ppdname] = ppd_device_id_dict
+        return ppd_device_id_dict
+
+    def getPPDNamesFromDeviceIDs (self, devices, downloadedfiles=None,
+                                  processes=None):
+        """
+	Obtain best-effort PPD matches for many IEEE 1284 Device IDs
+	at once.  This gives the same results as calling
+	getPPDNamesFromDeviceID and orderPPDNamesByPreference for
+	each device, but shares the work between devices.
+
+	@param devices: one (MFG, MDL, DES, CMD, URI,
+	device-make-and-model) tuple per device, with fields as for
+	getPPDNamesFromDeviceID
+	@type devices: list
+        @param downloadedfiles: filenames from downloaded packages
+        @type downloadedfiles: string list
+        @param processes: number of worker processes to spread the
+        matching over, or None to match in this process
+        @type processes: int
+	@returns: a list of (fit, ppdnamelist) pairs, one per device,
+	where fit is a dict of fit (string) indexed by PPD name and
+	ppdnamelist is the list of PPD names in order of preference
+	"""
+        if downloadedfiles is None:
+            downloadedfiles = []
+
+        devices = [tuple (device) for device in devices]
+
+        # Build the shared indexes before any worker processes are
+        # forked, so that they inherit them.
+        self._init_ids ()
+        self._init_makes ()
+
+        if processes is not None and processes > 1 and len (devices) > 1:
+            try:
+                return self._match_devices_in_pool (devices,
+                                                    downloadedfiles,
+                                                    processes)
+            except (OSError, ValueError) as e:
+                _debugprint ("Matching in this process instead: %s" % e)
+
+        return self._match_devices (devices, downloadedfiles)
+
+    def _match_devices (self, devices, downloadedfiles):
+        results = {}
+        ret = []
+        for device in devices:
+            (mfg, mdl, description, commandsets, uri, make_and_model) = device
+            if commandsets is None:
+                commandsets = []
+
+            # Identical devices (e.g. the same model on several
+            # queues) are only matched once.
+            if isinstance (commandsets, list):
+                key = (mfg, mdl, description, tuple (commandsets), uri,
+                       make_and_model)
+            else:
+                key = device
+
+            result = results.get (key)
+            if result is None:
+                fit = self.getPPDNamesFromDeviceID (mfg, mdl, description,
+                                                    commandsets, uri,
+                                                    make_and_model)
+                devid = { "MFG": mfg, "MDL": mdl,
+                          "DES": description,
+                          "CMD": commandsets }
+                ppdnamelist = self.orderPPDNamesByPreference (list(fit.keys ()),
+                                                              downloadedfiles,
+                                                              make_and_model,
+                                                              devid, fit)
+                result = (fit, ppdnamelist)
+                results[key] = result
+
+            ret.append ((dict (result[0]), list (result[1])))
+
+        return ret
+
+    def _match_devices_in_pool (self, devices, downloadedfiles, processes):
+        global _pool_ppds
+        import multiprocessing
+
+        # The worker processes are forked so that they share this
+        # object rather than having to pickle it.
+        context = multiprocessing.get_context ("fork")
+        chunksize = (len (devices) + processes - 1) // processes
+        chunks = [(devices[i:i + chunksize], downloadedfiles)
+                  for i in range (0, len (devices), chunksize)]
+        _pool_ppds = self
+        try:
+            with context.Pool (min (processes, len (chunks))) as pool:
+                results = pool.map (_pool_match_devices, chunks)
+        finally:
+            _pool_ppds = None
+
+        return list (itertools.chain.from_iterable (results))
+
     def getPPDNamesFromDeviceID (self, mfg, mdl, description="",
                                  commandsets=None, uri=None,
                                  make_and_model=None):
@@ -717,10 +1280,8 @@ class PPDs:
             exact_cmd = set()
             for ppdname in fit.keys ():
                 ppd_cmd_field = None
-                ppd = self.ppds[ppdname]
-                ppd_device_id = _singleton (ppd.get ('ppd-device-id'))
-                if ppd_device_id:
-                    ppd_device_id_dict = parseDeviceID (ppd_device_id)
+                ppd_device_id_dict = self._get_ppd_device_id (ppdname)
+                if ppd_device_id_dict:
                     ppd_cmd_field = ppd_device_id_dict["CMD"]
 
                 if (not ppd_cmd_field and
@@ -731,7 +1292,8 @@ class PPDs:
                     ppdname.find (":") == -1):
                     # If this is a PostScript PPD we know which
                     # command set it will use.
-                    ppd_type = _singleton (ppd.get ('ppd-type'))
+                    ppd_type = _singleton (self.ppds.get_attribute (ppdname,
+                                                                    'ppd-type'))
                     if ppd_type == "postscript":
                         ppd_cmd_field = ["POSTSCRIPT"]
 
@@ -788,7 +1350,7 @@ class PPDs:
 
             if not found:
                 _debugprint ("No fallback available; choosing any")
-                fit[list(self.ppds.keys ())[0]] = self.FIT_NONE
+                fit[self.ppds.get_name (0)] = self.FIT_NONE
 
         if not id_matched:
             sanitised_uri = re.sub (pattern="//[^@]*@/?", repl="//",
@@ -887,16 +1449,9 @@ class PPDs:
             mdl = mdl[:-7]
         best_mdl = None
         best_matchlen = 0
-        mdlnames = list(mdls.keys ())
-
-        # Perform a case-insensitive model sort on the names.
-        mdlnamesl = [(x, x.lower()) for x in mdlnames]
-        mdlnamesl.append ((mdl, mdll))
-        mdlnamesl.sort (key=functools.cmp_to_key(lambda x, y: cups.modelSort(x[1], y[1])))
-        i = mdlnamesl.index ((mdl, mdll))
-        candidates = [mdlnamesl[i - 1]]
-        if i + 1 < len (mdlnamesl):
-            candidates.append (mdlnamesl[i + 1])
+        index = self._get_model_index (mdls)
+        candidates = index.neighbours (mdl, mdll)
+        if len (candidates) > 1:
             _debugprint (candidates[0][0] + " <= " + mdl + " <= " +
                         candidates[1][0])
         else:
@@ -926,8 +1481,6 @@ class PPDs:
             # field and look for a match based solely on that.  If
             # there are digits, try lowering the number of
             # significant figures.
-            mdlnames.sort (key=functools.cmp_to_key(cups.modelSort))
-            mdlitems = [(x.lower (), mdls[x]) for x in mdlnames]
             modelid = None
             for word in mdll.split (' '):
                 if modelid is None:
@@ -971,15 +1524,10 @@ class PPDs:
                     _debugprint ("Ignoring %d of %d digits, trying %s" %
                                  (ignore_digits, digits, modelid))
 
-                    for (name, ppds) in mdlitems:
-                        for word in name.split (' '):
-                            if word.lower () == modelid:
-                                found = True
-                                break
-
-                        if found:
-                            best_mdl = list(ppds.keys ())
-                            break
+                    name = index.find_word (modelid)
+                    if name is not None:
+                        found = True
+                        best_mdl = list(mdls[name].keys ())
 
                     if found:
                         break
@@ -994,6 +1542,18 @@ class PPDs:
 
         return (fit, ppdnamelist)
 
+    def _get_model_index (self, mdls):
+        """
+        Return the _ModelIndex for a dict of models, building it the
+        first time it is needed.
+        """
+        index = self._model_indexes.get (id (mdls))
+        if index is None or index.mdls is not mdls:
+            index = _ModelIndex (mdls)
+            self._model_indexes[id (mdls)] = index
+
+        return index
+
     def _getPPDNameFromCommandSet (self, commandsets=None):
         """Return ppd-name list or None, given a list of strings representing
         the command sets supported."""
@@ -1034,18 +1594,155 @@ class PPDs:
             return get ("ESC/P Dot Matrix")
         return None
 
+    def _get_fingerprint (self):
+        """
+        Return a digest identifying the (language-filtered) PPD list
+        and the preferreddrivers.xml file it was loaded alongside.
+        """
+        if self._fingerprint is not None:
+            return self._fingerprint
+
+        h = hashlib.sha1 ()
+        h.update (repr ((_INDEX_VERSION, self._xmlfile_mtime,
+                         len (self.ppds))).encode ())
+        self.ppds.digest (h)
+        self._fingerprint = h.hexdigest ()
+        return self._fingerprint
+
+    def _index_path (self):
+        if not self._cache_dir:
+            return None
+
+        return os.path.join (self._cache_dir, _INDEX_FILENAME)
+
+    def _read_index (self):
+        """
+        Return the stored index dict if it is valid for this PPD list,
+        otherwise an empty dict.  The file is only read once.
+        """
+        if self._index is not None:
+            return self._index
+
+        self._index = {}
+        path = self._index_path ()
+        if path is None:
+            return self._index
+
+        try:
+            with open (path, "rb") as f:
+                index = pickle.load (f)
+        except (OSError, EOFError, pickle.UnpicklingError,
+                AttributeError, ImportError, IndexError) as e:
+            _debugprint ("PPDs index not loaded: %s" % e)
+            return self._index
+
+        if (not isinstance (index, dict) or
+            index.get ('version') != _INDEX_VERSION or
+            index.get ('fingerprint') != self._get_fingerprint ()):
+            _debugprint ("PPDs index is stale")
+            return self._index
+
+        self._index = index
+        return index
+
+    def _load_index (self, what):
+        """
+        Load the 'makes' or 'ids' tables from the on-disk index.
+
+        @returns: True if the tables were loaded
+        """
+        tstart = time.time ()
+        index = self._read_index ()
+        if what not in index:
+            return False
+
+        if what == 'makes':
+            ppds = self.ppds
+            makes = {}
+            for make, models in index['makes'].items ():
+                makes[make] = {}
+                for model, ppdnames in models.items ():
+                    rows = [ppds.get_row (ppdname) for ppdname in ppdnames]
+                    makes[make][model] = dict ([(ppds.get_name (row), row)
+                                                for row in rows])
+
+            self.lmakes = index['lmakes']
+            self.lmodels = index['lmodels']
+            self.makes = makes
+            self._model_indexes = {}
+        else:
+            # Share the PPD name strings with self.ppds.
+            ppds = self.ppds
+            ids = index['ids']
+            for mdls in ids.values ():
+                for lmdl, ppdnames in mdls.items ():
+                    mdls[lmdl] = [ppds.get_name (ppds.get_row (ppdname))
+                                  for ppdname in ppdnames]
+
+            self.ids = ids
+
+        # Each table is only loaded once, so drop it from the index.
+        del index[what]
+        _debugprint ("PPDs index: loaded %s in %.3fs" %
+                     (what, time.time () - tstart))
+        return True
+
+    def _save_index (self):
+        """
+        Write the makes/models and IDs tables to the on-disk index,
+        after building whichever of them is still missing so that the
+        file is only written once.  Errors are not fatal: the index
+        is only a cache.
+        """
+        path = self._index_path ()
+        if path is None or self._saving_index:
+            return
+
+        self._saving_index = True
+        try:
+            self._init_makes ()
+            self._init_ids ()
+        finally:
+            self._saving_index = False
+
+        # Nothing else will be loaded from the old index.
+        self._index = {}
+        index = { 'version': _INDEX_VERSION,
+                  'fingerprint': self._get_fingerprint () }
+
+        if self.makes:
+            makes = {}
+            for make, models in self.makes.items ():
+                makes[make] = {}
+                for model, ppds in models.items ():
+                    makes[make][model] = list (ppds.keys ())
+
+            index['makes'] = makes
+            index['lmakes'] = self.lmakes
+            index['lmodels'] = self.lmodels
+
+        if self.ids:
+            index['ids'] = self.ids
+
+        _write_cache_file (self._cache_dir, _INDEX_FILENAME, index)
+
     def _init_makes (self):
         if self.makes:
             return
 
+        if self._load_index ('makes'):
+            return
+
         tstart = time.time ()
         makes = {}
         lmakes = {}
         lmodels = {}
         aliases = {} # Generic model name: set(specific model names)
-        for ppdname, ppddict in self.ppds.items ():
+        get_attribute = self.ppds.get_attribute
+        for row, ppdname in enumerate (self.ppds):
             # One entry for ppd-make-and-model
-            ppd_make_and_model = _singleton (ppddict['ppd-make-and-model'])
+            ppd_make_and_model = _singleton (get_attribute (ppdname,
+                                                            'ppd-make-and-model'))
             ppd_mm_split = ppdMakeModelSplit (ppd_make_and_model)
             ppd_makes_and_models = set([ppd_mm_split])
 
@@ -1057,7 +1754,7 @@ class PPDs:
 
             # Add another entry for each ppd-product that came from a
             # Product attribute in the PPD file.
-            ppd_products = ppddict.get ('ppd-product', [])
+            ppd_products = get_attribute (ppdname, 'ppd-product', [])
             if not isinstance (ppd_products, list):
                 ppd_products = [ppd_products]
             ppd_products = set ([x for x in ppd_products if x.startswith ("(")])
@@ -1067,7 +1764,8 @@ class PPDs:
                 if len (ppd_products) == 1:
                     ppd_products = set()
 
-                make = _singleton (ppddict.get ('ppd-make', '')).rstrip ()
+                make = _singleton (get_attribute (ppdname,
+                                                  'ppd-make', '')).rstrip ()
                 if make:
                     make += ' '
                 lmake = normalize (make)
@@ -1104,7 +1802,7 @@ class PPDs:
                 else:
                     model = lmodels[lmake][lmodel]
 
-                makes[make][model][ppdname] = ppddict
+                makes[make][model][ppdname] = row
 
             # Build list of model aliases
             if ppd_mm_split in ppd_makes_and_models:
@@ -1141,15 +1839,21 @@ class PPDs:
         self.makes = makes
         self.lmakes = lmakes
         self.lmodels = lmodels
+        self._model_indexes = {}
         _debugprint ("init_makes: %.3fs" % (time.time () - tstart))
+        self._save_index ()
 
     def _init_ids (self):
         if self.ids:
             return
 
+        if self._load_index ('ids'):
+            return
+
         ids = {}
-        for ppdname, ppddict in self.ppds.items ():
-            id = _singleton (ppddict.get ('ppd-device-id'))
+        for ppdname in self.ppds:
+            id = _singleton (self.ppds.get_attribute (ppdname,
+                                                      'ppd-device-id'))
             if not id:
                 continue
 
@@ -1174,6 +1878,15 @@ class PPDs:
             ids[lmfg][lmdl].append (ppdname)
 
         self.ids = ids
+        self._save_index ()
+
+# The PPDs object being shared with forked worker processes by
+# PPDs.getPPDNamesFromDeviceIDs.
+_pool_ppds = None
+
+def _pool_match_devices (args):
+    (devices, downloadedfiles) = args
+    return _pool_ppds._match_devices (devices, downloadedfiles)
 
 def _show_help():
     print ("usage: ppds.py [--deviceid] [--list-models] [--list-ids] [--debug]")
@@ -150,7 +150,7 @@ class DriverType:
     def __repr__ (self):
         return "<DriverType %s instance at 0x%x>" % (self.name, id (self))
 
-    def match (self, ppd_name, attributes, fit):
+    def match (self, ppd_name, attributes, fit, deviceids=None):
         """
         Return True if there is a match for all specified criteria.
 
@@ -159,6 +159,9 @@ class DriverType:
         attributes: dict
 
         fit: string
+
+        deviceids: optional list of parsed ppd-device-id values, to
+        save parsing them again
         """
 
         matches = self._fit.get (fit, False)
@@ -192,14 +195,11 @@ class DriverType:
             elif self.deviceid:
                 # This is a match if any of the ppd-device-id values
                 # match.
-                deviceidlist = attributes["ppd-device-id"]
-                if not isinstance (deviceidlist, list):
-                    # In case getPPDs() was used instead of getPPDs2()
-                    deviceidlist = [deviceidlist]
+                if deviceids is None:
+                    deviceids = parse_ppd_device_ids (attributes)
 
                 any_id_matches = False
-                for deviceidstr in deviceidlist:
-                    deviceid = parseDeviceID (deviceidstr)
+                for deviceid in deviceids:
                     for match in self.deviceid:
                         if match.match (deviceid):
                             any_id_matches = True
@@ -213,6 +213,19 @@ class DriverType:
     def get_packagehint (self):
         return None
 
+def parse_ppd_device_ids (attributes):
+    """
+    Return the list of parsed ppd-device-id values from a dict of
+    PPD attributes.
+    """
+
+    deviceidlist = attributes.get ("ppd-device-id", [])
+    if not isinstance (deviceidlist, list):
+        # In case getPPDs() was used instead of getPPDs2()
+        deviceidlist = [deviceidlist]
+
+    return [parseDeviceID (deviceidstr) for deviceidstr in deviceidlist]
+
 class DriverTypes:
     """
     A list of driver types.
@@ -220,6 +233,7 @@ class DriverTypes:
 
     def __init__ (self):
         self.drivertypes = []
+        self._have_deviceid_matches = False
 
     def load (self, drivertypes):
         """
@@ -250,6 +264,7 @@ class DriverTypes:
             types.append (t)
 
         self.drivertypes = types
+        self._have_deviceid_matches = any ([t.deviceid for t in types])
 
     def match (self, ppdname, ppddict, fit):
         """
@@ -257,12 +272,43 @@ class DriverTypes:
         attributes, and fitness, or None if there is no match.
         """
 
+        # Parse the PPD's Device IDs once for all driver types.
+        deviceids = None
+        if self._have_deviceid_matches and "ppd-device-id" in ppddict:
+            deviceids = parse_ppd_device_ids (ppddict)
+
         for drivertype in self.drivertypes:
-            if drivertype.match (ppdname, ppddict, fit):
+            if drivertype.match (ppdname, ppddict, fit, deviceids):
                 return drivertype
 
         return None
 
+    def classify (self, ppdname, ppddict, fit, cache=None):
+        """
+        Return the name of the first matching drivertype for a PPD,
+        or "none" if there is no match.
+
+        If cache is a dict it is used to remember the result for
+        each PPD name and fitness.
+        """
+
+        if cache is not None:
+            try:
+                return cache[(ppdname, fit)]
+            except KeyError:
+                pass
+
+        drivertype = self.match (ppdname, ppddict, fit)
+        if drivertype:
+            name = drivertype.get_name ()
+        else:
+            name = "none"
+
+        if cache is not None:
+            cache[(ppdname, fit)] = name
+
+        return name
+
     def filter (self, pattern):
         """
         Return the subset of driver type names that match a glob
@@ -272,7 +318,7 @@ class DriverTypes:
         return fnmatch.filter ([x.get_name () for x in self.drivertypes],
                                pattern)
 
-    def get_ordered_ppdnames (self, drivertypes, ppdsdict, fit):
+    def get_ordered_ppdnames (self, drivertypes, ppdsdict, fit, cache=None):
         """
         Given a list of driver type names, a dict of PPD attributes by
         PPD name, and a dict of driver fitness status codes by PPD
@@ -284,31 +330,38 @@ class DriverTypes:
         as the driver types given, with the exception that any
         blacklisted driver types will be omitted from the returned
         result.
+
+        If cache is a dict it is passed to classify() so that each
+        PPD is only matched against the driver types once.  The PPD
+        attributes are then only looked up for PPDs not in the cache,
+        so ppdsdict may be any mapping that builds them on demand.
         """
 
         ppdnames = []
+        seen = set ()
 
         # First find out what driver types we have
         ppdtypes = {}
         fit_default = DriverType.FIT_CLOSE
-        for ppd_name, ppd_dict in ppdsdict.items ():
-            drivertype = self.match (ppd_name, ppd_dict, fit.get (ppd_name,
-                                                                  fit_default))
-            if drivertype:
-                name = drivertype.get_name ()
-            else:
-                name = "none"
+        for ppd_name in ppdsdict:
+            ppd_fit = fit.get (ppd_name, fit_default)
+            name = None
+            if cache is not None:
+                name = cache.get ((ppd_name, ppd_fit))
+
+            if name is None:
+                name = self.classify (ppd_name, ppdsdict[ppd_name], ppd_fit,
+                                      cache)
 
-            m = ppdtypes.get (name, [])
-            m.append (ppd_name)
-            ppdtypes[name] = m
+            ppdtypes.setdefault (name, []).append (ppd_name)
 
         # Now construct the list.
         for drivertypename in drivertypes:
             for ppd_name in ppdtypes.get (drivertypename, []):
-                if ppd_name in ppdnames:
+                if ppd_name in seen:
                     continue
 
+                seen.add (ppd_name)
                 ppdnames.append ((drivertypename, ppd_name))
 
         return ppdnames
@@ -19,30 +19,82 @@
 ## Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 import dbus, re
+import time
 import urllib.parse
+from gi.repository import GLib
 from debug import *
 
+# Give up waiting for Avahi after this many seconds, and pass on what
+# has been resolved so far.
+DNSSD_RESOLVE_TIMEOUT = 10
+
+# How long, in seconds, to remember where a service is.
+DNSSD_CACHE_TTL = 120
+
+_avahi_server = None
+
+# Resolved services, indexed by (name, type, domain).  Values are
+# (address, hostname, expiry time) tuples.
+_resolved_services = {}
+
+def _get_avahi_server (bus):
+    global _avahi_server
+    if _avahi_server is None:
+        obj = bus.get_object ("org.freedesktop.Avahi", "/")
+        _avahi_server = dbus.Interface (obj,
+                                        "org.freedesktop.Avahi.Server")
+
+    return _avahi_server
+
+def _forget_avahi_server ():
+    # Avahi may have restarted; get a new proxy next time.
+    global _avahi_server
+    _avahi_server = None
+
+def forget_resolved_services ():
+    """
+    Discard all remembered service addresses.
+    """
+    _resolved_services.clear ()
+
 class DNSSDHostNamesResolver:
     def __init__ (self, devices):
         self._devices = devices
         self._unresolved = len (devices)
         self._device_uri_by_name = {}
+        self._done = False
+        self._timer = None
         debugprint ("+%s" % self)
 
     def __del__ (self):
         debugprint ("-%s" % self)
 
-    def resolve (self, reply_handler):
-
+    def resolve (self, reply_handler, resolved_handler=None,
+                 timeout=DNSSD_RESOLVE_TIMEOUT):
+        """
+        Find the address and host name of each dnssd device.
+
+        @param reply_handler: function called with the devices
+        dict once all of them are resolved or the timeout is reached
+        @type reply_handler: function
+        @param resolved_handler: function called with the URI and
+        device as each one is resolved
+        @type resolved_handler: function
+        @param timeout: seconds to wait for Avahi, or None to wait
+        for every reply
+        @type timeout: number
+        """
         self._reply_handler = reply_handler
+        self._resolved_handler = resolved_handler
 
         bus = dbus.SystemBus ()
         if not bus:
-            reply_handler ([])
-            del self._devices
-            del self._reply_handler
+            # Nothing can be resolved.
+            self._finish ()
             return
 
+        pending = []
+        now = time.monotonic ()
         for uri, device in self._devices.items ():
             if not uri.startswith ("dnssd://"):
                 self._unresolved -= 1
@@ -54,51 +106,113 @@ class DNSSDHostNamesResolver:
             hostname = result.netloc
             elements = hostname.rsplit (".", 3)
             if len (elements) != 4:
-                self._resolved ()
+                self._unresolved -= 1
                 continue
 
             name, stype, protocol, domain = elements
             name = urllib.parse.unquote (name)
             stype += "." + protocol #  e.g. _printer._tcp
+            key = (name, stype, domain)
+            cached = _resolved_services.get (key)
+            if cached is not None and cached[2] > now:
+                (address, host, expires) = cached
+                debugprint ("%s is at %s (%s) (cached)" % (uri, address, host))
+                self._apply (uri, address, host)
+                self._unresolved -= 1
+                continue
+
+            self._device_uri_by_name[key] = uri
+            pending.append ((uri, hostname, key))
+
+        if self._unresolved == 0:
+            self._finish ()
+            return
+
+        if timeout is not None:
+            self._timer = GLib.timeout_add_seconds (timeout, self._timed_out)
+
+        kwds = {}
+        if timeout is not None:
+            kwds['timeout'] = timeout
+
+        for uri, hostname, (name, stype, domain) in pending:
+            if self._done:
+                break
 
             try:
-                obj = bus.get_object ("org.freedesktop.Avahi", "/")
-                server = dbus.Interface (obj,
-                                         "org.freedesktop.Avahi.Server")
-                self._device_uri_by_name[(name, stype, domain)] = uri
+                server = _get_avahi_server (bus)
                 debugprint ("Resolving address for %s" % hostname)
                 server.ResolveService (-1, -1,
                                         name, stype, domain,
                                         -1, 0,
                                         reply_handler=self._reply,
-                                        error_handler=lambda e:
-                                            self._error (uri, e))
+                                        error_handler=lambda e, uri=uri:
+                                            self._error (uri, e),
+                                        **kwds)
             except dbus.DBusException as e:
                 debugprint ("Failed to resolve address: %s" % repr (e))
+                _forget_avahi_server ()
                 self._resolved ()
 
+    def _apply (self, uri, address, hostname):
+        device = self._devices[uri]
+        device.address = address
+        device.hostname = hostname
+        if self._resolved_handler:
+            self._resolved_handler (uri, device)
+
     def _resolved (self):
         self._unresolved -= 1
         if self._unresolved == 0:
             debugprint ("All addresses resolved")
-            self._reply_handler (self._devices)
-            del self._devices
-            del self._reply_handler
+            self._finish ()
+
+    def _finish (self):
+        if self._done:
+            return
+
+        self._done = True
+        if self._timer is not None:
+            GLib.source_remove (self._timer)
+            self._timer = None
+
+        devices = self._devices
+        reply_handler = self._reply_handler
+        self._devices = None
+        self._reply_handler = None
+        self._resolved_handler = None
+        reply_handler (devices)
+
+    def _timed_out (self):
+        self._timer = None
+        debugprint ("Timed out resolving addresses (%d left)" %
+                    self._unresolved)
+        self._finish ()
+        return False
 
     def _reply (self, interface, protocol, name, stype, domain,
                 host, aprotocol, address, port, txt, flags):
-        uri = self._device_uri_by_name[(name, stype, domain)]
-        self._devices[uri].address = address
         hostname = host
         p = hostname.find(".")
         if p != -1:
             hostname = hostname[:p]
+
+        key = (name, stype, domain)
+        _resolved_services[key] = (address, hostname,
+                                   time.monotonic () + DNSSD_CACHE_TTL)
+        if self._done:
+            return
+
+        uri = self._device_uri_by_name[key]
         debugprint ("%s is at %s (%s)" % (uri, address, hostname))
-        self._devices[uri].hostname = hostname
+        self._apply (uri, address, hostname)
         self._resolved ()
 
     def _error (self, uri, error):
         debugprint ("Error resolving %s: %s" % (uri, repr (error)))
+        if self._done:
+            return
+
         self._resolved ()
 
 if __name__ == '__main__':
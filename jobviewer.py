@@ -617,10 +617,9 @@ class JobViewer (GtkGUI):
                                         specific_dests=specific_dests,
                                         host=self.host, port=self.port,
                                         encryption=self.encryption)
+        self.monitor.set_coalescing ()
         self.monitor.connect ('refresh', self.on_refresh)
-        self.monitor.connect ('job-added', self.job_added)
-        self.monitor.connect ('job-event', self.job_event)
-        self.monitor.connect ('job-removed', self.job_removed)
+        self.monitor.connect ('jobs-changed', self.jobs_changed)
         self.monitor.connect ('state-reason-added', self.state_reason_added)
         self.monitor.connect ('state-reason-removed', self.state_reason_removed)
         self.monitor.connect ('still-connecting', self.still_connecting)
@@ -1874,7 +1873,8 @@ class JobViewer (GtkGUI):
         else:
             urgency = Notify.Urgency.LOW
 
-        (title, text) = reason.get_description ()
+        (title, text) = reason.get_description (
+            self.on_state_reason_localized)
         notification = Notify.Notification.new (title, text, 'printer')
         reason.user_notified = True
         notification.set_urgency (urgency)
@@ -1889,6 +1889,22 @@ class JobViewer (GtkGUI):
         except GObject.GError:
             nonfatalException ()
 
+    def on_state_reason_localized (self, reason):
+        # The printer's PPD has a better description for this reason.
+        self.update_status ()
+        self.treeview.queue_draw ()
+
+        notification = self.state_reason_notifications.get (reason.get_tuple ())
+        if notification is None or getattr (notification, 'closed', False):
+            return
+
+        (title, text) = reason.get_description ()
+        notification.update (title, text, 'printer')
+        try:
+            notification.show ()
+        except GObject.GError:
+            nonfatalException ()
+
     def on_state_reason_notification_closed (self, notification, reason=None):
         debugprint ("Notification %s closed" % repr (notification))
         notification.closed = True
@@ -1958,6 +1974,15 @@ class JobViewer (GtkGUI):
         self.jobiters = {}
         self.printer_uri_index = PrinterURIIndex ()
 
+    def jobs_changed (self, mon, changes):
+        for (signal, jobid, eventname, event, jobdata) in changes:
+            if signal == 'job-added':
+                self.job_added (mon, jobid, eventname, event, jobdata)
+            elif signal == 'job-event':
+                self.job_event (mon, jobid, eventname, event, jobdata)
+            else:
+                self.job_removed (mon, jobid, eventname, event)
+
     def job_added (self, mon, jobid, eventname, event, jobdata):
         uri = jobdata.get ('job-printer-uri', '')
         try:
@@ -2182,7 +2207,7 @@ class JobViewer (GtkGUI):
         self.update_status ()
 
     def state_reason_added (self, mon, reason):
-        (title, text) = reason.get_description ()
+        (title, text) = reason.get_description (self.on_state_reason_localized)
         printer = reason.get_printer ()
 
         try:
@@ -36,6 +36,17 @@ from statereason import StateReason
 CONNECTING_TIMEOUT = 60 # seconds
 MIN_REFRESH_INTERVAL = 1 # seconds
 
+# Jobs are fetched in batches, starting small so that the first ones
+# appear quickly and growing geometrically up to a maximum.
+FETCH_JOBS_FIRST_BATCH = 5
+FETCH_JOBS_MAX_BATCH = 500
+
+# Don't reuse a pooled CUPS connection that has been idle this long.
+MAX_CONNECTION_IDLE = 300 # seconds
+
+# Default time window for collecting job changes in coalescing mode.
+COALESCE_WINDOW = 250 # milliseconds
+
 def state_reason_is_harmless (reason):
     if (reason.startswith ("moving-to-paused") or
         reason.startswith ("paused") or
@@ -97,7 +108,11 @@ class Monitor(GObject.GObject):
         'cups-connection-error': (GObject.SignalFlags.RUN_LAST, None, ()),
         'cups-connection-recovered': (GObject.SignalFlags.RUN_LAST, None, ()),
         'cups-ipp-error':        (GObject.SignalFlags.RUN_LAST, None,
-                                  (int, str,))
+                                  (int, str,)),
+        'fetch-jobs-progress':   (GObject.SignalFlags.RUN_LAST, None,
+                                  (int, bool,)),
+        'jobs-changed':          (GObject.SignalFlags.RUN_LAST, None,
+                                  (GObject.TYPE_PYOBJECT,))
         }
 
     # Monitor jobs and printers.
@@ -117,6 +132,11 @@ class Monitor(GObject.GObject):
         self.process_pending_events = True
         self.fetch_jobs_timer = None
         self.cups_connection_in_error = False
+        self.connection = None
+        self.connection_used = 0
+        self.coalesce_window = None
+        self.job_changes = {}
+        self.job_changes_timer = None
 
         if host:
             cups.setServer (host)
@@ -163,15 +183,155 @@ class Monitor(GObject.GObject):
     def get_ppdcache (self):
         return self.ppdcache
 
+    def get_connection (self):
+        """
+        Return the pooled CUPS connection, connecting if there is
+        none or if it has been idle too long.
+
+        @raise RuntimeError: cannot connect to CUPS
+        """
+        now = time.time ()
+        if (self.connection is not None and
+            now - self.connection_used > MAX_CONNECTION_IDLE):
+            debugprint ("Pooled CUPS connection idle, reconnecting")
+            self.connection = None
+
+        if self.connection is None:
+            self.connection = cups.Connection (host=self.host,
+                                               port=self.port,
+                                               encryption=self.encryption)
+
+        self.connection_used = now
+        return self.connection
+
+    def cups_call (self, method, *args, **kwds):
+        """
+        Call a cups.Connection method using the pooled connection.
+        If a previously-used connection has failed, reconnect and try
+        once more.
+
+        @raise RuntimeError: cannot connect to CUPS
+        """
+        while True:
+            fresh = self.connection is None
+            c = self.get_connection ()
+            try:
+                return getattr (c, method) (*args, **kwds)
+            except RuntimeError:
+                self.connection = None
+                if fresh:
+                    raise
+
+                debugprint ("Pooled CUPS connection failed, reconnecting")
+
+    def set_coalescing (self, window=COALESCE_WINDOW):
+        """
+        Collect job changes for up to window milliseconds, keeping
+        only the latest change for each job, and emit them together
+        as a single 'jobs-changed' signal instead of 'job-added',
+        'job-event' and 'job-removed' signals.  New jobs announced by
+        notifications have their attributes fetched together.
+
+        The signal argument is a list of (signal-name, jobid,
+        eventname, event, jobdata) tuples, where signal-name is the
+        signal that would otherwise have been emitted and jobdata is
+        None for 'job-removed'.  There is one tuple per job, except
+        that a job added and then removed within the window is
+        reported as 'job-added' followed by 'job-removed', so that
+        the listener still learns its attributes.
+
+        @param window: time window in milliseconds, or None to emit
+        one signal per event
+        """
+        self.flush_job_changes ()
+        self.coalesce_window = window
+
+    def emit_job_change (self, signal, jobid, eventname, event, jobdata=None):
+        if self.coalesce_window is None:
+            if signal == 'job-removed':
+                self.emit (signal, jobid, eventname, event)
+            else:
+                self.emit (signal, jobid, eventname, event, jobdata)
+            return
+
+        change = (signal, jobid, eventname, event, jobdata)
+        previous = self.job_changes.get (jobid)
+        if previous is not None and previous[-1][0] == 'job-added':
+            if signal == 'job-event':
+                # A job added and then changed in the same window is
+                # still new as far as the listener is concerned.
+                change = ('job-added', jobid, eventname, event, jobdata)
+            elif signal == 'job-removed':
+                # Keep the addition, with the job's attributes.
+                self.job_changes[jobid] = [previous[-1], change]
+                change = None
+
+        if change is not None:
+            self.job_changes[jobid] = [change]
+
+        if self.job_changes_timer is None:
+            self.job_changes_timer = GLib.timeout_add (self.coalesce_window,
+                                                       self.flush_job_changes)
+
+    def flush_job_changes (self):
+        if self.job_changes_timer is not None:
+            GLib.source_remove (self.job_changes_timer)
+            self.job_changes_timer = None
+
+        if self.job_changes:
+            changes = [change
+                       for job_changes in self.job_changes.values ()
+                       for change in job_changes]
+            self.job_changes = {}
+            debugprint ("Emitting %d coalesced job changes" % len (changes))
+            self.emit ('jobs-changed', changes)
+
+        return False
+
+    def fetch_job_attributes (self, jobids):
+        """
+        Fetch the attributes of several jobs, using one Get-Jobs
+        request for each run of consecutive job IDs so that no other
+        jobs are fetched.
+
+        @returns: dict of attribute dicts indexed by job ID, omitting
+        any jobs that were not found
+        """
+        runs = []
+        for jobid in sorted (jobids):
+            if runs and jobid == runs[-1][-1] + 1:
+                runs[-1].append (jobid)
+            else:
+                runs.append ([jobid])
+
+        result = {}
+        for run in runs:
+            try:
+                if len (run) == 1:
+                    fetched = { run[0]: self.cups_call ('getJobAttributes',
+                                                        run[0]) }
+                else:
+                    fetched = self.cups_call ('getJobs',
+                                              which_jobs='all',
+                                              first_job_id=run[0],
+                                              limit=len (run),
+                                              requested_attributes=['all'])
+            except (cups.IPPError, RuntimeError) as e:
+                debugprint ("Failed to fetch job attributes: %s" % repr (e))
+                continue
+
+            for jobid in run:
+                if jobid in fetched:
+                    result[jobid] = fetched[jobid]
+
+        return result
+
     def cleanup (self):
         if self.sub_id != -1:
             user = cups.getUser ()
             try:
                 cups.setUser (self.user)
-                c = cups.Connection (host=self.host,
-                                     port=self.port,
-                                     encryption=self.encryption)
-                c.cancelSubscription (self.sub_id)
+                self.cups_call ('cancelSubscription', self.sub_id)
                 debugprint ("Canceled subscription %d" % self.sub_id)
             except:
                 pass
@@ -189,6 +349,8 @@ class Monitor(GObject.GObject):
         for timer in timers:
             GLib.source_remove (timer)
 
+        self.flush_job_changes ()
+        self.connection = None
         self.emit ('monitor-exited')
 
     def set_process_pending (self, whether):
@@ -342,16 +504,14 @@ class Monitor(GObject.GObject):
         user = cups.getUser ()
         try:
             cups.setUser (self.user)
-            c = cups.Connection (host=self.host,
-                                 port=self.port,
-                                 encryption=self.encryption)
-
             try:
                 try:
-                    notifications = c.getNotifications ([self.sub_id],
-                                                        [self.sub_seq + 1])
+                    notifications = self.cups_call ('getNotifications',
+                                                    [self.sub_id],
+                                                    [self.sub_seq + 1])
                 except AttributeError:
-                    notifications = c.getNotifications ([self.sub_id])
+                    notifications = self.cups_call ('getNotifications',
+                                                    [self.sub_id])
             except cups.IPPError as e:
                 (e, m) = e.args
                 cups.setUser (user)
@@ -382,6 +542,21 @@ class Monitor(GObject.GObject):
 
         cups.setUser (user)
         jobs = self.jobs.copy ()
+
+        prefetched = {}
+        if self.coalesce_window is not None:
+            # Fetch the attributes of all the new jobs at once.
+            new_jobids = set()
+            for event in notifications['events']:
+                nse = event['notify-subscribed-event']
+                if (nse == 'job-created' or
+                    (nse == 'job-state-changed' and
+                     event['notify-job-id'] not in jobs and
+                     event['job-state'] == cups.IPP_JOB_PROCESSING)):
+                    new_jobids.add (event['notify-job-id'])
+
+            prefetched = self.fetch_job_attributes (new_jobids)
+
         for event in notifications['events']:
             seq = event['notify-sequence-number']
             self.sub_seq = seq
@@ -392,6 +567,10 @@ class Monitor(GObject.GObject):
             if nse.startswith ('printer-'):
                 # Printer events
                 name = event['printer-name']
+                if nse in ['printer-modified', 'printer-deleted']:
+                    # Its PPD may have changed.
+                    statereason.forget_localized_reasons (name)
+
                 if nse == 'printer-added' and name not in self.printers:
                     self.printers.add (name)
                     self.emit ('printer-added', name)
@@ -441,7 +620,11 @@ class Monitor(GObject.GObject):
                     continue
 
                 try:
-                    attrs = c.getJobAttributes (jobid)
+                    try:
+                        attrs = prefetched[jobid]
+                    except KeyError:
+                        attrs = self.cups_call ('getJobAttributes', jobid)
+
                     if (self.my_jobs and
                         attrs['job-originating-user-name'] != cups.getUser ()):
                         continue
@@ -453,15 +636,20 @@ class Monitor(GObject.GObject):
                     (e, m) = e.args
                     self.emit ('cups-ipp-error', e, m)
                     jobs[jobid] = {'job-k-octets': 0}
+                except RuntimeError:
+                    self.cups_connection_in_error = True
+                    self.emit ('cups-connection-error')
+                    jobs[jobid] = {'job-k-octets': 0}
 
-                self.emit ('job-added', jobid, nse, event, jobs[jobid].copy ())
+                self.emit_job_change ('job-added', jobid, nse, event,
+                                      jobs[jobid].copy ())
             elif (nse == 'job-completed' or
                   (nse == 'job-state-changed' and
                    event['job-state'] == cups.IPP_JOB_COMPLETED)):
                 if not (self.which_jobs in ['completed', 'all']):
                     try:
                         del jobs[jobid]
-                        self.emit ('job-removed', jobid, nse, event)
+                        self.emit_job_change ('job-removed', jobid, nse, event)
                     except KeyError:
                         pass
                     continue
@@ -474,7 +662,7 @@ class Monitor(GObject.GObject):
             if (self.specific_dests is not None and
                 event['printer-name'] not in self.specific_dests):
                 del jobs[jobid]
-                self.emit ('job-removed', jobid, nse, event)
+                self.emit_job_change ('job-removed', jobid, nse, event)
                 continue
 
             for attribute in ['job-state',
@@ -483,7 +671,7 @@ class Monitor(GObject.GObject):
             if 'notify-printer-uri' in event:
                 job['job-printer-uri'] = event['notify-printer-uri']
 
-            self.emit ('job-event', jobid, nse, event, job.copy ())
+            self.emit_job_change ('job-event', jobid, nse, event, job.copy ())
 
         self.set_process_pending (False)
         self.update_jobs (jobs)
@@ -504,6 +692,12 @@ class Monitor(GObject.GObject):
     def refresh(self, which_jobs=None, refresh_all=True):
         debugprint ("refresh")
 
+        # Changes collected before the refresh are now stale.
+        if self.job_changes_timer is not None:
+            GLib.source_remove (self.job_changes_timer)
+            self.job_changes_timer = None
+        self.job_changes = {}
+
         self.emit ('refresh')
         if which_jobs is not None:
             self.which_jobs = which_jobs
@@ -511,9 +705,7 @@ class Monitor(GObject.GObject):
         user = cups.getUser ()
         try:
             cups.setUser (self.user)
-            c = cups.Connection (host=self.host,
-                                 port=self.port,
-                                 encryption=self.encryption)
+            self.get_connection ()
         except RuntimeError:
             GLib.idle_add (self.emit, 'cups-connection-error')
             cups.setUser (user)
@@ -521,11 +713,15 @@ class Monitor(GObject.GObject):
 
         if self.sub_id != -1:
             try:
-                c.cancelSubscription (self.sub_id)
+                self.cups_call ('cancelSubscription', self.sub_id)
             except cups.IPPError as e:
                 (e, m) = e.args
                 GLib.idle_add (lambda e, m: self.emit ('cups-ipp-error', e, m),
                                e, m)
+            except RuntimeError:
+                GLib.idle_add (self.emit, 'cups-connection-error')
+                cups.setUser (user)
+                return
 
             if self.update_timer:
                 GLib.source_remove (self.update_timer)
@@ -550,13 +746,18 @@ class Monitor(GObject.GObject):
                             "job-progress"])
 
         try:
-            self.sub_id = c.createSubscription ("/", events=events)
+            self.sub_id = self.cups_call ('createSubscription', "/",
+                                          events=events)
             debugprint ("Created subscription %d, events=%s" % (self.sub_id,
                                                                 repr (events)))
         except cups.IPPError as e:
             (e, m) = e.args
             GLib.idle_add (lambda e, m: self.emit ('cups-ipp-error', e, m),
                            e, m)
+        except RuntimeError:
+            GLib.idle_add (self.emit, 'cups-connection-error')
+            cups.setUser (user)
+            return
 
         cups.setUser (user)
 
@@ -582,6 +783,8 @@ class Monitor(GObject.GObject):
                 jobs = filtered
 
             self.fetch_first_job_id = 1
+            self.fetch_jobs_limit = FETCH_JOBS_FIRST_BATCH
+            self.fetch_jobs_count = 0
             if self.fetch_jobs_timer:
                 GLib.source_remove (self.fetch_jobs_timer)
             self.fetch_jobs_timer = GLib.timeout_add (5, self.fetch_jobs,
@@ -590,9 +793,10 @@ class Monitor(GObject.GObject):
             jobs = {}
 
         try:
-            r = collect_printer_state_reasons (c, self.ppdcache)
+            r = collect_printer_state_reasons (self.get_connection (),
+                                               self.ppdcache)
             self.printer_state_reasons = r
-            dests = c.getPrinters ()
+            dests = self.cups_call ('getPrinters')
             self.printers = set(dests.keys ())
         except cups.IPPError as e:
             (e, m) = e.args
@@ -600,6 +804,7 @@ class Monitor(GObject.GObject):
                            e, m)
             return
         except RuntimeError:
+            self.connection = None
             GLib.idle_add (self.emit, 'cups-connection-error')
             return
 
@@ -616,7 +821,8 @@ class Monitor(GObject.GObject):
             GLib.idle_add (lambda x: self.emit ('printer-added', x), printer)
         for jobid, job in jobs.items ():
             GLib.idle_add (lambda jobid, job:
-                                  self.emit ('job-added', jobid, '', {}, job),
+                               self.emit_job_change ('job-added', jobid,
+                                                     '', {}, job),
                            jobid, job)
         self.update_jobs (jobs)
         self.jobs = jobs
@@ -629,18 +835,8 @@ class Monitor(GObject.GObject):
             return True
 
         user = cups.getUser ()
-        try:
-            cups.setUser (self.user)
-            c = cups.Connection (host=self.host,
-                                 port=self.port,
-                                 encryption=self.encryption)
-        except RuntimeError:
-            self.emit ('cups-connection-error')
-            self.fetch_jobs_timer = None
-            cups.setUser (user)
-            return False
-
-        limit = 1
+        cups.setUser (self.user)
+        limit = self.fetch_jobs_limit
         r = ["job-id",
              "job-printer-uri",
              "job-state",
@@ -649,17 +845,23 @@ class Monitor(GObject.GObject):
              "job-name",
              "time-at-creation"]
         try:
-            fetched = c.getJobs (which_jobs=self.which_jobs,
-                                 my_jobs=self.my_jobs,
-                                 first_job_id=self.fetch_first_job_id,
-                                 limit=limit,
-                                 requested_attributes=r)
+            fetched = self.cups_call ('getJobs',
+                                      which_jobs=self.which_jobs,
+                                      my_jobs=self.my_jobs,
+                                      first_job_id=self.fetch_first_job_id,
+                                      limit=limit,
+                                      requested_attributes=r)
         except cups.IPPError as e:
             (e, m) = e.args
             self.emit ('cups-ipp-error', e, m)
             self.fetch_jobs_timer = None
             cups.setUser (user)
             return False
+        except RuntimeError:
+            self.emit ('cups-connection-error')
+            self.fetch_jobs_timer = None
+            cups.setUser (user)
+            return False
 
         cups.setUser (user)
         got = len (fetched)
@@ -692,12 +894,12 @@ class Monitor(GObject.GObject):
                     n = 'job-added'
 
                 jobs[jobid] = job
-                self.emit (n, jobid, '', {}, job.copy ())
+                self.emit_job_change (n, jobid, '', {}, job.copy ())
             except KeyError:
                 # No job by that ID.
                 if jobid in jobs:
                     del jobs[jobid]
-                    self.emit ('job-removed', jobid, '', {})
+                    self.emit_job_change ('job-removed', jobid, '', {})
 
         jobids = list(jobs.keys ())
         jobids.sort ()
@@ -710,23 +912,29 @@ class Monitor(GObject.GObject):
             
                 if trim:
                     del jobs[jobid]
-                    self.emit ('job-removed', jobid, '', {})
+                    self.emit_job_change ('job-removed', jobid, '', {})
 
         self.update_jobs (jobs)
         self.jobs = jobs
+        self.fetch_jobs_count += got
 
         if got < limit:
             # That's all.  Don't run this timer again.
             self.fetch_jobs_timer = None
+            self.emit ('fetch-jobs-progress', self.fetch_jobs_count, True)
             return False
 
-        # Remember where we got up to and run this timer again.
+        self.emit ('fetch-jobs-progress', self.fetch_jobs_count, False)
+
+        # Remember where we got up to and run this timer again, with
+        # a larger batch.
         next = jobid + 1
 
         while not refresh_all and next in self.jobs:
             next += 1
 
         self.fetch_first_job_id = next
+        self.fetch_jobs_limit = min (limit * 2, FETCH_JOBS_MAX_BATCH)
         return True
 
     def sort_jobs_by_printer (self, jobs=None):
@@ -787,6 +995,8 @@ if __name__ == '__main__':
             monitor.connect ('cups-connection-error',
                              self.on_cups_connection_error)
             monitor.connect ('cups-ipp-error', self.on_cups_ipp_error)
+            monitor.connect ('fetch-jobs-progress',
+                             self.on_fetch_jobs_progress)
 
         def on_monitor_exited (self, obj):
             print("*%s: monitor exited" % obj)
@@ -827,6 +1037,10 @@ if __name__ == '__main__':
         def on_cups_ipp_error (self, obj, err, errstring):
             print("*%s: IPP error (%d): %s" % (obj, err, errstring))
 
+        def on_fetch_jobs_progress (self, obj, count, finished):
+            print("*%s: %d jobs fetched%s" % (obj, count,
+                                              finished and " (done)" or ""))
+
     set_debugging (True)
     m = Monitor ()
     SignalWatcher (m)
@@ -51,13 +51,14 @@ import options
 from gi.repository import GObject
 from gi.repository import GLib
 from gui import GtkGUI
-from optionwidgets import OptionWidget
+from optionwidgets import OptionWidget, index_constraints
 from debug import *
 import probe_printer
 import urllib.request, urllib.parse
 from smburi import SMBURI
 from errordialogs import *
-from PhysicalDevice import PhysicalDevice
+from PhysicalDevice import PhysicalDevice, PhysicalDeviceGrouper
+from PhysicalDevice import resolve_device_hosts
 import firewallsettings
 import asyncconn
 import ppdsloader
@@ -414,6 +415,7 @@ class NewPrinterGUI(GtkGUI):
         self.ntbkNPDownloadableDriverProperties.set_show_tabs(False)
 
         self.spinner_count = 0
+        self.device_batches = []
 
         # Set up OpenPrinting widgets.
         self.opreq = None
@@ -564,6 +566,9 @@ class NewPrinterGUI(GtkGUI):
 
         return
 
+    def get_option_widget(self, keyword):
+        return self.options.get(keyword)
+
     def setDataButtonState(self):
         self.btnNPForward.set_sensitive(not bool(self.conflicts))
 
@@ -1385,7 +1390,9 @@ class NewPrinterGUI(GtkGUI):
                 self._installSMBBackendIfNeeded ()
 
         if page_nr == self.PAGE_SELECT_DEVICE or page_nr == self.PAGE_SELECT_INSTALL_METHOD:
-            self._selectDeviceForInstallation (uri)
+            if (self._selectDeviceForInstallation (uri, step) ==
+                self.INSTALL_RESULT_OPS_PENDING):
+                return self.INSTALL_RESULT_OPS_PENDING
         elif page_nr == self.PAGE_DOWNLOAD_DRIVER and self.nextnptab_rerun == False:
             self._handleDriverInstallation ()
 
@@ -1423,10 +1430,27 @@ class NewPrinterGUI(GtkGUI):
             except:
                 nonfatalException ()
 
-    def _selectDeviceForInstallation (self, uri):
+    def _selectDeviceForInstallation (self, uri, step):
         self._initialiseAutoVariables ()
         self.device.uri = self.getDeviceURI ()
 
+        if (not self.device.id and
+            self.device.type in ["socket", "lpd", "ipp"]):
+            # This is a network printer whose model we don't yet know.
+            # Ask SNMP about it in the background, and come back here
+            # once the answer is in.
+            host = self._getNetworkPrinterHost (self.device)
+            if host:
+                snmp = probe_printer.get_snmp_service ()
+                (found, result) = snmp.get_cached (host)
+                if not found:
+                    page_nr = self.ntbkNewPrinter.get_current_page ()
+                    snmp.query_async (host,
+                                      lambda h, r:
+                                          self.on_snmp_reply_next (page_nr,
+                                                                   step))
+                    return self.INSTALL_RESULT_OPS_PENDING
+
         # Cancel the printer finder now as the user has
         # already selected their device.
         if self.fetchDevices_conn:
@@ -1503,6 +1527,21 @@ class NewPrinterGUI(GtkGUI):
             # Remote CUPS queue discovered by "dnssd" CUPS backend
             self.remotecupsqueue = self.device.info
 
+        return self.INSTALL_RESULT_DONE
+
+    def on_snmp_reply_next (self, page_nr, step):
+        """
+        This method is called when SNMP has answered about the
+        network printer selected before clicking 'Forward'.
+        """
+        if (not self.NewPrinterWindow.get_property ("visible") or
+            self.ntbkNewPrinter.get_current_page () != page_nr):
+            # The dialog has been closed or moved on meanwhile.
+            return
+
+        debugprint ("Got SNMP answer; try nextNPTab again...")
+        self.nextNPTab (step)
+
     def _handleDriverInstallation (self):
         # Install package of the driver found on OpenPrinting
         treeview = self.tvNPDownloadableDrivers
@@ -2032,7 +2071,7 @@ class NewPrinterGUI(GtkGUI):
         self.fetchDevices (network=True, current_uri=current_uri)
 
         # Add the local devices to the list.
-        self.add_devices (result, current_uri)
+        self.queue_devices (result, current_uri)
 
     def network_devices_reply (self, conn, result, current_uri):
         self.fetchDevices_conn._end_operation ()
@@ -2050,23 +2089,59 @@ class NewPrinterGUI(GtkGUI):
         for uri in need_resolving.keys ():
             del result[uri]
 
-        self.add_devices (result, current_uri, no_more=no_more)
+        self.queue_devices (result, current_uri, no_more=no_more)
 
         if len (need_resolving) > 0:
             resolver = dnssdresolve.DNSSDHostNamesResolver (need_resolving)
             self.inc_spinner_task ()
+            added = set ()
             resolver.resolve (reply_handler=lambda devices:
                                   self.dnssd_resolve_reply (current_uri,
-                                                            devices))
+                                                            devices, added),
+                              resolved_handler=lambda uri, device:
+                                  self.dnssd_resolved_device (current_uri,
+                                                              uri, device,
+                                                              added))
 
         self.dec_spinner_task ()
         self.check_firewall ()
 
-    def dnssd_resolve_reply (self, current_uri, devices):
-        self.add_devices (devices, current_uri, no_more=True)
+    def dnssd_resolved_device (self, current_uri, uri, device, added):
+        # Show each device as soon as it is resolved.
+        added.add (uri)
+        self.queue_devices ({uri: device}, current_uri)
+
+    def dnssd_resolve_reply (self, current_uri, devices, added):
+        # Now add the rest, including any not resolved in time.
+        devices = dict ([(uri, device) for uri, device in devices.items ()
+                         if uri not in added])
+        self.queue_devices (devices, current_uri, no_more=True)
         self.dec_spinner_task ()
         self.check_firewall ()
 
+    def queue_devices (self, devices, current_uri, no_more=False):
+        # Look up the devices' host addresses on worker threads
+        # before grouping them, so that add_devices() does not block
+        # the main loop on DNS.  Batches are added in the order they
+        # arrived, whichever finishes resolving first.
+        batch = [False, (devices, current_uri, no_more)]
+        self.device_batches.append (batch)
+        self.inc_spinner_task ()
+        def resolved ():
+            batch[0] = True
+            GLib.idle_add (self.add_queued_devices)
+
+        resolve_device_hosts (devices.values (), reply_handler=resolved)
+
+    def add_queued_devices (self):
+        while self.device_batches and self.device_batches[0][0]:
+            batch = self.device_batches.pop (0)
+            (devices, current_uri, no_more) = batch[1]
+            self.dec_spinner_task ()
+            self.add_devices (devices, current_uri, no_more=no_more)
+
+        return False
+
     def get_hpfax_device_id(self, faxuri):
         new_environ = os.environ.copy()
         new_environ['LC_ALL'] = "C"
@@ -2151,6 +2226,19 @@ class NewPrinterGUI(GtkGUI):
         uri = stdout.decode ().strip ()
         return uri
 
+    def _getNetworkPrinterHost (self, device):
+        host = None
+        s = device.uri.find ("://")
+        if s != -1:
+            s += 3
+            e = device.uri[s:].find (":")
+            if e == -1: e = device.uri[s:].find ("/")
+            if e == -1: e = device.uri[s:].find ("?")
+            if e == -1: e = len (device.uri)
+            host = device.uri[s:s+e]
+
+        return host
+
     def getNetworkPrinterMakeModel(self, host=None, device=None):
         """
         Try to determine the make and model for the currently selected
@@ -2163,39 +2251,12 @@ class NewPrinterGUI(GtkGUI):
             device = self.device
         # Determine host name/IP
         if host is None:
-            s = device.uri.find ("://")
-            if s != -1:
-                s += 3
-                e = device.uri[s:].find (":")
-                if e == -1: e = device.uri[s:].find ("/")
-                if e == -1: e = device.uri[s:].find ("?")
-                if e == -1: e = len (device.uri)
-                host = device.uri[s:s+e]
+            host = self._getNetworkPrinterHost (device)
         # Try to get make and model via SNMP
         if host:
-            args = ["/usr/lib/cups/backend/snmp", host]
-            debugprint (host + ": " + repr(args))
-            stdout = None
-            try:
-                p = subprocess.Popen (args, close_fds=True,
-                                      stdin=subprocess.DEVNULL,
-                                      stdout=subprocess.PIPE,
-                                      stderr=subprocess.PIPE)
-                (stdout, stderr) = p.communicate ()
-                if p.returncode != 0:
-                    stdout = None
-            except:
-                # Problem executing command.
-                pass
-
-            if stdout is not None:
-                try:
-                    line = stdout.decode ('utf-8').strip ()
-                except UnicodeDecodeError:
-                    # Work-around snmp backend output encoded as iso-8859-1 (despire RFC 2571).
-                    # If it's neither iso-8859-1, make a best guess by ignoring problematic bytes.
-                    line = stdout.decode (encoding='iso-8859-1', errors='ignore').strip ()
-                words = probe_printer.wordsep (line)
+            lines = probe_printer.get_snmp_service ().query (host)
+            if lines is not None:
+                words = list (lines[0])
                 n = len (words)
                 if n < 4:
                     words.extend (['','','',''])
@@ -2265,6 +2326,10 @@ class NewPrinterGUI(GtkGUI):
         self.devices_find_nw_iter = find_nw_iter
         self.devices_network_iter = network_iter
         self.devices_network_fetched = False
+        for batch in self.device_batches:
+            # Discard devices still waiting for host names to resolve.
+            self.dec_spinner_task ()
+        self.device_batches = []
         self.tvNPDevices.set_model (model)
         self.entNPTDevice.set_text ('')
         self.expNPDeviceURIs.hide ()
@@ -2355,27 +2420,33 @@ class NewPrinterGUI(GtkGUI):
         devices = list(map (replace_generic, devices))
 
         # Mark duplicate URIs for deletion
-        for i in range (len (devices) - 1):
-            for j in range (i + 1, len (devices)):
-                device1 = devices[i]
-                device2 = devices[j]
-                if device1.uri == "delete" or device2.uri == "delete":
-                    continue
-                if device1.uri == device2.uri:
-                    # Keep the one with the longer (better) device ID
-                    if (not device1.id):
-                        device1.uri = "delete"
-                    elif (not device2.id):
-                        device2.uri = "delete"
-                    elif (len (device1.id) < len (device2.id)):
-                        device1.uri = "delete"
-                    else:
-                        device2.uri = "delete"
+        kept = {}
+        for device2 in devices:
+            if device2.uri == "delete":
+                continue
+            device1 = kept.get (device2.uri)
+            if device1 is None:
+                kept[device2.uri] = device2
+                continue
+
+            # Keep the one with the longer (better) device ID
+            uri = device2.uri
+            if (not device1.id):
+                device1.uri = "delete"
+                kept[uri] = device2
+            elif (not device2.id):
+                device2.uri = "delete"
+            elif (len (device1.id) < len (device2.id)):
+                device1.uri = "delete"
+                kept[uri] = device2
+            else:
+                device2.uri = "delete"
         devices = [x for x in devices if x.uri not in ("hp", "hpfax",
                                                        "hal", "beh", "smb", 
                                                        "scsi", "http", "bjnp",
                                                        "delete")]
         newdevices = []
+        grouper = PhysicalDeviceGrouper (self.devices)
         for device in devices:
             debugprint("Adding device with URI %s" % device.uri)
             if (hasattr (device, 'address')):
@@ -2385,26 +2456,27 @@ class NewPrinterGUI(GtkGUI):
             physicaldevice = PhysicalDevice (device)
             debugprint ("   Created physical device %s" % repr(physicaldevice))
             try:
-                i = self.devices.index (physicaldevice)
+                i = grouper.index (physicaldevice)
                 debugprint ("   Physical device %d is the same printer" % i)
-                self.devices[i].add_device (device)
+                grouper.add_device (i, device)
                 debugprint ("   New physical device %s is same as physical device %d: %s" %
                             (repr(physicaldevice), i, repr(self.devices[i])))
                 debugprint ("   Joining devices")
             except ValueError:
-                self.devices.append (physicaldevice)
+                grouper.append (physicaldevice)
                 newdevices.append (physicaldevice)
                 debugprint ("   Physical device %s is a completely new device" % repr(physicaldevice))
 
         self.devices.sort()
+        grouper = PhysicalDeviceGrouper (self.devices)
         if current_uri:
             current_device = PhysicalDevice (current)
             try:
-                i = self.devices.index (current_device)
-                self.devices[i].add_device (current)
+                i = grouper.index (current_device)
+                grouper.add_device (i, current)
                 current_device = self.devices[i]
             except ValueError:
-                self.devices.append (current_device)
+                grouper.append (current_device)
                 newdevices.append (current_device)
         else:
             current_device = None
@@ -2416,7 +2488,7 @@ class NewPrinterGUI(GtkGUI):
         for newdevice in newdevices:
             device = None
             try:
-                i = self.devices.index (newdevice)
+                i = grouper.index (newdevice)
                 device = self.devices[i]
             except ValueError:
                 debugprint("ERROR: Cannot identify new physical device with its entry in the device list (%s)" %
@@ -3148,6 +3220,7 @@ class NewPrinterGUI(GtkGUI):
             remotecups = False
             host = None
             device_dict = { 'device-class': 'network' }
+            snmp_pending = False
             if physicaldevice._network_host:
                 host = physicaldevice._network_host
             for device in physicaldevice.get_devices ():
@@ -3175,6 +3248,19 @@ class NewPrinterGUI(GtkGUI):
                         if (not device.make_and_model or \
                             device.make_and_model == "Unknown") and not \
                            remotecups:
+                            snmp = probe_printer.get_snmp_service ()
+                            (found, result) = snmp.get_cached (host)
+                            if not found:
+                                # Ask in the background rather than
+                                # block, and look again when the
+                                # answer arrives.
+                                snmp.query_async (host,
+                                                  lambda h, r:
+                                                      self.on_snmp_reply (
+                                                          physicaldevice))
+                                snmp_pending = True
+                                break
+
                             self.getNetworkPrinterMakeModel(host=host,
                                                             device=device)
                         device_dict['device-info'] = device.info
@@ -3184,6 +3270,7 @@ class NewPrinterGUI(GtkGUI):
                         device_dict['device-location'] = device.location
 
             if not hp_drivable and is_network and not remotecups and \
+               not snmp_pending and \
                (not device.make_and_model or \
                 device.make_and_model == "Unknown" or \
                 device.make_and_model.lower ().startswith ("hp") or \
@@ -3219,7 +3306,8 @@ class NewPrinterGUI(GtkGUI):
 
             if hp_scannable:
                 physicaldevice.hp_scannable = True
-            physicaldevice.checked_hplip = True
+            if not snmp_pending:
+                physicaldevice.checked_hplip = True
 
         device.hp_scannable = getattr (physicaldevice, 'hp_scannable', None)
 
@@ -3235,6 +3323,18 @@ class NewPrinterGUI(GtkGUI):
         else:
             self.expNPDeviceURIs.hide ()
 
+    def on_snmp_reply (self, physicaldevice):
+        # The make and model of this device's host are now known.
+        # If it is still selected, look at it again.
+        (path, column) = self.tvNPDevices.get_cursor ()
+        if path is None:
+            return
+
+        model = self.tvNPDevices.get_model ()
+        iter = model.get_iter (path)
+        if model.get_value (iter, 1) is physicaldevice:
+            self.on_tvNPDevices_cursor_changed (self.tvNPDevices)
+
     def on_tvNPDeviceURIs_cursor_changed(self, widget):
         path, column = widget.get_cursor ()
         if path is None:
@@ -4288,6 +4388,8 @@ class NewPrinterGUI(GtkGUI):
             debugprint ("No PPD so no installable options")
             return
 
+        constraints = index_constraints(self.ppd)
+
         # build option tabs
         for group in self.ppd.optionGroups:
             if group.name != "InstallableOptions":
@@ -4303,7 +4405,8 @@ class NewPrinterGUI(GtkGUI):
                 if option.keyword == "PageRegion":
                     continue
                 rows += 1
-                o = OptionWidget(option, self.ppd, self)
+                o = OptionWidget(option, self.ppd, self,
+                                 constraints=constraints)
                 grid.attach(o.conflictIcon, 0, nr, 1, 1)
 
                 hbox = Gtk.Box()
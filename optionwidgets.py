@@ -25,7 +25,24 @@ import gettext
 gettext.install(domain=config.PACKAGE, localedir=config.localedir)
 import ppdippstr
 
-def OptionWidget(option, ppd, gui, tab_label=None):
+def index_constraints(ppd):
+    """
+    Map each option keyword to the UIConstraints involving it, so
+    that option widgets need not each scan every constraint.
+
+    @param ppd: PPD
+    @type ppd: cups.PPD
+    @returns: dict, indexed by option keyword, of lists of constraints
+    """
+    index = {}
+    for c in ppd.constraints:
+        index.setdefault(c.option1, []).append(c)
+        if c.option2 != c.option1:
+            index.setdefault(c.option2, []).append(c)
+
+    return index
+
+def OptionWidget(option, ppd, gui, tab_label=None, constraints=None):
     """Factory function"""
     ui = option.ui
     if (ui == cups.PPD_UI_BOOLEAN and
@@ -36,16 +53,20 @@ def OptionWidget(option, ppd, gui, tab_label=None):
         ui = cups.PPD_UI_PICKONE
 
     if ui == cups.PPD_UI_BOOLEAN:
-        return OptionBool(option, ppd, gui, tab_label=tab_label)
+        return OptionBool(option, ppd, gui, tab_label=tab_label,
+                          constraints=constraints)
     elif ui == cups.PPD_UI_PICKONE:
-        return OptionPickOne(option, ppd, gui, tab_label=tab_label)
+        return OptionPickOne(option, ppd, gui, tab_label=tab_label,
+                             constraints=constraints)
     elif ui == cups.PPD_UI_PICKMANY:
-        return OptionPickMany(option, ppd, gui, tab_label=tab_label)
+        return OptionPickMany(option, ppd, gui, tab_label=tab_label,
+                              constraints=constraints)
 
 # ---------------------------------------------------------------------------
 
 class Option:
-    def __init__(self, option, ppd, gui, tab_label=None):
+    def __init__(self, option, ppd, gui, tab_label=None,
+                 constraints=None):
         self.option = option
         self.ppd = ppd
         self.gui = gui
@@ -67,9 +88,9 @@ class Option:
         self.btnConflict.connect("clicked", self.on_btnConflict_clicked)
         icon.show()
 
-        self.constraints = [c for c in ppd.constraints
-                            if (c.option1 == option.keyword or
-                                c.option2 == option.keyword)]
+        if constraints is None:
+            constraints = index_constraints(ppd)
+        self.constraints = constraints.get(option.keyword, [])
         #for c in self.constraints:
         #    if not c.choice1 or not c.choice2:
         #        print c.option1, repr(c.choice1), c.option2, repr(c.choice2)
@@ -101,21 +122,27 @@ class Option:
         value = self.get_current_value()
         for constraint in self.constraints:
             if constraint.option1 == self.option.keyword:
-                option2 = self.gui.options.get(constraint.option2, None)
+                keyword2 = constraint.option2
                 choice1 = constraint.choice1
                 choice2 = constraint.choice2
             else:
-                option2 = self.gui.options.get(constraint.option1, None)
+                keyword2 = constraint.option1
                 choice1 = constraint.choice2
                 choice2 = constraint.choice1
 
-            if option2 is None: continue
-
             def matches (constraint_choice, value):
                 if constraint_choice != '':
                     return constraint_choice == value
                 return value not in ['None', 'False', 'Off']
 
+            if (not matches (choice1, value) and
+                constraint not in self.conflicts):
+                # Nothing to do, so don't look for the other option.
+                continue
+
+            option2 = self.gui.get_option_widget(keyword2)
+            if option2 is None: continue
+
             if (matches (choice1, value) and
                 matches (choice2, option2.get_current_value())):
                 # conflict
@@ -179,7 +206,8 @@ class Option:
 
 class OptionBool(Option):
 
-    def __init__(self, option, ppd, gui, tab_label=None):
+    def __init__(self, option, ppd, gui, tab_label=None,
+                 constraints=None):
         self.selector = Gtk.CheckButton.new_with_label(
                                             ppdippstr.ppd.get (option.text))
         self.label = None
@@ -193,7 +221,8 @@ class OptionBool(Option):
         self.selector.set_active(option.defchoice == self.true)
         self.selector.set_alignment(0.0, 0.5)
         self.selector.connect("toggled", self.on_change)
-        Option.__init__(self, option, ppd, gui, tab_label=tab_label)
+        Option.__init__(self, option, ppd, gui, tab_label=tab_label,
+                        constraints=constraints)
 
     def get_current_value(self):
         return (self.false, self.true)[self.selector.get_active()]
@@ -203,7 +232,8 @@ class OptionBool(Option):
 class OptionPickOne(Option):
     widget_name = "OptionPickOne"
 
-    def __init__(self, option, ppd, gui, tab_label=None):
+    def __init__(self, option, ppd, gui, tab_label=None,
+                 constraints=None):
         self.selector = Gtk.ComboBoxText()
         #self.selector.set_alignment(0.0, 0.5)
 
@@ -224,7 +254,8 @@ class OptionPickOne(Option):
             print(option.text, "unknown value:", option.defchoice)
         self.selector.connect("changed", self.on_change)
 
-        Option.__init__(self, option, ppd, gui, tab_label=tab_label)
+        Option.__init__(self, option, ppd, gui, tab_label=tab_label,
+                        constraints=constraints)
 
     def get_current_value(self):
         return self.option.choices[self.selector.get_active()]['choice']
@@ -234,7 +265,9 @@ class OptionPickOne(Option):
 class OptionPickMany(OptionPickOne):
     widget_name = "OptionPickMany"
 
-    def __init__(self, option, ppd, gui, tab_label=None):
+    def __init__(self, option, ppd, gui, tab_label=None,
+                 constraints=None):
         raise NotImplemented
-        Option.__init__(self, option, ppd, gui, tab_label=tab_label)
+        Option.__init__(self, option, ppd, gui, tab_label=tab_label,
+                        constraints=constraints)
         
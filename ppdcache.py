@@ -24,18 +24,56 @@ from gi.repository import GLib
 from gi.repository import Gdk
 from gi.repository import Gtk
 import os
-from shutil import copyfileobj
-from tempfile import NamedTemporaryFile
+import time
+from collections import OrderedDict
 from debug import *
 
 cups.require ("1.9.50")
 
+# Limits on how many parsed PPDs are kept, and on the total size of
+# the PPD files they were parsed from.
+PPD_CACHE_MAX_ENTRIES = 64
+PPD_CACHE_MAX_BYTES = 32 * 1024 * 1024
+
+# How long, in seconds, a PPD is assumed to still be up to date after
+# checking it with the server.
+PPD_CACHE_FRESHNESS = 10
+
 class PPDCache:
-    def __init__ (self, host=None, port=None, encryption=None):
+    """
+    Fetch PPDs from the CUPS server asynchronously, keeping the
+    parsed cups.PPD objects of the most recently used printers.
+
+    The same cups.PPD object is passed to every callback asking for
+    that printer, so callers must not modify it.  Requests for a PPD
+    which is already being fetched wait for that request instead of
+    starting another.
+    """
+
+    def __init__ (self, host=None, port=None, encryption=None,
+                  max_entries=PPD_CACHE_MAX_ENTRIES,
+                  max_bytes=PPD_CACHE_MAX_BYTES,
+                  freshness=PPD_CACHE_FRESHNESS):
+        """
+        @param max_entries: maximum number of PPDs to keep
+        @type max_entries: int
+        @param max_bytes: maximum total size of the PPD files kept
+        @type max_bytes: int
+        @param freshness: seconds for which a PPD checked with the
+        server is not checked again
+        @type freshness: number
+        """
         self._cups = None
         self._exc = None
-        self._cache = dict()
+        self._cache = OrderedDict()
+        self._sizes = dict()
+        self._cache_bytes = 0
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
         self._modtimes = dict()
+        self._checked = dict()
+        self._freshness = freshness
+        self._inflight = dict()
         self._host = host
         self._port = port
         self._encryption = encryption
@@ -49,23 +87,16 @@ class PPDCache:
             self._cups.destroy ()
 
     def fetch_ppd (self, name, callback, check_uptodate=True):
-        if check_uptodate and name in self._modtimes:
+        if (check_uptodate and name in self._modtimes and
+            not self._is_fresh (name)):
             # We have getPPD3 so we can check whether the PPD is up to
             # date.
             debugprint ("%s: check if %s is up to date" % (self, name))
-            self._cups.getPPD3 (name,
-                                modtime=self._modtimes[name],
-                                reply_handler=lambda c, r:
-                                    self._got_ppd3 (c, name, r, callback),
-                                error_handler=lambda c, r:
-                                    self._got_ppd3 (c, name, r, callback))
+            self._request (name, callback, modtime=self._modtimes[name])
             return
 
         try:
-            f = self._cache[name]
-        except RuntimeError as e:
-            self._schedule_callback (callback, name, None, e)
-            return
+            ppd = self._cache[name]
         except KeyError:
             if not self._cups:
                 self._queued.append ((name, callback))
@@ -75,25 +106,80 @@ class PPDCache:
                 return
 
             debugprint ("%s: fetch PPD for %s" % (self, name))
-            self._cups.getPPD3 (name,
-                                reply_handler=lambda c, r:
-                                    self._got_ppd3 (c, name, r, callback),
-                                error_handler=lambda c, r:
-                                    self._got_ppd3 (c, name, r, callback))
+            self._request (name, callback)
+            return
+
+        self._cache.move_to_end (name)
+        self._schedule_callback (callback, name, ppd, None)
+
+    def _is_fresh (self, name):
+        checked = self._checked.get (name)
+        return (checked is not None and
+                time.monotonic () - checked < self._freshness)
+
+    def _request (self, name, callback, modtime=None):
+        if name in self._inflight:
+            # Already fetching this one; share the result.
+            debugprint ("%s: waiting for pending request for %s" %
+                        (self, name))
+            self._inflight[name].append (callback)
             return
 
-        # Copy from our file object to a new temporary file, create a
-        # PPD object from it, then remove the file.  This way we don't
-        # leave temporary files around even though we are caching...
-        f.seek (0)
-        with NamedTemporaryFile () as tmpf:
-            copyfileobj (f, tmpf)
+        self._inflight[name] = [callback]
+        kwds = {}
+        if modtime is not None:
+            kwds['modtime'] = modtime
 
+        self._cups.getPPD3 (name,
+                            reply_handler=lambda c, r:
+                                self._got_ppd3 (c, name, r),
+                            error_handler=lambda c, r:
+                                self._got_ppd3 (c, name, r),
+                            **kwds)
+
+    def _store (self, name, filename, modtime=None):
+        """
+        Parse a downloaded PPD file into the cache, then remove the
+        file.  This way we don't leave temporary files around.
+
+        @raise RuntimeError: the PPD could not be parsed
+        @raise OSError: the file could not be read
+        """
+        try:
+            size = os.path.getsize (filename)
+            ppd = cups.PPD (filename)
+        finally:
             try:
-                ppd = cups.PPD (tmpf.file)
-                self._schedule_callback (callback, name, ppd, None)
-            except Exception as e:
-                self._schedule_callback (callback, name, None, e)
+                os.unlink (filename)
+            except OSError:
+                pass
+
+        self._discard (name)
+        self._cache[name] = ppd
+        self._checked[name] = time.monotonic ()
+        self._sizes[name] = size
+        self._cache_bytes += size
+        if modtime is not None:
+            self._modtimes[name] = modtime
+
+        debugprint ("%s: caching %s (%d bytes) (%s)" % (self, name, size,
+                                                        modtime))
+        while (len (self._cache) > 1 and
+               (len (self._cache) > self._max_entries or
+                self._cache_bytes > self._max_bytes)):
+            (oldest, oldppd) = self._cache.popitem (last=False)
+            debugprint ("%s: dropping %s from cache" % (self, oldest))
+            self._cache_bytes -= self._sizes.pop (oldest)
+            self._modtimes.pop (oldest, None)
+            self._checked.pop (oldest, None)
+
+    def _discard (self, name):
+        if name in self._cache:
+            del self._cache[name]
+            self._cache_bytes -= self._sizes.pop (name)
+
+        self._modtimes.pop (name, None)
+        self._checked.pop (name, None)
 
     def _connect (self, callback=None):
         self._connecting = True
@@ -104,27 +190,29 @@ class PPDCache:
 
     def _got_ppd (self, connection, name, result, callback):
         if isinstance (result, Exception):
-            self._schedule_callback (callback, name, none, result)
+            self._schedule_callback (callback, name, None, result)
         else:
-            # Store an open file object, then remove the actual file.
-            # This way we don't leave temporary files around.
             try:
-                self._cache[name] = open (result, "rb")
-                debugprint ("%s: caching %s (fd %d)" %
-                            (self, result,
-                             self._cache[name].fileno()))
-                os.unlink (result)
-            except IOError as exc:
+                self._store (name, result)
+            except (RuntimeError, OSError) as exc:
                 self._schedule_callback (callback, name, None, exc)
                 return
 
             self.fetch_ppd (name, callback)
 
-    def _got_ppd3 (self, connection, name, result, callback):
+    def _got_ppd3 (self, connection, name, result):
+        callbacks = self._inflight.pop (name, [])
+        if isinstance (result, Exception):
+            for callback in callbacks:
+                self._schedule_callback (callback, name, None, result)
+
+            return
+
         (status, modtime, filename) = result
         if status in [cups.HTTP_OK, cups.HTTP_NOT_MODIFIED]:
             if status == cups.HTTP_NOT_MODIFIED:
                 # The file is no newer than the one we already have.
+                self._checked[name] = time.monotonic ()
 
                 # CUPS before 1.5.3 created a temporary file in error
                 # in this situation (STR #4018) so remove that.
@@ -135,30 +223,30 @@ class PPDCache:
 
             elif status == cups.HTTP_OK:
                 # Our version of the file was older.  Cache the new version.
-
-                # Store an open file object, then remove the actual
-                # file.  This way we don't leave temporary files
-                # around.
                 try:
-                    self._cache[name] = open (filename, "rb")
-                    debugprint ("%s: caching %s (fd %d) "
-                                "(%s) - %s" % (self, filename,
-                                               self._cache[name].fileno (),
-                                               modtime, status))
-                    os.unlink (filename)
-                    self._modtimes[name] = modtime
-                except IOError as exc:
+                    self._store (name, filename, modtime)
+                except OSError as exc:
                     # File disappeared?
                     debugprint ("%s: file %s disappeared? Unable to cache it"
                                 % (self, filename))
-                    self._schedule_callback (callback, name, None, exc)
+                    self._discard (name)
+                    for callback in callbacks:
+                        self._schedule_callback (callback, name, None, exc)
+                    return
+                except RuntimeError as exc:
+                    debugprint ("%s: unable to parse %s" % (self, filename))
+                    self._discard (name)
+                    for callback in callbacks:
+                        self._schedule_callback (callback, name, None, exc)
                     return
 
             # Now fetch it from our own cache.
-            self.fetch_ppd (name, callback, check_uptodate=False)
+            for callback in callbacks:
+                self.fetch_ppd (name, callback, check_uptodate=False)
         else:
-            self._schedule_callback (callback, name,
-                                     None, cups.HTTPError (status))
+            for callback in callbacks:
+                self._schedule_callback (callback, name,
+                                         None, cups.HTTPError (status))
 
     def _connected (self, connection, exc):
         self._connecting = False
@@ -36,8 +36,9 @@ from gi.repository import GObject
 from gi.repository import GLib
 from gui import GtkGUI
 import html  # requires python3.2
-from optionwidgets import OptionWidget
+from optionwidgets import OptionWidget, index_constraints
 from debug import *
+import asyncconn
 import authconn
 from errordialogs import *
 import gtkinklevel
@@ -65,6 +66,7 @@ class PrinterPropertiesDialog(GtkGUI):
     __gsignals__ = {
         'destroy':       ( GObject.SignalFlags.RUN_LAST, None, ()),
         'dialog-closed': ( GObject.SignalFlags.RUN_LAST, None, ()),
+        'ppd-loaded':    ( GObject.SignalFlags.RUN_LAST, None, ()),
         }
 
     printer_states = { cups.IPP_PRINTER_IDLE:
@@ -91,6 +93,9 @@ class PrinterPropertiesDialog(GtkGUI):
 
         self.parent = None
         self.printer = self.ppd = None
+        self.ppd_local = None
+        self._ppd_conn = None
+        self._ppd_name = None
         self.conflicts = set() # of options
         self.changed = set() # of options
         self.signal_ids = dict()
@@ -254,6 +259,12 @@ class PrinterPropertiesDialog(GtkGUI):
         sel.connect ('changed', self.on_tvPrinterProperties_selection_changed)
         sel.set_mode (Gtk.SelectionMode.SINGLE)
 
+        # PPD option widgets are only created once their tab is shown.
+        self.pending_option_tabs = {}
+        self.pending_option_keywords = {}
+        self.ntbkPrinter.connect ('switch-page',
+                                  self.on_ntbkPrinter_switch_page)
+
         # Job Options widgets.
         for (widget,
              opts) in [(self.cmbJOOrientationRequested,
@@ -535,6 +546,7 @@ class PrinterPropertiesDialog(GtkGUI):
     def destroy (self):
         debugprint ("DESTROY: %s" % self)
         self._disconnect ()
+        self._cancel_ppd_fetch ()
         self.ppd = None
         self.ppd_local = None
         self.printer = None
@@ -642,6 +654,7 @@ class PrinterPropertiesDialog(GtkGUI):
 
         if ((response == Gtk.ResponseType.OK and not failed) or
             response == Gtk.ResponseType.CANCEL):
+            self._cancel_ppd_fetch ()
             self.ppd = None
             self.ppd_local = None
             self.printer = None
@@ -1166,7 +1179,7 @@ class PrinterPropertiesDialog(GtkGUI):
         # if we have a page size specific custom test page, use it;
         # otherwise use cups' default one
         custom_testpage = None
-        if self.ppd != False:
+        if self.ppd:
             opt = self.ppd.findOption ("PageSize")
             if opt:
                 custom_testpage = os.path.join(pkgdata,
@@ -1278,6 +1291,8 @@ class PrinterPropertiesDialog(GtkGUI):
         self.changed = set() # of options
         self.options = {} # keyword -> Option object
         self.conflicts = set() # of options
+        self.pending_option_tabs = {} # tab -> groups not yet shown
+        self.pending_option_keywords = {} # keyword -> tab
 
         if not host:
             host = cups.getServer()
@@ -1300,44 +1315,10 @@ class PrinterPropertiesDialog(GtkGUI):
 
         editable = not self.printer.discovered
 
-        try:
-            self.ppd = printer.getPPD()
-            self.ppd_local = printer.getPPD()
-            if self.ppd_local != False:
-                self.ppd_local.localize()
-        except cups.IPPError as e:
-            (e, m) = e.args
-            # We might get IPP_INTERNAL_ERROR if this is a memberless
-            # class.
-            if e != cups.IPP_INTERNAL_ERROR:
-                # Some IPP error other than IPP_NOT_FOUND.
-                show_IPP_Error(e, m, self.parent)
-
-            if e in [cups.IPP_SERVICE_UNAVAILABLE,
-                     cups.IPP_INTERNAL_ERROR]:
-                show_dialog(_("Raw Queue"),
-                            _("Unable to get queue details. Treating queue "
-                              "as raw."),
-                            Gtk.MessageType.ERROR,
-                            self.parent)
-
-            # Treat it as a raw queue.
-            self.ppd = False
-        except RuntimeError as e:
-            # Either the underlying cupsGetPPD2() function returned
-            # NULL without setting an IPP error (so it'll be something
-            # like a failed connection), or the PPD could not be parsed.
-            if str (e).startswith ("ppd"):
-                show_error_dialog (_("Error"),
-                                   _("The PPD file for this queue "
-                                     "is damaged."),
-                                   self.parent)
-            else:
-                show_error_dialog (_("Error"),
-                                   _("There was a problem connecting to "
-                                     "the CUPS server."),
-                                   self.parent)
-            raise
+        # The PPD may be large and the server remote, so fetch it in
+        # the background.  The options depending on it are filled in
+        # once it arrives.
+        self._fetch_ppd (name, host, encryption)
 
         for widget in (self.entPDescription, self.entPLocation,
                        self.entPDevice):
@@ -1478,6 +1459,142 @@ class PrinterPropertiesDialog(GtkGUI):
         self.updatePrinterProperties ()
         self.setDataButtonState()
 
+    def _fetch_ppd (self, name, host, encryption):
+        """
+        Start downloading the printer's PPD.  Until it arrives
+        self.ppd is None; the 'ppd-loaded' signal is emitted once it
+        has been handled (even if there was no PPD to fetch).
+        """
+        self._cancel_ppd_fetch ()
+        self.ppd = None
+        self.ppd_local = None
+        # Remember which queue to ask for: callers such as duplicate
+        # may rename self.printer before the connection is up.
+        self._ppd_name = name
+        self._ppd_conn = asyncconn.Connection (host=host,
+                                               encryption=encryption,
+                                               parent=self.dialog,
+                                               reply_handler=
+                                               self._ppd_connect_reply,
+                                               error_handler=self._got_ppd)
+
+    def _cancel_ppd_fetch (self):
+        if self._ppd_conn:
+            self._ppd_conn.destroy ()
+            self._ppd_conn = None
+
+    def _ppd_connect_reply (self, conn, UNUSED):
+        if conn is not self._ppd_conn:
+            return
+
+        conn.getPPD (self._ppd_name,
+                     reply_handler=self._got_ppd,
+                     error_handler=self._got_ppd)
+
+    def _got_ppd (self, conn, result):
+        if conn is not self._ppd_conn:
+            return
+
+        conn.destroy ()
+        self._ppd_conn = None
+        if not self.printer:
+            # Dialog closed meanwhile
+            return
+
+        # Parse the downloaded file twice: once for saving changes,
+        # and once localized for display.
+        try:
+            if isinstance (result, Exception):
+                raise result
+
+            try:
+                ppd = cups.PPD (result)
+                ppd_local = cups.PPD (result)
+            finally:
+                try:
+                    os.unlink (result)
+                except OSError:
+                    pass
+
+            ppd_local.localize ()
+            self.ppd = ppd
+            self.ppd_local = ppd_local
+        except cups.IPPError as e:
+            (e, m) = e.args
+            if e == cups.IPP_NOT_FOUND:
+                # Raw queue.
+                self.ppd = False
+                self.ppd_local = False
+            else:
+                # We might get IPP_INTERNAL_ERROR if this is a
+                # memberless class.
+                if e != cups.IPP_INTERNAL_ERROR:
+                    # Some IPP error other than IPP_NOT_FOUND.
+                    show_IPP_Error(e, m, self.parent)
+
+                if e in [cups.IPP_SERVICE_UNAVAILABLE,
+                         cups.IPP_INTERNAL_ERROR]:
+                    show_dialog(_("Raw Queue"),
+                                _("Unable to get queue details. Treating "
+                                  "queue as raw."),
+                                Gtk.MessageType.ERROR,
+                                self.parent)
+
+                # Treat it as a raw queue.
+                self.ppd = False
+        except RuntimeError as e:
+            # Either the underlying cupsGetPPD2() function returned
+            # NULL without setting an IPP error (so it'll be something
+            # like a failed connection), or the PPD could not be parsed.
+            if str (e).startswith ("ppd"):
+                show_error_dialog (_("Error"),
+                                   _("The PPD file for this queue "
+                                     "is damaged."),
+                                   self.parent)
+            else:
+                show_error_dialog (_("Error"),
+                                   _("There was a problem connecting to "
+                                     "the CUPS server."),
+                                   self.parent)
+
+            self.ppd = False
+
+        self._ppd_loaded ()
+
+    def _ppd_loaded (self):
+        """
+        Fill in the parts of the dialog that depend on the PPD.
+        """
+        printer = self.printer
+        editable = not printer.discovered
+        page = self.ntbkPrinter.get_nth_page (self.ntbkPrinter.
+                                              get_current_page ())
+        if self.ppd:
+            opt = self.ppd.findOption ("PageSize")
+            for option in self.job_options_widgets.values ():
+                if option.name == "media" and opt:
+                    # The 'system default' for media depends on the
+                    # printer's PageSize.
+                    option.set_default (opt.defchoice)
+                    if (option.name not in printer.attributes and
+                        option not in self.changed):
+                        option.reinit (None)
+
+        if not printer.is_class:
+            self.fillPrinterOptions(printer.name, editable)
+
+        self.updateMarkerLevels()
+        self.updatePrinterPropertiesTreeView()
+        page_nr = self.ntbkPrinter.page_num (page)
+        if page_nr != -1:
+            self.tvPrinterProperties.set_cursor (Gtk.TreePath(page_nr),
+                                                 None, False)
+
+        # The test page button depends on whether there is a PPD.
+        self.updatePrinterProperties ()
+        self.setDataButtonState()
+        self.emit ('ppd-loaded')
+
     def updatePrinterPropertiesTreeView (self):
         # Now update the tree view (which we use instead of the notebook tabs).
         store = Gtk.ListStore (str, int)
@@ -1564,7 +1681,7 @@ class PrinterPropertiesDialog(GtkGUI):
             for color, name, marker_type, level in markers:
                 if name is None:
                     name = ''
-                elif self.ppd != False:
+                elif self.ppd:
                     localized_name = self.ppd.localizeMarkerName(name)
                     if localized_name is not None:
                         name = localized_name
@@ -1607,7 +1724,9 @@ class PrinterPropertiesDialog(GtkGUI):
             else:
                 icon = statereason.StateReason.LEVEL_ICON[r.get_level ()]
             store.set_value (iter, 0, icon)
-            (title, text) = r.get_description ()
+            (title, text) = r.get_description (
+                lambda r, store=store, iter=iter:
+                    self.on_state_reason_localized (r, store, iter))
             store.set_value (iter, 1, text)
 
         self.tvPrinterStateReasons.set_model (store)
@@ -1617,6 +1736,14 @@ class PrinterPropertiesDialog(GtkGUI):
 
         self.ntbkPrinterStateReasons.set_current_page (page)
 
+    def on_state_reason_localized (self, reason, store, iter):
+        if self.tvPrinterStateReasons.get_model () is not store:
+            # The reasons have been updated since.
+            return
+
+        (title, text) = reason.get_description ()
+        store.set_value (iter, 1, text)
+
     def set_printer_state_reason_icon (self, column, cell, model, iter, *data):
         icon = model.get_value (iter, 0)
         theme = Gtk.IconTheme.get_default ()
@@ -1691,6 +1818,16 @@ class PrinterPropertiesDialog(GtkGUI):
         for widget in self.vbPOptions.get_children():
             self.vbPOptions.remove(widget)
 
+        self.pending_option_tabs = {}
+        self.pending_option_keywords = {}
+
+        # InputSlot and ManualFeed need special handling.  With
+        # libcups, if ManualFeed is True, InputSlot gets unset.
+        # Likewise, if InputSlot is set, ManualFeed becomes False.
+        # We handle it by toggling the sensitivity of InputSlot
+        # based on ManualFeed.
+        self.option_inputslot = self.option_manualfeed = None
+
         # insert Options Tab
         if self.ntbkPrinter.page_num(self.swPOptions) == -1:
             self.ntbkPrinter.insert_page(
@@ -1707,19 +1844,76 @@ class PrinterPropertiesDialog(GtkGUI):
         ppd = self.ppd
         ppd.markDefaults()
         self.ppd_local.markDefaults()
+        self.option_constraints = index_constraints (ppd)
+        self.option_tabs_editable = editable
 
         hasInstallableOptions = False
 
-        # build option tabs
+        # Sort the option groups into tabs.  The widgets for a tab
+        # are built the first time it is shown (see fillOptionTab).
+        pending_tabs = {}
+        pending_keywords = {}
         for group in self.ppd_local.optionGroups:
             if group.name == "InstallableOptions":
                 hasInstallableOptions = True
-                container = self.vbPInstallOptions
+                tab = self.swPInstallOptions
                 tab_nr = self.ntbkPrinter.page_num(self.swPInstallOptions)
                 if tab_nr == -1:
                     self.ntbkPrinter.insert_page(self.swPInstallOptions,
                                                  Gtk.Label(label=group.text),
                                                  self.static_tabs)
+            else:
+                tab = self.swPOptions
+
+            pending_tabs.setdefault (tab, []).append (group)
+            for option in group.options:
+                pending_keywords[option.keyword] = tab
+
+        self.pending_option_tabs = pending_tabs
+        self.pending_option_keywords = pending_keywords
+
+        # remove Installable Options tab if not needed
+        if not hasInstallableOptions:
+            tab_nr = self.ntbkPrinter.page_num(self.swPInstallOptions)
+            if tab_nr != -1:
+                self.ntbkPrinter.remove_page(tab_nr)
+
+        if ppd.conflicts ():
+            # The marked defaults conflict, so build every tab now
+            # to show where the conflicts are.
+            for tab in list (self.pending_option_tabs.keys ()):
+                self.fillOptionTab (tab)
+
+            # check for conflicts
+            for option in self.options.values():
+                conflicts = option.checkConflicts()
+                if conflicts:
+                    self.conflicts.add(option)
+        else:
+            page = self.ntbkPrinter.get_nth_page (self.ntbkPrinter.
+                                                  get_current_page ())
+            self.fillOptionTab (page)
+
+        self.swPInstallOptions.show_all()
+        self.swPOptions.show_all()
+
+    def fillOptionTab(self, tab):
+        """
+        Build the option widgets for one of the PPD option tabs, if
+        that has not been done yet.
+
+        @param tab: notebook page (swPOptions or swPInstallOptions)
+        """
+        groups = self.pending_option_tabs.pop (tab, None)
+        if groups is None:
+            return
+
+        debugprint ("Building option widgets for %d groups" % len (groups))
+        ppd = self.ppd
+        editable = self.option_tabs_editable
+        for group in groups:
+            if group.name == "InstallableOptions":
+                container = self.vbPInstallOptions
                 tab_label = self.lblPInstallOptions
             else:
                 group_name = ppdippstr.ppd.get (group.text)
@@ -1742,18 +1936,13 @@ class PrinterPropertiesDialog(GtkGUI):
 
             rows = 0
 
-            # InputSlot and ManualFeed need special handling.  With
-            # libcups, if ManualFeed is True, InputSlot gets unset.
-            # Likewise, if InputSlot is set, ManualFeed becomes False.
-            # We handle it by toggling the sensitivity of InputSlot
-            # based on ManualFeed.
-            self.option_inputslot = self.option_manualfeed = None
-
             for nr, option in enumerate(group.options):
+                self.pending_option_keywords.pop (option.keyword, None)
                 if option.keyword == "PageRegion":
                     continue
                 rows += 1
-                o = OptionWidget(option, ppd, self, tab_label=tab_label)
+                o = OptionWidget(option, ppd, self, tab_label=tab_label,
+                                 constraints=self.option_constraints)
                 grid.attach(o.conflictIcon, 0, nr, 1, 1)
 
                 hbox = Gtk.Box()
@@ -1773,20 +1962,28 @@ class PrinterPropertiesDialog(GtkGUI):
                 elif option.keyword == "ManualFeed":
                     self.option_manualfeed = o
 
-        # remove Installable Options tab if not needed
-        if not hasInstallableOptions:
-            tab_nr = self.ntbkPrinter.page_num(self.swPInstallOptions)
-            if tab_nr != -1:
-                self.ntbkPrinter.remove_page(tab_nr)
+        if (self.option_manualfeed and self.option_inputslot and
+            self.option_manualfeed.get_current_value () == "True"):
+            self.option_inputslot.disable ()
 
-        # check for conflicts
-        for option in self.options.values():
-            conflicts = option.checkConflicts()
-            if conflicts:
-                self.conflicts.add(option)
+        tab.show_all ()
 
-        self.swPInstallOptions.show_all()
-        self.swPOptions.show_all()
+    def get_option_widget(self, keyword):
+        """
+        Find the widget for a PPD option, building its tab first if
+        it has not been shown yet.
+
+        @param keyword: PPD option keyword
+        @returns: Option widget, or None if there is none
+        """
+        tab = self.pending_option_keywords.get (keyword)
+        if tab is not None:
+            self.fillOptionTab (tab)
+
+        return self.options.get (keyword)
+
+    def on_ntbkPrinter_switch_page (self, notebook, page, page_num):
+        self.fillOptionTab (page)
 
     # Class members
 
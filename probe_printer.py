@@ -27,6 +27,8 @@ from gi.repository import Gtk
 from timedops import TimedOperation
 import subprocess
 import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import wait as wait_for_futures
 import cups
 from gi.repository import GObject
 from gi.repository import GLib
@@ -41,6 +43,29 @@ except:
         class AuthContext:
             pass
 
+# How long, in seconds, to spend probing any one host.
+HOST_PROBE_TIMEOUT = 60
+
+# How many hosts find_many() probes at the same time.
+FIND_MANY_PARALLEL = 8
+
+# Politeness limit for LPD probing: connections per second to any one
+# host, and how many connections may be made in a burst.
+LPD_PROBE_RATE = 10
+LPD_PROBE_BURST = 3
+
+# Give up on an LPD server after this many consecutive failed
+# exchanges, as it has probably stopped talking to us.
+LPD_MAX_ERRORS = 3
+
+# How long, in seconds, to remember the queues found on a host.
+LPD_CACHE_TTL = 300
+
+# How long, in seconds, to remember what SNMP said about a host, and
+# how many SNMP queries may run at once.
+SNMP_CACHE_TTL = 300
+SNMP_WORKERS = 4
+
 def wordsep (line):
     words = []
     escaped = False
@@ -120,11 +145,243 @@ def open_socket(hostname, port):
         break
     return s
 
+def _run_snmp_backend (hostname):
+    """
+    Run the CUPS SNMP backend, pointing it at the host.
+
+    @returns: list of the words on each line of output, or None if
+    the backend failed
+    """
+    try:
+        debugprint ("snmp: querying %s" % hostname)
+        p = subprocess.Popen (args=["/usr/lib/cups/backend/snmp",
+                                    hostname],
+                              close_fds=True,
+                              stdin=subprocess.DEVNULL,
+                              stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL)
+    except OSError as e:
+        debugprint ("snmp: no good")
+        if e.errno == errno.ENOENT:
+            return None
+
+        raise
+
+    (stdout, stderr) = p.communicate ()
+    if p.returncode != 0:
+        debugprint ("snmp: no good (return code %d)" % p.returncode)
+        return None
+
+    try:
+        output = stdout.decode ('utf-8')
+    except UnicodeDecodeError:
+        # Work-around snmp backend output encoded as iso-8859-1
+        # (despite RFC 2571).  If it's neither iso-8859-1, make a
+        # best guess by ignoring problematic bytes.
+        output = stdout.decode (encoding='iso-8859-1', errors='ignore')
+
+    return [wordsep (line) for line in output.strip ().split ('\n')]
+
+class SnmpQueryService:
+    """
+    Query hosts with the CUPS SNMP backend on a pool of worker
+    threads, remembering the answers (including failures) for a
+    while.
+    """
+
+    def __init__ (self, ttl=SNMP_CACHE_TTL, max_workers=SNMP_WORKERS):
+        self.ttl = ttl
+        self.max_workers = max_workers
+        self._lock = threading.Lock ()
+        self._cache = dict()
+        self._pending = dict()
+        self._executor = None
+
+    def _query (self, hostname):
+        try:
+            result = _run_snmp_backend (hostname)
+        except Exception:
+            nonfatalException ()
+            result = None
+
+        with self._lock:
+            self._cache[hostname] = (result, time.monotonic () + self.ttl)
+            self._pending.pop (hostname, None)
+
+        return result
+
+    def _cached (self, hostname):
+        # Must be called with the lock held.
+        entry = self._cache.get (hostname)
+        if entry is None:
+            return False, None
+
+        (result, expires) = entry
+        if expires < time.monotonic ():
+            del self._cache[hostname]
+            return False, None
+
+        return True, result
+
+    def get_cached (self, hostname):
+        """
+        @returns: (found, result) tuple, where result is as for
+        query()
+        """
+        with self._lock:
+            return self._cached (hostname)
+
+    def query (self, hostname):
+        """
+        Query a host, blocking until the answer is known.
+
+        @param hostname: host name or address
+        @type hostname: string
+        @returns: list of the words on each line of the SNMP
+        backend's output, or None if it failed
+        """
+        with self._lock:
+            (found, result) = self._cached (hostname)
+            if found:
+                return result
+
+            future = self._pending.get (hostname)
+            if future is None:
+                # Run the query in this thread, letting others wait
+                # for it.
+                mine = Future ()
+                self._pending[hostname] = mine
+
+        if future is not None:
+            return future.result ()
+
+        result = self._query (hostname)
+        mine.set_result (result)
+        return result
+
+    def query_async (self, hostname, reply_handler):
+        """
+        Query a host in the background.
+
+        @param hostname: host name or address
+        @type hostname: string
+        @param reply_handler: function called from the main loop
+        with the host name and the result, as for query()
+        @type reply_handler: function
+        """
+        def deliver (result):
+            reply_handler (hostname, result)
+            return False
+
+        with self._lock:
+            (found, result) = self._cached (hostname)
+            if not found:
+                future = self._pending.get (hostname)
+                if future is None:
+                    if self._executor is None:
+                        self._executor = ThreadPoolExecutor (
+                            max_workers=self.max_workers)
+
+                    future = self._executor.submit (self._query, hostname)
+                    self._pending[hostname] = future
+
+        if found:
+            GLib.idle_add (deliver, result)
+        else:
+            future.add_done_callback (lambda f:
+                                          GLib.idle_add (deliver, f.result ()))
+
+    def clear (self):
+        """
+        Forget all remembered answers.
+        """
+        with self._lock:
+            self._cache.clear ()
+
+_snmp_service = SnmpQueryService ()
+
+def get_snmp_service ():
+    """
+    @returns: the SnmpQueryService shared by all callers
+    """
+    return _snmp_service
+
+class TokenBucket:
+    """
+    Limit the rate of some operation, allowing short bursts.
+    """
+
+    def __init__ (self, rate, burst=1):
+        """
+        @param rate: operations allowed per second
+        @type rate: number
+        @param burst: operations allowed at once
+        @type burst: int
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._last = time.monotonic ()
+        self._lock = threading.Lock ()
+
+    def take (self, should_stop=None):
+        """
+        Wait until an operation is allowed.
+
+        @param should_stop: function returning True to stop waiting
+        @type should_stop: function
+        @returns: True if allowed, False if should_stop said to stop
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic ()
+                self._tokens = min (self.burst,
+                                    self._tokens +
+                                    (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+
+                delay = (1 - self._tokens) / self.rate
+
+            if should_stop and should_stop ():
+                return False
+
+            time.sleep (min (delay, 0.1))
+
+_lpd_buckets = dict()
+_lpd_results = dict()
+_lpd_lock = threading.Lock ()
+
+def _get_lpd_bucket (hostname):
+    with _lpd_lock:
+        try:
+            return _lpd_buckets[hostname]
+        except KeyError:
+            bucket = TokenBucket (LPD_PROBE_RATE, LPD_PROBE_BURST)
+            _lpd_buckets[hostname] = bucket
+            return bucket
+
+def forget_lpd_queues (hostname=None):
+    """
+    Discard remembered LPD probe results.
+
+    @param hostname: host to forget, or None for all hosts
+    @type hostname: string
+    """
+    with _lpd_lock:
+        if hostname is None:
+            _lpd_results.clear ()
+        else:
+            _lpd_results.pop (hostname, None)
+
 class LpdServer:
     def __init__(self, hostname):
         self.hostname = hostname
         self.max_lpt_com = 8
         self.stop = False
+        self.consecutive_errors = 0
 
     def probe_queue(self,name, result):
         s = open_socket(self.hostname, 515)
@@ -136,8 +393,10 @@ class LpdServer:
             s.send(('\2%s\n' % name).encode('UTF-8'))  # cmd send job to queue
             data = s.recv(1024).decode('UTF-8')  # receive status
             debugprint(repr(data))
+            self.consecutive_errors = 0
         except socket.error as msg:
             debugprint(msg)
+            self.consecutive_errors += 1
             try:
                 s.close ()
             except:
@@ -178,26 +437,73 @@ class LpdServer:
         debugprint ("LpdServer exiting: destroy called")
         self.stop = True
 
-    def probe(self):
+    def find_queues (self, found_fn=None, should_stop=None):
+        """
+        Find the queues on the server.  This blocks, so should not
+        be called from the main loop.  Connections to each host are
+        rate-limited, and the results for a host are remembered for
+        LPD_CACHE_TTL seconds.
+
+        @param found_fn: function to call with each queue name as it
+        is found
+        @type found_fn: function
+        @param should_stop: function returning True to give up
+        @type should_stop: function
+        @returns: list of queue names
+        """
+        def stopping ():
+            return self.stop or (should_stop is not None and should_stop ())
+
+        with _lpd_lock:
+            cached = _lpd_results.get (self.hostname)
+
+        if cached is not None and cached[1] > time.monotonic ():
+            debugprint ("lpd: using cached queues for %s" % self.hostname)
+            result = list (cached[0])
+            if found_fn:
+                for name in result:
+                    found_fn (name)
+
+            return result
+
+        bucket = _get_lpd_bucket (self.hostname)
         result = []
+        complete = True
         for name in self.get_possible_queue_names ():
-            while Gtk.events_pending ():
-                Gtk.main_iteration ()
-
-            if self.stop:
+            if stopping () or not bucket.take (stopping):
+                complete = False
                 break
 
-            found = self.probe_queue(name, result)
+            found = self.probe_queue (name, result)
             if found is None:
-                # Couldn't even connect.
+                # Couldn't even connect.  It may be switched off, so
+                # don't remember that.
+                complete = False
                 break
 
+            if found and found_fn:
+                found_fn (name)
+
             if not found and name.startswith ("pr"):
                 break
-            time.sleep(0.1) # avoid DOS and following counter measures 
+
+            if self.consecutive_errors >= LPD_MAX_ERRORS:
+                # It has stopped talking to us.
+                debugprint ("lpd: giving up on %s" % self.hostname)
+                break
+
+        if complete:
+            with _lpd_lock:
+                _lpd_results[self.hostname] = (list (result),
+                                               time.monotonic () +
+                                               LPD_CACHE_TTL)
 
         return result
 
+    def probe(self):
+        # Run the search in a thread while the main loop carries on.
+        return TimedOperation (self.find_queues).run ()
+
 class BackgroundSmbAuthContext(pysmb.AuthContext):
     """An SMB AuthContext class that is only ever run from
     a non-GUI thread."""
@@ -225,76 +531,166 @@ class BackgroundSmbAuthContext(pysmb.AuthContext):
         return self._do_perform_authentication_result
 
 class PrinterFinder:
-    def __init__ (self):
+    """
+    Find printers on a network host by probing it in several ways
+    (HPLIP, JetDirect, IPP, SNMP, LPD and SMB) at once.
+
+    Each device found is passed to callback_fn as soon as it is
+    found, from a background thread; when the search is over
+    callback_fn is called with None.
+    """
+
+    def __init__ (self, timeout=HOST_PROBE_TIMEOUT):
+        """
+        @param timeout: seconds to spend probing each host
+        @type timeout: number
+        """
         self.quit = False
+        self.timeout = timeout
+        self._deadline = None
+        self._finished = False
+        self._lock = threading.Lock ()
+        self._snmp_done = threading.Event ()
+        self._children = []
 
     def find (self, hostname, callback_fn):
         self.hostname = hostname
         self.callback_fn = callback_fn
         self.op = TimedOperation (self._do_find, callback=lambda x, y: None)
 
+    def find_many (self, hosts, callback_fn, max_parallel=FIND_MANY_PARALLEL):
+        """
+        Find printers on several hosts, for example to sweep a
+        subnet, probing at most max_parallel hosts at a time.
+
+        @param hosts: host names or addresses to probe
+        @type hosts: list of strings
+        @param callback_fn: function called with each device found,
+        then with None once every host has been probed
+        @type callback_fn: function
+        @param max_parallel: how many hosts to probe at once
+        @type max_parallel: int
+        """
+        self.hostname = None
+        self.callback_fn = callback_fn
+        self.op = TimedOperation (self._do_find_many,
+                                  args=(list (hosts), max_parallel),
+                                  callback=lambda x, y: None)
+
     def cancel (self):
         self.op.cancel ()
         self.quit = True
+        for child in self._children:
+            child.quit = True
+
+    def _should_stop (self):
+        return (self.quit or
+                (self._deadline is not None and
+                 time.monotonic () > self._deadline))
+
+    def _report (self, device):
+        with self._lock:
+            if self._finished or self.quit:
+                return
+
+            self.callback_fn (device)
+
+    def _finish (self):
+        with self._lock:
+            self._finished = True
+            if not self.quit:
+                # Signal that we've finished.
+                self.callback_fn (None)
 
     def _do_find (self):
-        self._cached_attributes = dict()
-        for fn in [self._probe_hplip,
-                   self._probe_jetdirect,
-                   self._probe_ipp,
-                   self._probe_snmp,
-                   self._probe_lpd,
-                   self._probe_smb]:
+        self._find_host ()
+        self._finish ()
+
+    def _do_find_many (self, hosts, max_parallel):
+        def find_host (hostname):
             if self.quit:
                 return
 
+            child = self.__class__ (timeout=self.timeout)
+            child.hostname = hostname
+            child.callback_fn = self._report
+            with self._lock:
+                self._children.append (child)
+
+            child._find_host ()
+            with self._lock:
+                self._children.remove (child)
+
+        with ThreadPoolExecutor (max_workers=max_parallel) as executor:
+            for future in [executor.submit (find_host, host)
+                           for host in hosts]:
+                try:
+                    future.result ()
+                except Exception:
+                    nonfatalException ()
+
+        self._finish ()
+
+    def _find_host (self):
+        # Run each kind of probe in its own thread, giving up on
+        # any that are still running once the deadline passes.
+        self._cached_attributes = dict()
+        self._deadline = time.monotonic () + self.timeout
+        self._snmp_done.clear ()
+        def run (fn):
+            if self._should_stop ():
+                return
+
             try:
                 fn ()
             except Exception:
                 nonfatalException ()
+            finally:
+                if fn == self._probe_snmp:
+                    self._snmp_done.set ()
+
+        probes = [self._probe_hplip,
+                  self._probe_jetdirect,
+                  self._probe_ipp,
+                  self._probe_snmp,
+                  self._probe_lpd,
+                  self._probe_smb]
+        executor = ThreadPoolExecutor (max_workers=len (probes))
+        futures = [executor.submit (run, fn) for fn in probes]
+        executor.shutdown (wait=False)
+        wait_for_futures (futures, timeout=self.timeout)
+        debugprint ("%s: finished probing" % self.hostname)
+
+    def _wait_for_snmp (self):
+        # Devices found by LPD and SMB get the make and model
+        # discovered by SNMP, so wait for that to finish first.
+        if self._deadline is None:
+            return
 
-        # Signal that we've finished.
-        if not self.quit:
-            self.callback_fn (None)
+        self._snmp_done.wait (max (0, self._deadline - time.monotonic ()))
 
     def _new_device (self, uri, info, location = None):
         device_dict = { 'device-class': 'network',
                         'device-info': "%s" % info }
         if location:
             device_dict['device-location']=location
-        device_dict.update (self._cached_attributes)
+        with self._lock:
+            device_dict.update (self._cached_attributes)
         new_device = cupshelpers.Device (uri, **device_dict)
         debugprint ("Device found: %s" % uri)
-        self.callback_fn (new_device)
+        self._report (new_device)
 
     def _probe_snmp (self):
-        # Run the CUPS SNMP backend, pointing it at the host.
-        try:
-            debugprint ("snmp: trying")
-            p = subprocess.Popen (args=["/usr/lib/cups/backend/snmp",
-                                        self.hostname],
-                                  close_fds=True,
-                                  stdin=subprocess.DEVNULL,
-                                  stdout=subprocess.PIPE,
-                                  stderr=subprocess.DEVNULL)
-        except OSError as e:
-            debugprint ("snmp: no good")
-            if e.errno == errno.ENOENT:
-                return
-
-            raise
-
-        (stdout, stderr) = p.communicate ()
-        if p.returncode != 0:
-            debugprint ("snmp: no good (return code %d)" % p.returncode)
+        debugprint ("snmp: trying")
+        lines = get_snmp_service ().query (self.hostname)
+        if lines is None:
             return
 
-        if self.quit:
+        if self._should_stop ():
             debugprint ("snmp: no good")
             return
 
-        for line in stdout.decode ().split ('\n'):
-            words = wordsep (line)
+        for words in lines:
             n = len (words)
             if n == 6:
                 (device_class, uri, make_and_model,
@@ -318,38 +714,26 @@ class PrinterFinder:
 
             device = cupshelpers.Device (uri, **device_dict)
             debugprint ("Device found: %s" % uri)
-            self.callback_fn (device)
+            self._report (device)
 
             # Cache the make and model for use by other search methods
             # that are not able to determine it.
-            self._cached_attributes['device-make-and-model'] = make_and_model
-            self._cached_attributes['device_id'] = device_id
+            with self._lock:
+                self._cached_attributes['device-make-and-model'] = \
+                    make_and_model
+                self._cached_attributes['device_id'] = device_id
 
         debugprint ("snmp: done")
 
     def _probe_lpd (self):
         debugprint ("lpd: trying")
         lpd = LpdServer (self.hostname)
-        for name in lpd.get_possible_queue_names ():
-            if self.quit:
-                debugprint ("lpd: no good")
-                return
-
-            found = lpd.probe_queue (name, [])
-            if found is None:
-                # Couldn't even connect.
-                debugprint ("lpd: couldn't connect")
-                break
-
-            if found:
-                uri = "lpd://%s/%s" % (self.hostname, name)
-                self._new_device(uri, self.hostname)
-
-            if not found and name.startswith ("pr"):
-                break
-
-            time.sleep(0.1) # avoid DOS and following counter measures 
+        def found (name):
+            uri = "lpd://%s/%s" % (self.hostname, name)
+            self._wait_for_snmp ()
+            self._new_device(uri, self.hostname)
 
+        lpd.find_queues (found_fn=found, should_stop=self._should_stop)
         debugprint ("lpd: done")
 
     def _probe_hplip (self):
@@ -379,7 +763,7 @@ class PrinterFinder:
             debugprint ("hplip: no good (return code %d)" % p.returncode)
             return
 
-        if self.quit:
+        if self._should_stop ():
             debugprint ("hplip: no good")
             return
 
@@ -405,7 +789,7 @@ class PrinterFinder:
         debugprint ("smb: trying")
         try:
             while smbc_auth.perform_authentication () > 0:
-                if self.quit:
+                if self._should_stop ():
                     debugprint ("smb: no good")
                     return
 
@@ -420,10 +804,11 @@ class PrinterFinder:
         except:
             nonfatalException ()
 
-        if self.quit:
+        if self._should_stop ():
             debugprint ("smb: no good")
             return
 
+        self._wait_for_snmp ()
         for entry in entries:
             if entry.smbc_type == pysmb.smbc.PRINTER_SHARE:
                 uri = "smb://%s/%s" % (smburi.urlquote (self.hostname),
@@ -496,7 +881,7 @@ class PrinterFinder:
 if __name__ == '__main__':
     import sys
     if len (sys.argv) < 2:
-        print("Need printer address")
+        print("Need printer address(es)")
         sys.exit (1)
 
     set_debugging (True)
@@ -506,7 +891,9 @@ if __name__ == '__main__':
         if device is None:
             loop.quit ()
 
-    addr = sys.argv[1]
     p = PrinterFinder ()
-    p.find (addr, display)
+    if len (sys.argv) > 2:
+        p.find_many (sys.argv[1:], display)
+    else:
+        p.find (sys.argv[1], display)
     loop.run ()
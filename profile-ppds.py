@@ -1,13 +1,329 @@
 #!/usr/bin/python3
-import cups
+
+## profile-ppds
+
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+# Benchmark the cupshelpers.ppds driver matching code.  By default
+# this runs against generated PPD lists of 1000, 10000 and 50000
+# entries, so no CUPS server is needed and results can be compared
+# between runs.  A PPD list recorded from a real server (for instance
+# the pickled-ppds file written by test_ppds.py) can be used instead.
+
 import cupshelpers
-import hotshot
-import hotshot.stats
-
-ppds = cupshelpers.ppds.PPDs (cups.Connection ().getPPDs ())
-prof = hotshot.Profile ("a.prof")
-prof.runcall (lambda: ppds.getPPDNameFromDeviceID('','',''))
-prof.close ()
-stats = hotshot.stats.load ("a.prof")
-stats.sort_stats ('time')
-stats.print_stats (100)
+from cupshelpers.ppds import PPDs
+import getopt
+import os
+import pickle
+import random
+import sys
+import time
+import tracemalloc
+
+DEFAULT_SIZES = [1000, 10000, 50000]
+DEFAULT_QUERIES = 500
+DEFAULT_SEED = 1
+
+MAKES = {
+    "HP": ["LaserJet", "Color LaserJet", "DeskJet", "OfficeJet",
+           "Photosmart", "PSC", "DesignJet"],
+    "Epson": ["Stylus", "Stylus Photo", "AcuLaser", "WorkForce"],
+    "Canon": ["PIXMA iP", "PIXMA MG", "imageRUNNER", "LBP", "i-SENSYS MF"],
+    "Brother": ["HL-", "DCP-", "MFC-"],
+    "Xerox": ["Phaser", "WorkCentre", "DocuPrint"],
+    "Ricoh": ["Aficio", "Aficio MP C"],
+    "Lexmark": ["Optra", "E", "X"],
+    "Kyocera": ["FS-", "TASKalfa"],
+    "KONICA MINOLTA": ["magicolor", "bizhub C"],
+    "Samsung": ["ML-", "CLP-", "SCX-"],
+    "Oki": ["C", "B", "MicroLine"],
+    }
+
+GENERIC_MODELS = ["PCL 6/PCL XL Printer", "PostScript Printer",
+                  "PCL 5e Printer", "PCL 5c Printer", "PCL 5 Printer",
+                  "PCL 3 Printer", "PCL Laser Printer",
+                  "ESC/P Dot Matrix Printer", "text-only printer"]
+
+DRIVERS = [("drv:///hpcups.drv/", "hpcups 3.22.10"),
+           ("foomatic:", "Foomatic/hpijs"),
+           ("foomatic:", "Foomatic/pxlcolor"),
+           ("foomatic:", "Foomatic/Postscript"),
+           ("lsb/usr/", "Postscript (recommended)"),
+           ("gutenprint.5.3://", "- CUPS+Gutenprint v5.3.4"),
+           ("gutenprint.5.3://", "- CUPS+Gutenprint v5.3.4 Simplified"),
+           ("drv:///sample.drv/", "pcl3")]
+
+COMMAND_SETS = ["PJL,PCL,POSTSCRIPT", "PJL,PCLXL,PCL", "ESCPL2,BDC",
+                "BJL,BJRaster3,BSCCe", "POSTSCRIPT", ""]
+
+LANGUAGES = ["en", "en", "en", "en", "de", "fr", "ja"]
+
+def generate_ppds (size, seed=DEFAULT_SEED):
+    """
+    Generate a PPD list in the format returned by
+    cups.Connection.getPPDs2().  The same size and seed always give
+    the same list.
+    """
+    r = random.Random (seed)
+    makes = sorted (MAKES.keys ())
+    ppds = {}
+    n = 0
+    while len (ppds) < size:
+        if r.random () < 0.02:
+            make = "Generic"
+            model = r.choice (GENERIC_MODELS)
+        else:
+            make = r.choice (makes)
+            family = r.choice (MAKES[make])
+            if not family.endswith ("-"):
+                family += " "
+
+            model = "%s%d%s" % (family, r.randint (1, 9999),
+                                r.choice (["", "", "", " Series", "dn",
+                                           "n", " Plus"]))
+
+        (scheme, driver) = r.choice (DRIVERS)
+        makemodel = "%s %s %s" % (make, model, driver)
+        ppdname = "%s%s-%d.ppd" % (scheme, makemodel.replace (" ", "_"), n)
+        n += 1
+        ppd = { 'ppd-make': [make],
+                'ppd-make-and-model': [makemodel],
+                'ppd-natural-language': [r.choice (LANGUAGES)],
+                'ppd-type': [r.choice (["postscript", "pdf", "raster",
+                                        "unknown"])] }
+        if make != "Generic" and r.random () < 0.6:
+            mfg = make
+            if make == "HP" and r.random () < 0.5:
+                mfg = "Hewlett-Packard"
+
+            devid = "MFG:%s;MDL:%s;" % (mfg, model)
+            cmd = r.choice (COMMAND_SETS)
+            if cmd:
+                devid += "CMD:%s;" % cmd
+
+            ppd['ppd-device-id'] = [devid]
+
+        if r.random () < 0.2:
+            ppd['ppd-product'] = ["(%s %s)" % (make, model), "(%s)" % model]
+
+        ppds[ppdname] = ppd
+
+    ppds['raw'] = { 'ppd-make': ['Raw'],
+                    'ppd-make-and-model': ['Raw Queue'],
+                    'ppd-natural-language': ['en'] }
+    return ppds
+
+def generate_queries (ppds, count, seed=DEFAULT_SEED):
+    """
+    Generate Device IDs to match against a PPD list.  Some match a
+    PPD's Device ID exactly, some only a PPD's make and model, some
+    are near misses, and the rest are unknown models that fall back to
+    a generic driver.
+
+    @returns: a list of (MFG, MDL, DES, CMD, URI,
+    device-make-and-model) tuples, as for
+    PPDs.getPPDNamesFromDeviceIDs()
+    """
+    r = random.Random (seed)
+    ppdnames = sorted (ppds.keys ())
+    queries = []
+    while len (queries) < count:
+        ppd = ppds[r.choice (ppdnames)]
+        makemodel = ppd['ppd-make-and-model'][0]
+        (make, model) = cupshelpers.ppds.ppdMakeModelSplit (makemodel)
+        kind = r.random ()
+        cmd = r.choice (COMMAND_SETS)
+        if kind < 0.3 and 'ppd-device-id' in ppd:
+            id_dict = cupshelpers.parseDeviceID (ppd['ppd-device-id'][0])
+            (make, model, cmd) = (id_dict["MFG"], id_dict["MDL"],
+                                  ",".join (id_dict["CMD"]))
+        elif kind < 0.6:
+            pass
+        elif kind < 0.8:
+            model += " %s" % r.choice (["Series", "Pro", "dtn", "II"])
+        else:
+            model = "Unknown %d" % r.randint (1, 9999)
+
+        uri = r.choice (["usb://%s/%s" % (make, model.replace (" ", "%20")),
+                         "socket://192.168.0.%d" % r.randint (1, 254),
+                         "ipp://printer-%d.local/ipp/print" % len (queries)])
+        queries.append ((make, model, "%s %s" % (make, model),
+                         [c for c in cmd.split (",") if c],
+                         uri, "%s %s" % (make, model)))
+
+    return queries
+
+def _benchmark (cupsppds, queries, xml_dir, cache_dir):
+    """
+    Run each entry point once.
+
+    @returns: list of (stage name, seconds, items) tuples
+    """
+    stages = []
+    start = time.perf_counter ()
+    ppds = PPDs (cupsppds, xml_dir=xml_dir, cache_dir=cache_dir)
+    stages.append (("PPDs.__init__", time.perf_counter () - start,
+                    len (cupsppds)))
+
+    start = time.perf_counter ()
+    makes = ppds.getMakes ()
+    stages.append (("getMakes", time.perf_counter () - start, len (makes)))
+
+    start = time.perf_counter ()
+    for make in makes:
+        ppds.getModels (make)
+    stages.append (("getModels", time.perf_counter () - start, len (makes)))
+
+    fits = []
+    start = time.perf_counter ()
+    for (mfg, mdl, des, cmd, uri, makemodel) in queries:
+        fits.append (ppds.getPPDNamesFromDeviceID (mfg, mdl, des, cmd,
+                                                   uri, makemodel))
+    stages.append (("getPPDNamesFromDeviceID",
+                    time.perf_counter () - start, len (queries)))
+
+    start = time.perf_counter ()
+    for (fit, query) in zip (fits, queries):
+        devid = { "MFG": query[0], "MDL": query[1],
+                  "DES": query[2], "CMD": query[3] }
+        ppds.orderPPDNamesByPreference (list (fit.keys ()),
+                                        make_and_model=query[5],
+                                        devid=devid, fit=fit)
+    stages.append (("orderPPDNamesByPreference",
+                    time.perf_counter () - start, len (queries)))
+
+    start = time.perf_counter ()
+    ppds.getPPDNamesFromDeviceIDs (queries)
+    stages.append (("getPPDNamesFromDeviceIDs",
+                    time.perf_counter () - start, len (queries)))
+    return stages
+
+def run (name, cupsppds, queries, xml_dir, cache_dir):
+    print ("%s: %d PPDs, %d queries" % (name, len (cupsppds), len (queries)))
+    stages = _benchmark (cupsppds, queries, xml_dir, cache_dir)
+
+    # Measure memory in a separate run, as tracing slows everything
+    # down.
+    tracemalloc.start ()
+    _benchmark (cupsppds, queries, xml_dir, cache_dir)
+    (current, peak) = tracemalloc.get_traced_memory ()
+    tracemalloc.stop ()
+
+    for (stage, secs, items) in stages:
+        if secs > 0:
+            rate = "%12.0f/s" % (items / secs)
+        else:
+            rate = "%14s" % "-"
+
+        print ("  %-28s %9.3fs %s" % (stage, secs, rate))
+
+    print ("  %-28s %9.1fMB" % ("peak memory", peak / (1024.0 * 1024)))
+
+def usage ():
+    print ("Usage: profile-ppds [--size N]... [--corpus FILE] "
+           "[--save FILE]\n"
+           "                    [--queries N] [--seed N] "
+           "[--cache-dir DIR] [--profile]\n"
+           "\n"
+           "  --size N         generate a PPD list with N entries "
+           "(default: %s)\n"
+           "  --corpus FILE    use a pickled PPD list, e.g. "
+           "test_ppds.py's pickled-ppds\n"
+           "  --save FILE      save the (last) generated PPD list and "
+           "exit\n"
+           "  --queries N      number of Device IDs to match "
+           "(default: %d)\n"
+           "  --seed N         random seed (default: %d)\n"
+           "  --cache-dir DIR  use an on-disk index in DIR (default: "
+           "none)\n"
+           "  --profile        show a profile of the matching code" %
+           (",".join (map (str, DEFAULT_SIZES)), DEFAULT_QUERIES,
+            DEFAULT_SEED))
+
+def main ():
+    try:
+        (opts, args) = getopt.getopt (sys.argv[1:], "h",
+                                      ["help", "size=", "corpus=",
+                                       "save=", "queries=", "seed=",
+                                       "cache-dir=", "profile",
+                                       "debug"])
+    except getopt.GetoptError:
+        usage ()
+        sys.exit (1)
+
+    sizes = []
+    corpus = None
+    save = None
+    nqueries = DEFAULT_QUERIES
+    seed = DEFAULT_SEED
+    cache_dir = ""
+    profile = False
+    for (opt, optarg) in opts:
+        if opt in ("-h", "--help"):
+            usage ()
+            sys.exit (0)
+        elif opt == "--size":
+            sizes.append (int (optarg))
+        elif opt == "--corpus":
+            corpus = optarg
+        elif opt == "--save":
+            save = optarg
+        elif opt == "--queries":
+            nqueries = int (optarg)
+        elif opt == "--seed":
+            seed = int (optarg)
+        elif opt == "--cache-dir":
+            cache_dir = optarg
+        elif opt == "--profile":
+            profile = True
+        elif opt == "--debug":
+            def debugprint (x):
+                print (x)
+            cupshelpers.set_debugprint_fn (debugprint)
+
+    xml_dir = os.path.join (os.environ.get ("top_srcdir",
+                                            os.path.dirname (__file__)),
+                            "xml")
+    if corpus:
+        with open (corpus, "rb") as f:
+            corpora = [(os.path.basename (corpus), pickle.load (f))]
+    else:
+        if not sizes:
+            sizes = DEFAULT_SIZES
+
+        corpora = [("generated", generate_ppds (size, seed))
+                   for size in sizes]
+
+    if save:
+        with open (save, "wb") as f:
+            pickle.dump (corpora[-1][1], f)
+        return
+
+    for (name, cupsppds) in corpora:
+        queries = generate_queries (cupsppds, nqueries, seed)
+        if profile:
+            import cProfile
+            import pstats
+            ppds = PPDs (cupsppds, xml_dir=xml_dir, cache_dir=cache_dir)
+            prof = cProfile.Profile ()
+            prof.runcall (ppds.getPPDNamesFromDeviceIDs, queries)
+            stats = pstats.Stats (prof)
+            stats.sort_stats ('time')
+            stats.print_stats (40)
+        else:
+            run (name, cupsppds, queries, xml_dir, cache_dir)
+
+if __name__ == '__main__':
+    main ()
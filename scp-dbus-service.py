@@ -26,7 +26,9 @@ from gi.repository import GObject
 from gi.repository import GLib
 gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk
+import hashlib
 import sys
+import time
 
 from debug import *
 import asyncconn
@@ -53,6 +55,10 @@ CONFIG_JOBVIEWER_IFACE=CONFIG_IFACE + ".JobViewer"
 g_ppds = None
 g_killtimer = None
 
+# How long, in seconds, to use the list of PPDs before checking CUPS
+# for changes again, e.g. newly installed drivers.
+PPDS_REVALIDATE_INTERVAL = 300
+
 #set program name
 GLib.set_prgname("system-config-printer")
 
@@ -68,6 +74,10 @@ class FetchedPPDs(GObject.GObject):
         self._cupsconn = cupsconn
         self._language = language
         self._ppds = None
+        self._key = None
+        self._fetching = False
+        self._checked = None
+        self._generation = 0
 
     def is_ready (self):
         return self._ppds is not None
@@ -75,21 +85,164 @@ class FetchedPPDs(GObject.GObject):
     def get_ppds (self):
         return self._ppds
 
-    def run (self):
+    def run (self, revalidate=False):
+        """
+        Fetch the list of PPDs from CUPS.
+
+        @param revalidate: whether to keep using the current list (or
+        the one saved by a previous instance of this service) while
+        checking whether CUPS has any new PPDs
+        @type revalidate: bool
+        """
+        if revalidate:
+            if self._ppds is None:
+                result = cupshelpers.ppds.loadPPDsSnapshot ()
+                if result:
+                    debugprint ("FetchPPDs: using snapshot")
+                    self._set_ppds (cupshelpers.ppds.PPDs (result,
+                                                           language=
+                                                           self._language))
+        else:
+            self._ppds = None
+
         debugprint ("FetchPPDs: running")
-        self._ppds = None
-        self._cupsconn.getPPDs2 (reply_handler=self._cups_getppds_reply,
-                                 error_handler=self._cups_error)
+        self._fetching = True
+
+        # Only the answer to the latest request counts.
+        self._generation += 1
+        generation = self._generation
+        self._cupsconn.getPPDs2 (reply_handler=lambda conn, result:
+                                     self._cups_getppds_reply (conn, result,
+                                                               generation),
+                                 error_handler=lambda conn, exc:
+                                     self._cups_error (conn, exc,
+                                                       generation))
+
+    def revalidate_if_stale (self):
+        """
+        Check CUPS for changes to the list of PPDs in the background,
+        if it was last checked long enough ago, or fetch it again if
+        that failed.
+        """
+        if self._fetching:
+            return
+
+        if (self._ppds is not None and
+            time.monotonic () - self._checked < PPDS_REVALIDATE_INTERVAL):
+            return
+
+        self.run (revalidate=True)
+
+    def _set_ppds (self, ppds):
+        # The key is for spotting changes when revalidating.
+        self._key = _ppds_key (ppds)
+        self._ppds = ppds
+
+    def _cups_error (self, conn, exc, generation):
+        if generation != self._generation:
+            return
 
-    def _cups_error (self, conn, exc):
         debugprint ("FetchPPDs: error: %s" % repr (exc))
+        self._fetching = False
+        self._checked = time.monotonic ()
+        if self._ppds is not None:
+            # Carry on with the PPDs we already have.
+            return
+
         self.emit ('error', exc)
 
-    def _cups_getppds_reply (self, conn, result):
+    def _cups_getppds_reply (self, conn, result, generation):
+        if generation != self._generation:
+            debugprint ("FetchPPDs: ignoring superseded reply")
+            return
+
+        self._fetching = False
+        self._checked = time.monotonic ()
+        ppds = cupshelpers.ppds.PPDs (result, language=self._language)
+        if self._ppds is not None and _ppds_key (ppds) == self._key:
+            debugprint ("FetchPPDs: unchanged")
+            return
+
         debugprint ("FetchPPDs: success")
-        self._ppds = cupshelpers.ppds.PPDs (result, language=self._language)
+        self._set_ppds (ppds)
+        cupshelpers.ppds.savePPDsSnapshot (result)
         self.emit ('ready')
 
+def _ppds_key (ppds):
+    """
+    Return a key that changes when PPDs are added, removed, or have
+    any of their attributes changed, e.g. by a driver upgrade.
+
+    @param ppds: the PPDs to key
+    @type ppds: cupshelpers.ppds.PPDs
+    """
+    h = hashlib.sha1 ()
+    ppds.ppds.digest (h)
+    return h.hexdigest ()
+
+def _parse_device (device_id, device_make_and_model):
+    """
+    Work out the Device ID fields to match drivers against, using the
+    device-make-and-model string if there is no Device ID.
+
+    @returns: (device_id, id_dict) tuple
+    """
+    if device_id:
+        id_dict = cupshelpers.parseDeviceID (device_id)
+    else:
+        id_dict = {}
+        (mfg,
+         mdl) = cupshelpers.ppds.ppdMakeModelSplit (device_make_and_model)
+        id_dict["MFG"] = mfg
+        id_dict["MDL"] = mdl
+        id_dict["DES"] = ""
+        id_dict["CMD"] = []
+        device_id = "MFG:%s;MDL:%s;" % (mfg, mdl)
+
+    return (device_id, id_dict)
+
+def _get_best_drivers (ppds, device_id, device_make_and_model, device_uri,
+                       downloadedfiles=None):
+    """
+    Find the drivers for a device in order of preference, as returned
+    by GetBestDrivers.  GetBestDriversForDevices uses this too, so
+    that it gives the same answers.
+
+    @param ppds: the available PPDs
+    @type ppds: cupshelpers.ppds.PPDs
+    @param downloadedfiles: filenames from downloaded packages
+    @type downloadedfiles: string list
+    @returns: (device_id, fit, ppdnamelist) tuple, where device_id is
+    the Device ID that was matched against
+    """
+    (device_id, id_dict) = _parse_device (device_id, device_make_and_model)
+    fit = ppds.getPPDNamesFromDeviceID (id_dict["MFG"],
+                                        id_dict["MDL"],
+                                        id_dict["DES"],
+                                        id_dict["CMD"],
+                                        device_uri,
+                                        device_make_and_model)
+
+    ppdnamelist = ppds.orderPPDNamesByPreference (fit.keys (),
+                                                  downloadedfiles,
+                                                  devid=id_dict,
+                                                  fit=fit)
+    return (device_id, fit, ppdnamelist)
+
+def get_fetched_ppds (cupsconn, language):
+    """
+    Return the shared FetchedPPDs instance, creating it and starting
+    to fetch PPDs if necessary.
+    """
+    global g_ppds
+    if g_ppds is None:
+        g_ppds = FetchedPPDs (cupsconn, language)
+        g_ppds.run (revalidate=True)
+    else:
+        g_ppds.revalidate_if_stale ()
+
+    return g_ppds
+
 class GetBestDriversRequest:
     def __init__ (self, device_id, device_make_and_model, device_uri,
                   cupsconn, language, reply_handler, error_handler):
@@ -106,23 +259,16 @@ class GetBestDriversRequest:
         debugprint ("+%s" % self)
 
         g_killtimer.add_hold ()
-        global g_ppds
-        if g_ppds is None:
-            debugprint ("GetBestDrivers request: need to fetch PPDs")
-            g_ppds = FetchedPPDs (self.cupsconn, self.language)
-            self._signals.append (g_ppds.connect ('ready', self._ppds_ready))
-            self._signals.append (g_ppds.connect ('error', self._ppds_error))
-            g_ppds.run ()
+        fetchedppds = get_fetched_ppds (self.cupsconn, self.language)
+        if fetchedppds.is_ready ():
+            debugprint ("GetBestDrivers request: PPDs already fetched")
+            self._ppds_ready (fetchedppds)
         else:
-            if g_ppds.is_ready ():
-                debugprint ("GetBestDrivers request: PPDs already fetched")
-                self._ppds_ready (g_ppds)
-            else:
-                debugprint ("GetBestDrivers request: waiting for PPDs")
-                self._signals.append (g_ppds.connect ('ready',
-                                                      self._ppds_ready))
-                self._signals.append (g_ppds.connect ('error',
-                                                      self._ppds_error))
+            debugprint ("GetBestDrivers request: waiting for PPDs")
+            self._signals.append (fetchedppds.connect ('ready',
+                                                       self._ppds_ready))
+            self._signals.append (fetchedppds.connect ('error',
+                                                       self._ppds_error))
 
     def __del__ (self):
         debugprint ("-%s" % self)
@@ -131,6 +277,8 @@ class GetBestDriversRequest:
         for s in self._signals:
             g_ppds.disconnect (s)
 
+        self._signals = []
+
     def _ppds_error (self, fetchedppds, exc):
         self._disconnect_signals ()
         self.error_handler (exc)
@@ -144,29 +292,12 @@ class GetBestDriversRequest:
         ppds = fetchedppds.get_ppds ()
 
         try:
-            if self.device_id:
-                id_dict = cupshelpers.parseDeviceID (self.device_id)
-            else:
-                id_dict = {}
-                (mfg,
-                 mdl) = cupshelpers.ppds.ppdMakeModelSplit (self.device_make_and_model)
-                id_dict["MFG"] = mfg
-                id_dict["MDL"] = mdl
-                id_dict["DES"] = ""
-                id_dict["CMD"] = []
-                self.device_id = "MFG:%s;MDL:%s;" % (mfg, mdl)
-
-            fit = ppds.getPPDNamesFromDeviceID (id_dict["MFG"],
-                                                id_dict["MDL"],
-                                                id_dict["DES"],
-                                                id_dict["CMD"],
-                                                self.device_uri,
-                                                self.device_make_and_model)
-
-            ppdnamelist = ppds.orderPPDNamesByPreference (fit.keys (),
-                                                          self.installed_files,
-                                                          devid=id_dict,
-                                                          fit=fit)
+            (self.device_id,
+             fit,
+             ppdnamelist) = _get_best_drivers (ppds, self.device_id,
+                                               self.device_make_and_model,
+                                               self.device_uri,
+                                               self.installed_files)
             ppdname = ppdnamelist[0]
             status = fit[ppdname]
 
@@ -230,6 +361,103 @@ class GetBestDriversRequest:
         self._destroy_dialog ()
         self.reply_handler (self.reply_if_fail)
 
+class GetBestDriversForDevicesRequest:
+    def __init__ (self, devices, non_interactive, cupsconn, language,
+                  reply_handler, error_handler):
+        self.devices = [tuple (device) for device in devices]
+        self.non_interactive = non_interactive
+        self.cupsconn = cupsconn
+        self.language = language
+        self.reply_handler = reply_handler
+        self.error_handler = error_handler
+        self._signals = []
+        self._drivers = []
+        debugprint ("+%s" % self)
+
+        if not non_interactive:
+            # Each device may need a driver download dialog, so deal
+            # with them one at a time just as GetBestDrivers would.
+            self._next_device ()
+            return
+
+        g_killtimer.add_hold ()
+        fetchedppds = get_fetched_ppds (self.cupsconn, self.language)
+        if fetchedppds.is_ready ():
+            debugprint ("GetBestDriversForDevices request: "
+                        "PPDs already fetched")
+            self._ppds_ready (fetchedppds)
+        else:
+            debugprint ("GetBestDriversForDevices request: "
+                        "waiting for PPDs")
+            self._signals.append (fetchedppds.connect ('ready',
+                                                       self._ppds_ready))
+            self._signals.append (fetchedppds.connect ('error',
+                                                       self._ppds_error))
+
+    def __del__ (self):
+        debugprint ("-%s" % self)
+
+    def _disconnect_signals (self):
+        for s in self._signals:
+            g_ppds.disconnect (s)
+
+        self._signals = []
+
+    def _ppds_error (self, fetchedppds, exc):
+        self._disconnect_signals ()
+        g_killtimer.remove_hold ()
+        self.error_handler (exc)
+
+    def _ppds_ready (self, fetchedppds):
+        if not fetchedppds.is_ready ():
+            # PPDs being reloaded. Wait for next 'ready' signal.
+            return
+
+        self._disconnect_signals ()
+        ppds = fetchedppds.get_ppds ()
+
+        try:
+            # Identical devices (e.g. the same model on several
+            # queues) are only matched once.
+            results = {}
+            drivers = []
+            for device in self.devices:
+                result = results.get (device)
+                if result is None:
+                    (device_id, device_make_and_model, device_uri) = device
+                    (device_id,
+                     fit,
+                     ppdnamelist) = _get_best_drivers (ppds, device_id,
+                                                       device_make_and_model,
+                                                       device_uri)
+                    result = [(x, fit[x]) for x in ppdnamelist]
+                    results[device] = result
+
+                drivers.append (list (result))
+        except Exception as e:
+            g_killtimer.remove_hold ()
+            self.error_handler (e)
+            return
+
+        g_killtimer.remove_hold ()
+        self.reply_handler (drivers)
+
+    def _next_device (self):
+        if len (self._drivers) == len (self.devices):
+            self.reply_handler (self._drivers)
+            return
+
+        (device_id,
+         device_make_and_model,
+         device_uri) = self.devices[len (self._drivers)]
+        GetBestDriversRequest (device_id, device_make_and_model, device_uri,
+                               self.cupsconn, self.language,
+                               self._device_reply, self.error_handler)
+
+    def _device_reply (self, drivers):
+        self._drivers.append (drivers)
+        self._next_device ()
+
 class GroupPhysicalDevicesRequest:
     def __init__ (self, devices, reply_handler, error_handler):
         self.devices = devices
@@ -249,9 +477,9 @@ class GroupPhysicalDevicesRequest:
 
             if len (need_resolving) > 0:
                 resolver = dnssdresolve.DNSSDHostNamesResolver (need_resolving)
-                resolver.resolve (reply_handler=self._group)
+                resolver.resolve (reply_handler=self._resolve_hosts)
             else:
-                self._group ()
+                self._resolve_hosts ()
         except Exception as e:
             g_killtimer.remove_hold ()
             self.error_handler (e)
@@ -259,19 +487,23 @@ class GroupPhysicalDevicesRequest:
     def __del__ (self):
         debugprint ("-%s" % self)
 
-    def _group (self, resolved_devices=None):
+    def _resolve_hosts (self, resolved_devices=None):
         # We can ignore resolved_devices because the actual objects
-        # (in self.devices) have been modified.
+        # (in self.devices) have been modified.  Look up the host
+        # addresses in worker threads so that grouping does not
+        # block the main loop.
         try:
-            self.physdevs = []
-            for device_uri, deviceobj in self.deviceobjs.items ():
-                newphysicaldevice = PhysicalDevice.PhysicalDevice (deviceobj)
-                matched = False
-                try:
-                    i = self.physdevs.index (newphysicaldevice)
-                    self.physdevs[i].add_device (deviceobj)
-                except ValueError:
-                    self.physdevs.append (newphysicaldevice)
+            PhysicalDevice.resolve_device_hosts (
+                self.deviceobjs.values (),
+                reply_handler=lambda: GLib.idle_add (self._group))
+        except Exception as e:
+            g_killtimer.remove_hold ()
+            self.error_handler (e)
+
+    def _group (self):
+        try:
+            self.physdevs = PhysicalDevice.group_devices (
+                self.deviceobjs.values ())
 
             uris_by_phys = []
             for physdev in self.physdevs:
@@ -457,7 +689,7 @@ class ConfigPrintingJobApplet(dbus.service.Object):
         self.remove_from_connection ()
 
 class ConfigPrinting(dbus.service.Object):
-    def __init__ (self):
+    def __init__ (self, prewarm=False):
         self.bus = dbus.SessionBus ()
         bus_name = dbus.service.BusName (CONFIG_BUS, bus=self.bus)
         dbus.service.Object.__init__ (self, bus_name, CONFIG_PATH)
@@ -470,6 +702,14 @@ class ConfigPrinting(dbus.service.Object):
         if not self._language:
             self._language = locale.getlocale (locale.LC_CTYPE)[0]
 
+        if prewarm:
+            GLib.idle_add (self._prewarm)
+
+    def _prewarm (self):
+        debugprint ("Prewarming PPDs")
+        get_fetched_ppds (self._cupsconn, self._language)
+        return False
+
     def destroy (self):
         self._cupsconn.destroy ()
 
@@ -512,6 +752,15 @@ class ConfigPrinting(dbus.service.Object):
                                self._cupsconn, self._language,
                                reply_handler, error_handler)
 
+    @dbus.service.method(dbus_interface=CONFIG_IFACE,
+                         in_signature='a(sss)b', out_signature='aa(ss)',
+                         async_callbacks=('reply_handler', 'error_handler'))
+    def GetBestDriversForDevices(self, devices, non_interactive,
+                                 reply_handler, error_handler):
+        GetBestDriversForDevicesRequest (devices, non_interactive,
+                                         self._cupsconn, self._language,
+                                         reply_handler, error_handler)
+
     @dbus.service.method(dbus_interface=CONFIG_IFACE,
                          in_signature='s', out_signature='as')
     def MissingExecutables(self, ppd_filename):
@@ -579,6 +828,7 @@ if __name__ == '__main__':
     DBusGMainLoop (set_as_default=True)
 
     client_demo = False
+    prewarm = False
     if len (sys.argv) > 1:
         for opt in sys.argv[1:]:
             if opt == "--debug":
@@ -586,6 +836,8 @@ if __name__ == '__main__':
                 cupshelpers.set_debugprint_fn (debugprint)
             elif opt == "--client":
                 client_demo = True
+            elif opt == "--prewarm":
+                prewarm = True
 
     if client_demo:
         _client_demo ()
@@ -593,6 +845,6 @@ if __name__ == '__main__':
 
     debugprint ("Service running...")
     g_killtimer = killtimer.KillTimer (killfunc=Gtk.main_quit)
-    cp = ConfigPrinting ()
+    cp = ConfigPrinting (prewarm=prewarm)
     Gtk.main ()
     cp.destroy ()
@@ -20,11 +20,38 @@
 ## Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
 
 import cups
+import locale
 import os
 import config
 import gettext
 gettext.install(domain=config.PACKAGE, localedir=config.localedir)
 
+# Reasons localized using the printer's PPD, indexed by
+# (printer, reason, language).  A value of None means the PPD has no
+# localization for the reason.
+_localized_reasons = {}
+
+def _get_language ():
+    try:
+        return locale.getlocale (locale.LC_MESSAGES)[0]
+    except (ValueError, AttributeError):
+        return None
+
+def forget_localized_reasons (printer=None):
+    """
+    Discard reasons localized from a printer's PPD, for example
+    because the PPD has changed.
+
+    @param printer: printer name, or None for all printers
+    @type printer: string
+    """
+    if printer is None:
+        _localized_reasons.clear ()
+        return
+
+    for key in [k for k in _localized_reasons.keys () if k[0] == printer]:
+        del _localized_reasons[key]
+
 class StateReason:
     REPORT=1
     WARNING=2
@@ -41,12 +68,69 @@ class StateReason:
         self.reason = reason
         self.level = None
         self.canonical_reason = None
-        self._ppd = None
-        if ppdcache:
-            ppdcache.fetch_ppd (printer, self._got_ppd)
+        self._ppdcache = ppdcache
+        self._fetching_ppd = False
+        self._ppd_callbacks = []
 
-    def _got_ppd (self, name, result, exc):
-        self._ppd = result
+    def _localize_reason (self, ppd):
+        localized_reason = ""
+        try:
+            schemes = ["text", "http", "help", "file"]
+            for scheme in schemes:
+                lreason = ppd.localizeIPPReason(self.reason, scheme)
+                if lreason is not None:
+                    localized_reason = localized_reason + lreason + ", "
+        except RuntimeError:
+            pass
+
+        if localized_reason != "":
+            return localized_reason[:-2]
+
+        return None
+
+    def _get_localized_reason (self, callback=None):
+        """
+        Get the reason as localized by the printer's PPD.  The PPD is
+        only fetched the first time this is needed, so until it
+        arrives this returns None.
+
+        @param callback: function to call, with this StateReason, if
+        a localization arrives later
+        """
+        key = (self.printer, self.reason, _get_language ())
+        try:
+            return _localized_reasons[key]
+        except KeyError:
+            pass
+
+        if not self._ppdcache:
+            return None
+
+        if callback is not None and callback not in self._ppd_callbacks:
+            self._ppd_callbacks.append (callback)
+
+        if not self._fetching_ppd:
+            self._fetching_ppd = True
+            self._ppdcache.fetch_ppd (self.printer,
+                                      lambda name, result, exc:
+                                          self._got_ppd (key, result, exc))
+
+        return None
+
+    def _got_ppd (self, key, result, exc):
+        self._fetching_ppd = False
+        localized_reason = None
+        if result:
+            localized_reason = self._localize_reason (result)
+
+        # Remember failures too, e.g. for raw queues, so that the PPD
+        # is not requested again each time.
+        _localized_reasons[key] = localized_reason
+        callbacks = self._ppd_callbacks
+        self._ppd_callbacks = []
+        if localized_reason is not None:
+            for callback in callbacks:
+                callback (self)
 
     def get_printer (self):
         return self.printer
@@ -104,7 +188,16 @@ class StateReason:
                                                          self.get_printer (),
                                                          self.get_reason ())
 
-    def get_description (self):
+    def get_description (self, callback=None):
+        """
+        Describe the reason.  If it needs localizing from the
+        printer's PPD, the first description may use the reason
+        keyword instead while the PPD is fetched.
+
+        @param callback: function to call, with this StateReason, if
+        a better description becomes available once the PPD arrives
+        @returns: (title, text) tuple
+        """
         messages = {
             'toner-low': (_("Toner low"),
                           _("Printer '%s' is low on toner.")),
@@ -149,19 +242,9 @@ class StateReason:
                 title = _("Printer error")
 
             reason = self.get_reason ()
-            if self._ppd:
-                try:
-                    schemes = ["text", "http", "help", "file"]
-                    localized_reason = ""
-                    for scheme in schemes:
-                        lreason = self._ppd.localizeIPPReason(self.reason,
-                                                              scheme)
-                        if lreason is not None:
-                            localized_reason = localized_reason + lreason + ", "
-                    if localized_reason != "":
-                        reason = localized_reason[:-2]
-                except RuntimeError:
-                    pass
+            localized_reason = self._get_localized_reason (callback)
+            if localized_reason is not None:
+                reason = localized_reason
 
             text = (_("Printer '%s': '%s'.") % (self.get_printer (), reason))
         return (title, text)
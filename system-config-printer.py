@@ -523,6 +523,9 @@ class GUI(GtkGUI):
         self.propertiesDlg = printerproperties.PrinterPropertiesDialog ()
         self.propertiesDlg.connect ("dialog-closed",
                                     self.on_properties_dialog_closed)
+        self.propertiesDlg.connect ("ppd-loaded",
+                                    self.on_properties_ppd_loaded)
+        self.ppd_loaded_action = None
 
         self.connect_signals ()
 
@@ -1524,15 +1527,20 @@ class GUI(GtkGUI):
                                      host=self.connect_server,
                                      encryption=self.connect_encrypt,
                                      parent=self.PrintersWindow)
-        except RuntimeError:
-            # Perhaps cupsGetPPD2 failed for a browsed printer
-            pass
         except cups.IPPError as e:
             (e, m) = e.args
             show_IPP_Error (e, m, self.PrintersWindow)
             self.populateList ()
             return
 
+        # The new queue is created from the old one's PPD, so wait
+        # until that has been fetched.
+        def do_rename (name):
+            self.rename_loaded_printer (old_name, new_name)
+
+        self.when_ppd_loaded (old_name, do_rename)
+
+    def rename_loaded_printer (self, old_name, new_name):
         if not self.is_rename_possible (old_name):
             return
 
@@ -1660,17 +1668,19 @@ class GUI(GtkGUI):
                                      host=self.connect_server,
                                      encryption=self.connect_encrypt,
                                      parent=self.PrintersWindow)
-        except RuntimeError:
-            # Perhaps cupsGetPPD2 failed for a browsed printer
-            pass
         except cups.IPPError as e:
             (e, m) = e.args
             show_IPP_Error (e, m, self.PrintersWindow)
             self.populateList ()
             return
 
-        self.duplicate_printer (self.entDuplicateName.get_text ())
-        self.monitor.update ()
+        # Save the copy only once the original's PPD has arrived.
+        new_name = self.entDuplicateName.get_text ()
+        def do_duplicate (name):
+            self.duplicate_printer (new_name)
+            self.monitor.update ()
+
+        self.when_ppd_loaded (name, do_duplicate)
 
     def on_entDuplicateName_changed(self, widget):
         # restrict
@@ -2019,8 +2029,13 @@ class GUI(GtkGUI):
 
             iter = model.iter_next (iter)
 
-        # Any missing drivers?
+        # The remaining checks need the PPD, which the properties
+        # dialog fetches in the background.
         self.propertiesDlg.load (name)
+        self.when_ppd_loaded (name, self.check_new_printer)
+
+    def check_new_printer (self, name):
+        # Any missing drivers?
         if (self.propertiesDlg.ppd and
             not (self.propertiesDlg.printer.discovered or
                  self.propertiesDlg.printer.remote)):
@@ -2053,8 +2068,12 @@ class GUI(GtkGUI):
                     pass
 
                 if properties_shown:
-                    # Click the test button.
-                    self.propertiesDlg.btnPrintTestPage.clicked ()
+                    # Click the test button once the PPD is there, so
+                    # that the test page matches the page size.
+                    self.when_ppd_loaded (name, self.print_test_page_for)
+
+    def print_test_page_for (self, name):
+        self.propertiesDlg.btnPrintTestPage.clicked ()
 
     ## Service start-up
     def on_start_service_clicked (self, button):
@@ -2150,9 +2169,11 @@ class GUI(GtkGUI):
         debugprint ("Printer modified by user: %s" % name)
         # Load information about the printer,
         # e.g. self.propertiesDlg.server_side_options and self.propertiesDlg.ppd
-        # (both used below).
+        # (both used below, once the PPD has been fetched).
         self.propertiesDlg.load (name)
+        self.when_ppd_loaded (name, self.check_modified_printer)
 
+    def check_modified_printer (self, name):
         if self.propertiesDlg.ppd:
             try:
                 self.checkDriverExists (self.propertiesDlg.dialog,
@@ -2176,6 +2197,22 @@ class GUI(GtkGUI):
             except:
                 nonfatalException()
 
+    def when_ppd_loaded (self, name, action):
+        """
+        Arrange for action (name) to be called once the properties
+        dialog has finished fetching the PPD for queue name.
+        """
+        self.ppd_loaded_action = (name, action)
+
+    def on_properties_ppd_loaded (self, dialog):
+        if self.ppd_loaded_action is None:
+            return
+
+        (name, action) = self.ppd_loaded_action
+        self.ppd_loaded_action = None
+        if dialog.printer and dialog.printer.name == name:
+            action (name)
+
     def defer_refresh (self):
         def deferred_refresh ():
             self.populateList_timer = None
@@ -21,7 +21,7 @@
 import pytest
 try:
     import cups
-    from PhysicalDevice import PhysicalDevice
+    from PhysicalDevice import PhysicalDevice, group_devices, HostResolver
     from cupshelpers import cupshelpers
 except ImportError:
     cups = None
@@ -73,3 +73,74 @@ def test_ordering():
     devices = phys.get_devices ()
     assert devices[0] < devices[1]
     assert devices[0].uri.startswith ("hp")
+
+@pytest.mark.skipif(cups is None, reason="cups module not available")
+def test_grouping():
+    def make_devices ():
+        devices = []
+        for uri, make_and_model, device_id, device_class in [
+                ("usb://HP/LaserJet%204000?serial=ABC", "HP LaserJet 4000",
+                 "MFG:HP;MDL:LaserJet 4000;SN:ABC;", "direct"),
+                ("hp:/usb/HP_LaserJet_4000?serial=ABC", "HP LaserJet 4000",
+                 "MFG:Hewlett-Packard;MDL:HP LaserJet 4000;SN:ABC;",
+                 "direct"),
+                ("usb://HP/LaserJet%204000?serial=DEF", "HP LaserJet 4000",
+                 "MFG:HP;MDL:LaserJet 4000;SN:DEF;", "direct"),
+                ("socket://10.0.0.1:9100", "Canon PIXMA iP4200",
+                 "MFG:Canon;MDL:PIXMA iP4200;", "network"),
+                ("ipp://10.0.0.1/ipp/print", "Canon PIXMA iP4200",
+                 "MFG:Canon;MDL:PIXMA iP4200;", "network"),
+                ("socket://10.0.0.2", "Canon PIXMA iP4200",
+                 "MFG:Canon;MDL:PIXMA iP4200;", "network"),
+                ("usb://EPSON/Stylus%20Photo%20R300", "EPSON Stylus Photo R300",
+                 "MFG:EPSON;MDL:Stylus Photo R300;", "direct"),
+                ("parallel:/dev/lp0", "Unknown", "", "direct"),
+                ("lpd", "Unknown", "", "network")]:
+            devices.append (cupshelpers.Device (uri,
+                                                **{'device-class': device_class,
+                                                   'device-make-and-model':
+                                                   make_and_model,
+                                                   'device-id': device_id}))
+        return devices
+
+    expected = []
+    for device in make_devices ():
+        physicaldevice = PhysicalDevice (device)
+        try:
+            i = expected.index (physicaldevice)
+            expected[i].add_device (device)
+        except ValueError:
+            expected.append (physicaldevice)
+
+    grouped = group_devices (make_devices ())
+    assert ([[x.uri for x in p.get_devices ()] for p in grouped] ==
+            [[x.uri for x in p.get_devices ()] for p in expected])
+    assert len (grouped) == 7
+
+@pytest.mark.skipif(cups is None, reason="cups module not available")
+def test_host_resolver(monkeypatch):
+    import socket
+    import threading
+    lookups = []
+    def getaddrinfo (host, port, family=0):
+        lookups.append ((host, family))
+        if host == "printer.example.com":
+            return [(family, 0, 0, '', ("192.0.2.1", 0))]
+        raise socket.gaierror
+
+    monkeypatch.setattr (socket, "getaddrinfo", getaddrinfo)
+    resolver = HostResolver ()
+    done = threading.Event ()
+    resolver.resolve (["printer.example.com", "missing.example.com", None],
+                      reply_handler=done.set)
+    assert done.wait (10)
+    assert resolver.get_cached ("printer.example.com") == (True, "192.0.2.1")
+    # Failures are cached too.
+    assert resolver.get_cached ("missing.example.com") == (True, None)
+    n = len (lookups)
+    assert resolver.lookup ("printer.example.com") == "192.0.2.1"
+    assert resolver.lookup ("missing.example.com") is None
+    assert len (lookups) == n
+
+    resolver.clear ()
+    assert resolver.get_cached ("printer.example.com") == (False, None)
@@ -0,0 +1,113 @@
+#!/usr/bin/python3
+
+## system-config-printer
+
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import pytest
+try:
+    import cups
+    from cupshelpers.ppds import normalize
+except ImportError:
+    cups = None
+
+def _reference_normalize (strin):
+    # The original character-by-character algorithm.
+    lstrin = strin.strip ().lower ()
+    normalized = ""
+
+    BLANK=0
+    ALPHA=1
+    DIGIT=2
+    lastchar = BLANK
+
+    alnumfound = False
+    for i in range (len (lstrin)):
+        if lstrin[i].isalpha ():
+            if lastchar != ALPHA and alnumfound:
+                normalized += " ";
+            lastchar = ALPHA
+        elif lstrin[i].isdigit ():
+            if lastchar != DIGIT and alnumfound:
+                normalized += " ";
+            lastchar = DIGIT
+        else:
+            lastchar = BLANK
+
+        if lstrin[i].isalnum ():
+            normalized += lstrin[i]
+            alnumfound = True
+
+    return normalized
+
+# ppd-make-and-model and Device ID strings as reported by real drivers.
+MAKE_AND_MODEL = [
+    "HP LaserJet 4 Plus v2013.111 Postscript (recommended)",
+    "HP Color LaserJet CP3525, hpcups 3.20.3",
+    "HP PSC 2200 Series, hpcups 3.20.3",
+    "HP DeskJet 990C Foomatic/hpijs (recommended)",
+    "Hewlett-Packard LaserJet 6MP",
+    "Canon MG4100 series Ver.3.90",
+    "Canon PIXMA iP3000 - CUPS+Gutenprint v5.3.4",
+    "Canon iR-ADV C5045/5051 PS",
+    "Epson Stylus D78 - CUPS+Gutenprint v5.3.4 Simplified",
+    "Epson PM-A820",
+    "EPSON PX-V500",
+    "Brother HL-2030 Foomatic/hl1250 (recommended)",
+    "Brother MFC-J6910DW BR-Script3",
+    "Xerox WorkCentre 7845 v5.617.0.0 PS",
+    "Xerox 6250DP",
+    "Ricoh Aficio 3045 PS (en)",
+    "KONICA MINOLTA bizhub C454e PS",
+    "Kyocera Mita FS-1020D",
+    "Lexmark International Optra E312",
+    "OKI C5650(PS)",
+    "Generic PCL 6/PCL XL Printer Foomatic/pxlcolor (recommended)",
+    "Generic PostScript Printer Foomatic/Postscript (recommended)",
+    "Generic text-only printer",
+    "Samsung ML-2160 Series",
+    "Dymo LabelWriter 450 Twin Turbo",
+    "Zebra ZPL Label Printer",
+    "Fuji Xerox DocuPrint CP105 b",
+    "Citizen CT-S2000",
+    "  leading and trailing  ",
+    "",
+    "---",
+    "a1b2c3",
+    "Model_With_Underscores_42",
+    "Canon_PIXMA_iP4200 TurboPrint",
+    # Non-ASCII strings take the character-by-character path.
+    "Ricoh Aficio SP C232SF (Français)",
+    "Olivetti d-Color MF2400 Ü",
+    "キヤノン LBP3000",
+    "EPSON PX-1004 ½ size",
+    "Model ² test",
+    "İnce printer",
+]
+
+@pytest.mark.skipif(cups is None, reason="cups module not available")
+def test_normalize_equivalence():
+    for strin in MAKE_AND_MODEL:
+        assert normalize (strin) == _reference_normalize (strin), strin
+
+        # Again, from the memo.
+        assert normalize (strin) == _reference_normalize (strin), strin
+
+@pytest.mark.skipif(cups is None, reason="cups module not available")
+def test_normalize_examples():
+    assert normalize ("Epson PM-A820") == "epson pm a 820"
+    assert normalize ("Epson PM A820") == "epson pm a 820"
+    assert normalize ("HP PhotoSmart C 8100") == "hp photosmart c 8100"
+    assert normalize ("hp Photosmart C8100") == "hp photosmart c 8100"
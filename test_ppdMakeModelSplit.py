@@ -0,0 +1,142 @@
+#!/usr/bin/python3
+
+## system-config-printer
+
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import pytest
+try:
+    import cups
+    from cupshelpers.ppds import ppdMakeModelSplit
+except ImportError:
+    cups = None
+
+# ppd-make-and-model and ppd-product strings, and how they are split.
+# The on-disk PPDs index depends on these results, so any change here
+# also needs the index version bumping.
+CORPUS = [
+    ('HP LaserJet 4 Plus v2013.111 Postscript (recommended)',
+     ('HP', 'LaserJet 4 Plus')),
+    ('HP Color LaserJet CP3525, hpcups 3.20.3',
+     ('HP', 'Color LaserJet CP3525')),
+    ('HP PSC 2200 Series, hpcups 3.20.3',
+     ('HP', 'PSC 2200')),
+    ('HP DeskJet 990C Foomatic/hpijs (recommended)',
+     ('HP', 'DeskJet 990C')),
+    ('HP Officejet Series 300',
+     ('HP', 'Officejet 300')),
+    ('HP DJ 5550',
+     ('HP', 'DeskJet 5550')),
+    ('hp color lj 4500',
+     ('HP', 'Color LaserJet 4500')),
+    ('HP PS 7150',
+     ('HP', 'PhotoSmart7150')),
+    ('Hewlett-Packard LaserJet 6MP',
+     ('HP', 'LaserJet 6MP')),
+    ('Hewlett Packard HP LaserJet 1200',
+     ('Hewlett', 'Packard HP LaserJet 1200')),
+    ('LaserJet 4',
+     ('LaserJet', '4')),
+    ('DeskJet 990C',
+     ('DeskJet', '990C')),
+    ('Stylus Color 600',
+     ('Stylus', 'Color 600')),
+    ('PIXMA iP4200',
+     ('PIXMA', 'iP4200')),
+    ('hl-2030',
+     ('hl-2030', '')),
+    ('Canon MG4100 series Ver.3.90',
+     ('Canon', 'MG4100')),
+    ('Canon PIXMA iP3000 - CUPS+Gutenprint v5.3.4',
+     ('Canon', 'PIXMA iP3000')),
+    ('Canon Inc iR-ADV C5045 UFR II',
+     ('Canon', 'iR-ADV C5045')),
+    ('Canon LBP3000 PCL',
+     ('Canon', 'LBP3000')),
+    ('Epson Stylus D78 - CUPS+Gutenprint v5.3.4 Simplified',
+     ('Epson', 'Stylus D78')),
+    ('EPSON PX-V500',
+     ('Epson', 'PX-V500')),
+    ('Epson PX V500',
+     ('Epson', 'PX V500')),
+    ('Brother HL-2030 Foomatic/hl1250 (recommended)',
+     ('Brother', 'HL-2030')),
+    ('Brother MFC-J6910DW BR-Script3',
+     ('Brother', 'MFC-J6910DW')),
+    ('Xerox WorkCentre 7845 v5.617.0.0 PS',
+     ('Xerox', 'WorkCentre 7845 v5.617.0.0')),
+    ('Fuji Xerox DocuPrint CP105 b',
+     ('Fuji Xerox', 'DocuPrint CP105 b')),
+    ('Ricoh Aficio 3045 PS (en)',
+     ('Ricoh', 'Aficio 3045')),
+    ('KONICA MINOLTA bizhub C454e PS',
+     ('KONICA MINOLTA', 'bizhub C454e')),
+    ('Konica-Minolta magicolor 2430 DL',
+     ('KONICA MINOLTA', 'magicolor 2430 DL')),
+    ('Kyocera Mita FS-1020D',
+     ('Kyocera', 'FS-1020D')),
+    ('Kyocera TASKalfa 3051ci',
+     ('Kyocera', 'TASKalfa 3051ci')),
+    ('Lexmark International Optra E312',
+     ('Lexmark', 'Optra E312')),
+    ('OKI C5650(PS)',
+     ('Oki', 'C5650(PS)')),
+    ('oki MicroLine 320',
+     ('Oki', 'MicroLine 320')),
+    ('Generic PCL 6/PCL XL Printer Foomatic/pxlcolor (recommended)',
+     ('Generic', 'PCL 6/PCL XL')),
+    ('Generic PostScript Printer Foomatic/Postscript (recommended)',
+     ('Generic', 'PostScript')),
+    ('Generic text-only printer',
+     ('Generic', 'text-only')),
+    ('Samsung ML-2160 Series',
+     ('Samsung', 'ML-2160')),
+    ('Samsung SCX-3400 All-in-One w/ duplex',
+     ('Samsung', 'SCX-3400')),
+    ('Dell 1130 Laser Printer, 1.0',
+     ('Dell', '1130 Laser')),
+    ('Zebra ZPL Label Printer',
+     ('Zebra', 'ZPL Label')),
+    ('Dymo LabelWriter 450 Twin Turbo',
+     ('Dymo', 'LabelWriter 450 Twin Turbo')),
+    ('Canon_PIXMA_iP4200 TurboPrint',
+     ('Canon', 'PIXMA_i P4200')),
+    ('HewlettPackard_PhotoSmart7150 TurboPrint',
+     ('HP', 'PhotoSmart 7150')),
+    ('Epson_StylusPhoto1290 TurboPrint foo TurboPrint',
+     ('foo', '')),
+    ('Stylus TurboPrint',
+     ('Stylus', 'TurboPrint')),
+    ('turboprint',
+     ('turboprint', '')),
+    ('Raw Queue',
+     ('Raw', 'Queue')),
+    ('Generic Raw Queue',
+     ('Generic', 'Raw Queue')),
+    ('Citizen',
+     ('Citizen', '')),
+    ('',
+     ('', '')),
+]
+
+@pytest.mark.skipif(cups is None, reason="cups module not available")
+def test_ppdMakeModelSplit():
+    for (ppd_make_and_model, expected) in CORPUS:
+        assert ppdMakeModelSplit (ppd_make_and_model) == expected, \
+            ppd_make_and_model
+
+        # Again, from the memo.
+        assert ppdMakeModelSplit (ppd_make_and_model) == expected, \
+            ppd_make_and_model
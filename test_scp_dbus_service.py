@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+## Copyright (C) 2015 Red Hat, Inc.
+
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+import os.path
+import time
+import pytest
+try:
+    import cups
+    import importlib.machinery
+    import importlib.util
+    from cupshelpers.ppds import PPDs
+    # The service is a script, not a module, so load it by path.
+    srcdir = os.path.dirname (os.path.abspath (__file__))
+    loader = importlib.machinery.SourceFileLoader ("scp_dbus_service",
+                                                   os.path.join (srcdir,
+                                                                 "scp-dbus-service.py"))
+    scp = importlib.util.module_from_spec (
+        importlib.util.spec_from_loader (loader.name, loader))
+    loader.exec_module (scp)
+except (ImportError, ValueError):
+    cups = None
+
+class KillTimer:
+    def add_hold (self):
+        pass
+
+    def remove_hold (self):
+        pass
+
+def _hp_ppds ():
+    devid = ['MFG:HP;MDL:hp LaserJet 1320 series;DES:;']
+    return {
+        'lsb/usr/HP/hp-laserjet_1320_series-ps.ppd':
+        {'ppd-make-and-model':
+         ['HP LaserJet 1320 Series Postscript (recommended)'],
+         'ppd-natural-language': ['en'],
+         'ppd-make': ['HP'],
+         'ppd-device-id': devid},
+        'drv:///hpcups.drv/hp-laserjet_1320.ppd':
+        {'ppd-make-and-model': ['HP LaserJet 1320, hpcups 3.20.3'],
+         'ppd-natural-language': ['en'],
+         'ppd-make': ['HP'],
+         'ppd-device-id': devid},
+        'foomatic:HP-LaserJet_1320-Postscript.ppd':
+        {'ppd-make-and-model': ['HP LaserJet 1320 Foomatic/Postscript'],
+         'ppd-natural-language': ['en'],
+         'ppd-make': ['HP'],
+         'ppd-device-id': devid},
+        'raw':
+        {'ppd-make-and-model': ['Raw Queue'],
+         'ppd-natural-language': ['en'],
+         'ppd-make': ['Raw']},
+        }
+
+@pytest.mark.skipif(cups is None, reason="cups module not available")
+def test_batch_drivers_match_single_device ():
+    ppds = PPDs (_hp_ppds (), xml_dir=os.path.join (srcdir, "xml"))
+    fetchedppds = scp.FetchedPPDs (None, None)
+    fetchedppds._set_ppds (ppds)
+    fetchedppds._checked = time.monotonic ()
+    scp.g_ppds = fetchedppds
+    scp.g_killtimer = KillTimer ()
+
+    devices = [("MFG:Hewlett-Packard;MDL:HP LaserJet 1320 series;"
+                "CMD:PJL,MLC,PCL,POSTSCRIPT;CLS:PRINTER;",
+                "HP LaserJet 1320 series",
+                "usb://HP/LaserJet%201320%20series"),
+               ("",
+                "HP LaserJet 1320 series",
+                "socket://192.0.2.1")]
+
+    def error_handler (e):
+        raise e
+
+    single = []
+    for device in devices:
+        scp.GetBestDriversRequest (*device, cupsconn=None, language=None,
+                                   reply_handler=single.append,
+                                   error_handler=error_handler)
+
+    batch = []
+    scp.GetBestDriversForDevicesRequest (devices, True,
+                                         cupsconn=None, language=None,
+                                         reply_handler=batch.append,
+                                         error_handler=error_handler)
+    assert len (single) == len (devices)
+    assert single[0][0][0] == 'lsb/usr/HP/hp-laserjet_1320_series-ps.ppd'
+    assert batch == [single]
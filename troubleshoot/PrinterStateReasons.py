@@ -59,12 +59,7 @@ class PrinterStateReasons(Question):
 
         the_ppdcache = ppdcache.PPDCache ()
 
-        text = ''
         state_message = dict['printer-state-message']
-        if state_message:
-            text += _("The printer's state message is: '%s'.") % state_message
-            text += '\n\n'
-
         state_reasons_list = dict['printer-state-reasons']
         if type (state_reasons_list) == str:
             state_reasons_list = [state_reasons_list]
@@ -72,14 +67,42 @@ class PrinterStateReasons(Question):
         self.state_message = state_message
         self.state_reasons = state_reasons_list
 
-        human_readable_errors = []
-        human_readable_warnings = []
+        self.reasons = []
         for reason in state_reasons_list:
             if reason == "none":
                 continue
 
-            r = statereason.StateReason (queue, reason, the_ppdcache)
-            (title, description) = r.get_description ()
+            self.reasons.append (statereason.StateReason (queue, reason,
+                                                          the_ppdcache))
+
+        (errors, warnings) = self.update_label ()
+        if (state_message == '' and
+            len (errors) == 0 and
+            len (warnings) == 0):
+            return False
+
+        # If this screen has been show before, don't show it again if
+        # nothing changed.
+        if 'printer-state-message' in troubleshooter.answers:
+            if (troubleshooter.answers['printer-state-message'] ==
+                self.state_message and
+                troubleshooter.answers['printer-state-reasons'] ==
+                self.state_reasons):
+                return False
+
+        return True
+
+    def update_label (self):
+        text = ''
+        if self.state_message:
+            text += (_("The printer's state message is: '%s'.") %
+                     self.state_message)
+            text += '\n\n'
+
+        human_readable_errors = []
+        human_readable_warnings = []
+        for r in self.reasons:
+            (title, description) = r.get_description (self.on_reason_localized)
             level = r.get_level ()
             if level == statereason.StateReason.ERROR:
                 human_readable_errors.append (description)
@@ -96,21 +119,14 @@ class PrinterStateReasons(Question):
             text += reduce (lambda x, y: x + "\n" + y, human_readable_warnings)
 
         self.label.set_text (text)
-        if (state_message == '' and
-            len (human_readable_errors) == 0 and
-            len (human_readable_warnings) == 0):
-            return False
-
-        # If this screen has been show before, don't show it again if
-        # nothing changed.
-        if 'printer-state-message' in troubleshooter.answers:
-            if (troubleshooter.answers['printer-state-message'] ==
-                self.state_message and
-                troubleshooter.answers['printer-state-reasons'] ==
-                self.state_reasons):
-                return False
-
-        return True
+        return (human_readable_errors, human_readable_warnings)
+
+    def on_reason_localized (self, reason):
+        # Only update the label if it is still showing this reason.
+        for r in self.reasons:
+            if r is reason:
+                self.update_label ()
+                break
 
     def collect_answer (self):
         if not self.displayed: